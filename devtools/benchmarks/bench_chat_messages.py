@@ -0,0 +1,137 @@
+"""
+benchmark tokenizing formatted chats in a single offset-mapped pass against re-tokenizing
+each message after every content part, and against formatting the chats as dicts without
+building the pydantic models
+
+    python devtools/benchmarks/bench_chat_messages.py --tokenizer NousResearch/Meta-Llama-3-8B-Instruct
+"""
+import random
+import time
+
+import click
+from transformers import AutoTokenizer
+
+from axolotl.core.chat.format.chatml import format_message, format_message_dict
+from axolotl.core.chat.messages import (
+    ChatFormattedChats,
+    message_segments,
+    tokenize_segments,
+)
+
+WORDS = "the quick brown fox jumps over a lazy dog while axolotls swim in lakes".split()
+
+
+def random_text(rng: random.Random, num_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def tool_heavy_chat(rng: random.Random, num_turns: int, num_parts: int) -> dict:
+    conversation = [
+        {"role": "system", "content": [{"type": "text", "value": random_text(rng, 32)}]}
+    ]
+    for _ in range(num_turns):
+        conversation.append(
+            {
+                "role": "user",
+                "content": [{"type": "text", "value": random_text(rng, 64)}],
+            }
+        )
+        conversation.append(
+            {
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "tool_call",
+                        "value": {
+                            "name": f"tool_{idx}",
+                            "arguments": {"query": random_text(rng, 16)},
+                        },
+                    }
+                    for idx in range(num_parts)
+                ],
+                "weight": 1,
+            }
+        )
+        conversation.append(
+            {
+                "role": "tool",
+                "content": [
+                    {
+                        "type": "tool_response",
+                        "value": {
+                            "name": f"tool_{idx}",
+                            "content": {"result": random_text(rng, 48)},
+                        },
+                    }
+                    for idx in range(num_parts)
+                ],
+            }
+        )
+        conversation.append(
+            {
+                "role": "assistant",
+                "content": [
+                    {"type": "text", "value": random_text(rng, 96), "weight": idx % 2}
+                    for idx in range(num_parts)
+                ],
+                "weight": 1,
+            }
+        )
+    return {"conversation": conversation}
+
+
+def tokenize_incremental(chat: dict, tokenizer) -> int:
+    chats = ChatFormattedChats(**chat, formatter=format_message)
+    return sum(
+        len(msg.tokenized_incremental(tokenizer)["input_ids"])
+        for msg in chats.conversation
+    )
+
+
+def tokenize_single_pass(chat: dict, tokenizer) -> int:
+    chats = ChatFormattedChats(**chat, formatter=format_message)
+    return len(chats.tokenized(tokenizer)["input_ids"])
+
+
+def tokenize_from_dicts(chat: dict, tokenizer) -> int:
+    segments = [
+        message_segments(format_message_dict(msg, message_index=idx))
+        for idx, msg in enumerate(chat["conversation"])
+    ]
+    return sum(
+        len(res["input_ids"])
+        for res in tokenize_segments(tokenizer, segments)  # type: ignore[arg-type]
+    )
+
+
+@click.command()
+@click.option("--tokenizer", "tokenizer_name", type=str, required=True)
+@click.option("--num-chats", type=int, default=500)
+@click.option("--num-turns", type=int, default=4)
+@click.option("--num-parts", type=int, default=8)
+@click.option("--seed", type=int, default=42)
+def benchmark(tokenizer_name, num_chats, num_turns, num_parts, seed):
+    rng = random.Random(seed)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    chats = [tool_heavy_chat(rng, num_turns, num_parts) for _ in range(num_chats)]
+
+    results = {}
+    for name, tokenize in (
+        ("incremental", tokenize_incremental),
+        ("single pass", tokenize_single_pass),
+        ("from dicts", tokenize_from_dicts),
+    ):
+        start = time.perf_counter()
+        num_tokens = sum(tokenize(chat, tokenizer) for chat in chats)
+        elapsed = time.perf_counter() - start
+        results[name] = elapsed
+        print(
+            f"{name}: {num_chats / elapsed:,.1f} chats/s, "
+            f"{num_tokens / elapsed:,.0f} tokens/s"
+        )
+    print(f"speedup: {results['incremental'] / results['single pass']:.2f}x")
+    print(f"speedup from dicts: {results['single pass'] / results['from dicts']:.2f}x")
+
+
+if __name__ == "__main__":
+    benchmark()  # pylint: disable=no-value-for-parameter
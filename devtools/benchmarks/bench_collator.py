@@ -0,0 +1,121 @@
+"""
+benchmark collating packed batches with the preallocated collator against the
+concatenate-and-pad multipack collators, and fetching them from the dataset with one
+Arrow take against decoding every sample
+
+    python devtools/benchmarks/bench_collator.py --tokenizer NousResearch/Meta-Llama-3-8B-Instruct --batch-max-len 65536
+"""
+import time
+from copy import deepcopy
+
+import click
+import numpy as np
+from datasets import Dataset
+from transformers import AutoTokenizer
+
+from axolotl.monkeypatch.data.batch_dataset_fetcher import fetch_packed_table
+from axolotl.utils.collators import (
+    BatchSamplerDataCollatorForSeq2Seq,
+    PreallocatedBatchSamplerDataCollatorForSeq2Seq,
+    V2BatchSamplerDataCollatorForSeq2Seq,
+)
+
+
+def packed_bins(rng: np.random.Generator, num_bins: int, batch_max_len: int, max_len):
+    bins = []
+    for _ in range(num_bins):
+        samples, total = [], 0
+        while True:
+            length = int(rng.integers(16, max_len + 1))
+            if total + length > batch_max_len:
+                break
+            total += length
+            samples.append(
+                {
+                    "input_ids": rng.integers(0, 32_000, length).tolist(),
+                    "attention_mask": [1] * length,
+                    "labels": rng.integers(0, 32_000, length).tolist(),
+                    "position_ids": list(range(length)),
+                    "length": length,
+                }
+            )
+        bins.append(samples)
+    return bins
+
+
+def ms_per_batch(collator, batches) -> float:
+    # collators modify features in place, so time them on copies
+    batches = deepcopy(batches)
+    start = time.perf_counter()
+    for batch in batches:
+        collator(batch)
+    return (time.perf_counter() - start) / len(batches) * 1000
+
+
+@click.command()
+@click.option("--tokenizer", "tokenizer_name", type=str, required=True)
+@click.option("--batch-max-len", type=int, default=65536)
+@click.option("--max-len", type=int, default=4096)
+@click.option("--micro-batch-size", type=int, default=1)
+@click.option("--num-batches", type=int, default=20)
+@click.option("--seed", type=int, default=42)
+def benchmark(
+    tokenizer_name, batch_max_len, max_len, micro_batch_size, num_batches, seed
+):
+    rng = np.random.default_rng(seed)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    batches = [
+        packed_bins(rng, micro_batch_size, batch_max_len, max_len)
+        for _ in range(num_batches)
+    ]
+    kwargs = {"padding": True, "pad_to_multiple_of": 64, "return_tensors": "pt"}
+
+    for name, reference, multipack_attn in [
+        ("V2BatchSampler", V2BatchSamplerDataCollatorForSeq2Seq, True),
+        ("BatchSampler", BatchSamplerDataCollatorForSeq2Seq, False),
+    ]:
+        before = ms_per_batch(reference(tokenizer, **kwargs), batches)
+        after = ms_per_batch(
+            PreallocatedBatchSamplerDataCollatorForSeq2Seq(
+                tokenizer, multipack_attn=multipack_attn, **kwargs
+            ),
+            batches,
+        )
+        print(
+            f"{name}: {before:.2f} ms/batch, preallocated {after:.2f} ms/batch "
+            f"({before / after:.2f}x)"
+        )
+
+    # fetch + collate the same bins from a dataset, as a DataLoader worker does
+    dataset = Dataset.from_list(
+        [sample for batch in batches for bin_ in batch for sample in bin_]
+    )
+    batched_indices, start = [], 0
+    for batch in batches:
+        batched_indices.append([])
+        for bin_ in batch:
+            batched_indices[-1].append(list(range(start, start + len(bin_))))
+            start += len(bin_)
+    collator = PreallocatedBatchSamplerDataCollatorForSeq2Seq(tokenizer, **kwargs)
+
+    start = time.perf_counter()
+    for batched_index in batched_indices:
+        collator([dataset.__getitems__(bin_) for bin_ in batched_index])
+    decoded = (time.perf_counter() - start) / num_batches * 1000
+    start = time.perf_counter()
+    for batched_index in batched_indices:
+        collator.collate_arrow(
+            fetch_packed_table(dataset, batched_index),
+            [len(bin_) for bin_ in batched_index],
+        )
+    arrow = (time.perf_counter() - start) / num_batches * 1000
+    print(
+        f"fetch + collate: decoded samples {decoded:.2f} ms/batch, "
+        f"arrow take {arrow:.2f} ms/batch ({decoded / arrow:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    benchmark()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,126 @@
+"""
+benchmark the vectorized cu_seqlens helpers used by multipack attention against the
+per-row loops they replaced, on CPU
+
+    python devtools/benchmarks/bench_cu_seqlens.py --batch-size 4 --seq-len 65536
+"""
+import time
+
+import click
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from axolotl.monkeypatch.utils import (
+    _compute_unpad_data,
+    get_cu_seqlens_from_pos_ids,
+    get_max_seqlen_in_batch,
+)
+from axolotl.utils.collators.batching import packed_cu_seqlens
+
+
+def per_row_unpad_data(attention_mask: torch.Tensor):
+    # previous implementation: one dense count column per sample number
+    max_num = int(torch.max(attention_mask).item())
+    counts = torch.zeros((attention_mask.shape[0], max_num), dtype=torch.int32)
+    for i in range(1, max_num + 1):
+        counts[:, i - 1] = torch.sum(attention_mask == i, dim=-1).to(dtype=torch.int32)
+    seqlens = counts.flatten()
+    seqlens = seqlens[torch.nonzero(seqlens).squeeze(-1)]
+    indices = torch.nonzero(attention_mask.flatten()).flatten()
+    cu_seqlens = F.pad(torch.cumsum(seqlens, dim=0, dtype=torch.int32), (1, 0))
+    return indices, cu_seqlens, seqlens.max().item()
+
+
+def per_row_cu_seqlens_from_pos_ids(position_ids: torch.Tensor):
+    # previous implementation: one pass and several host syncs per row
+    results, max_seq_lens = [], []
+    for row in position_ids:
+        padding_length = (row == 0).int().flip(dims=[0]).cumprod(dim=0).sum().item()
+        adjusted_row = row[:-padding_length] if padding_length else row.clone()
+        seq_starts = torch.cat([torch.tensor([True]), adjusted_row[1:] == 0])
+        start_indices = torch.cat(
+            [
+                torch.nonzero(seq_starts).unbind(dim=1)[0],
+                torch.tensor([len(adjusted_row)]),
+            ]
+        )
+        cu_seqlens = torch.cat(
+            [torch.tensor([0]), (start_indices[1:] - start_indices[:-1]).cumsum(0)]
+        )
+        if padding_length:
+            cu_seqlens = torch.cat([cu_seqlens, torch.tensor([len(row)])])
+        results.append(cu_seqlens)
+        max_seq_lens.append((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+    max_length = max(t.size(0) for t in results)
+    max_value = max(t.max() for t in results)
+    padded = [F.pad(t, (0, max_length - t.size(0)), value=max_value) for t in results]
+    return torch.stack(padded).to(dtype=torch.int32), torch.stack(max_seq_lens)
+
+
+def packed_batch(rng: np.random.Generator, batch_size, seq_len, min_len, max_len):
+    attention_mask = np.zeros((batch_size, seq_len), dtype=np.int64)
+    position_ids = np.zeros((batch_size, seq_len), dtype=np.int64)
+    for row in range(batch_size):
+        pos, num = 0, 1
+        while True:
+            length = int(rng.integers(min_len, max_len + 1))
+            if pos + length > seq_len:
+                break
+            attention_mask[row, pos : pos + length] = num
+            position_ids[row, pos : pos + length] = np.arange(length)
+            pos, num = pos + length, num + 1
+    return torch.from_numpy(attention_mask), torch.from_numpy(position_ids)
+
+
+def ms_per_call(fn, *args, repeats: int) -> float:
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+@click.command()
+@click.option("--batch-size", type=int, default=4)
+@click.option("--seq-len", type=int, default=65536)
+@click.option("--min-len", type=int, default=16)
+@click.option("--max-len", type=int, default=2048)
+@click.option("--repeats", type=int, default=20)
+@click.option("--seed", type=int, default=42)
+def benchmark(batch_size, seq_len, min_len, max_len, repeats, seed):
+    attention_mask, position_ids = packed_batch(
+        np.random.default_rng(seed), batch_size, seq_len, min_len, max_len
+    )
+    print(f"{int(attention_mask.max())} samples in the longest row")
+
+    for name, before, after, arg in [
+        ("unpad data", per_row_unpad_data, _compute_unpad_data, attention_mask),
+        (
+            "cu_seqlens from position_ids",
+            per_row_cu_seqlens_from_pos_ids,
+            get_cu_seqlens_from_pos_ids,
+            position_ids,
+        ),
+    ]:
+        before_ms = ms_per_call(before, arg, repeats=repeats)
+        after_ms = ms_per_call(after, arg, repeats=repeats)
+        print(
+            f"{name}: per-row {before_ms:.2f} ms, vectorized {after_ms:.2f} ms "
+            f"({before_ms / after_ms:.2f}x)"
+        )
+
+    max_seqlen_ms = ms_per_call(
+        get_max_seqlen_in_batch, attention_mask, repeats=repeats
+    )
+    collator_ms = ms_per_call(
+        packed_cu_seqlens, attention_mask.numpy(), repeats=repeats
+    )
+    print(
+        f"sample lengths: {max_seqlen_ms:.2f} ms, "
+        f"precomputed in the collator with numpy: {collator_ms:.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    benchmark()  # pylint: disable=no-value-for-parameter
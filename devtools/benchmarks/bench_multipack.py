@@ -0,0 +1,145 @@
+"""
+benchmark packing efficiency and wall time of group-wise multipack allocation against
+the sequential allocator it replaced
+
+    python devtools/benchmarks/bench_multipack.py --num-samples 1000000 --batch-max-len 16384
+
+set NUMBA_NUM_THREADS to control how many cores the group-wise allocator uses
+"""
+import time
+from typing import Any, List
+
+import click
+import numba
+import numpy as np
+
+from axolotl.utils.samplers.multipack import allocate_groups
+
+
+@numba.njit
+def ffd_check(a: np.ndarray, c: int, n: int):
+    # First-fit-decreasing bin packing
+    # Check if a[] could fit in n bins with capacity c
+    # https://en.wikipedia.org/wiki/First-fit-decreasing_bin_packing
+
+    a = np.sort(a)[::-1]
+    bins = np.full((n,), c, dtype=a.dtype)
+    for size in a:
+        not_found = True
+        for idx in range(n):
+            if bins[idx] >= size:
+                bins[idx] -= size
+                not_found = False
+                break
+
+        if not_found:
+            return False
+
+    return True
+
+
+@numba.njit
+def ffd_with_result(a: np.ndarray, c: int, start_index: int):
+    # First-fit-decreasing bin packing (with result return)
+
+    indices = np.argsort(a)[::-1]
+    a = a[indices]
+
+    bins: List[Any] = []
+    bins_result: List[Any] = []
+    for a_id, size in enumerate(a):
+        add_new = True
+        for idx in range(len(bins)):  # pylint: disable=consider-using-enumerate
+            if bins[idx] >= size:
+                bins[idx] -= size
+                bins_result[idx].append(indices[a_id] + start_index)
+                add_new = False
+                break
+
+        if add_new:
+            bins.append(c - size)
+            bins_result.append([indices[a_id] + start_index])
+
+    return bins_result
+
+
+@numba.njit
+def allocate(
+    lengths: np.ndarray, lengths_cumsum: np.ndarray, rank: int, c: int, n: int
+):
+    # Dynamic batch allocator, similar to Multifit
+    # https://en.wikipedia.org/wiki/Multifit_algorithm
+    # ~99.5% efficiency on OpenChat training set (12 * 2048 ctx len)
+
+    s = 0
+    start_index = 0
+    result = []
+
+    while True:
+        # binary search [l, r)
+        left = 1
+        right = 1 + np.searchsorted(lengths_cumsum[start_index:], s + c * n, "right")
+
+        while right - left > 1:
+            mid = (left + right) // 2
+            if ffd_check(lengths[start_index : start_index + mid], c, n):
+                left = mid
+            else:
+                right = mid
+
+        # use length l
+        batch = ffd_with_result(
+            lengths[start_index : start_index + left], c, start_index
+        )
+        assert len(batch) <= n
+        if len(batch) < n:
+            break
+
+        start_index += left
+        s = lengths_cumsum[start_index - 1]
+
+        # add local rank
+        result.append(batch[rank])
+
+    return result, s, len(result) * c * n
+
+
+@click.command()
+@click.option("--num-samples", type=int, default=1_000_000)
+@click.option("--batch-max-len", type=int, default=8192)
+@click.option("--min-len", type=int, default=16)
+@click.option("--max-len", type=int, default=4096)
+@click.option("--group-size", type=int, default=100_000)
+@click.option("--bin-size", type=int, default=200)
+@click.option("--seed", type=int, default=42)
+def benchmark(num_samples, batch_max_len, min_len, max_len, group_size, bin_size, seed):
+    lengths = np.random.default_rng(seed).integers(
+        min_len, min(max_len, batch_max_len) + 1, num_samples
+    )
+    total_tokens = lengths.sum()
+
+    # compile both allocators before timing
+    allocate(lengths[:100], np.cumsum(lengths[:100]), 0, batch_max_len, 1)
+    allocate_groups(lengths[:100], batch_max_len, group_size, bin_size)
+
+    start = time.perf_counter()
+    _, total_used, total_slots = allocate(
+        lengths, np.cumsum(lengths), 0, batch_max_len, 1
+    )
+    sequential_time = time.perf_counter() - start
+    print(
+        f"sequential: {sequential_time:.2f}s, efficiency {total_used / total_slots:.4f}"
+    )
+
+    start = time.perf_counter()
+    offsets, _ = allocate_groups(lengths, batch_max_len, group_size, bin_size)
+    grouped_time = time.perf_counter() - start
+    efficiency = total_tokens / ((len(offsets) - 1) * batch_max_len)
+    print(
+        f"group-wise ({numba.get_num_threads()} threads): {grouped_time:.2f}s, "
+        f"efficiency {efficiency:.4f}"
+    )
+
+
+if __name__ == "__main__":
+    benchmark()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,130 @@
+"""
+benchmark tokenization throughput of the batched prompt strategy path against per-row mapping
+
+    python devtools/benchmarks/bench_tokenization.py --tokenizer NousResearch/Meta-Llama-3-8B-Instruct
+"""
+import random
+import time
+
+import click
+from datasets import Dataset
+from transformers import AutoTokenizer
+
+from axolotl.prompt_strategies.chat_template import (
+    ChatTemplatePrompter,
+    ChatTemplateStrategy,
+)
+from axolotl.prompt_tokenizers import AlpacaPromptTokenizingStrategy
+from axolotl.prompters import AlpacaPrompter
+from axolotl.utils.chat_templates import get_chat_template
+
+WORDS = "the quick brown fox jumps over a lazy dog while axolotls swim in lakes".split()
+
+
+def random_text(rng: random.Random, num_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def alpaca_rows(rng: random.Random, num_rows: int) -> Dataset:
+    return Dataset.from_list(
+        [
+            {
+                "instruction": random_text(rng, rng.randint(8, 64)),
+                "input": random_text(rng, rng.randint(0, 32)),
+                "output": random_text(rng, rng.randint(16, 256)),
+            }
+            for _ in range(num_rows)
+        ]
+    )
+
+
+def chat_rows(rng: random.Random, num_rows: int, num_turns: int) -> Dataset:
+    return Dataset.from_list(
+        [
+            {
+                "messages": [
+                    {
+                        "role": "user" if turn % 2 == 0 else "assistant",
+                        "content": random_text(rng, rng.randint(8, 128)),
+                    }
+                    for turn in range(num_turns)
+                ]
+            }
+            for _ in range(num_rows)
+        ]
+    )
+
+
+def rows_per_sec(strategy, dataset: Dataset, batched: bool) -> float:
+    if batched:
+        map_kwargs = {
+            "function": strategy.tokenize_prompt_batched,
+            "batched": True,
+            "batch_size": 1000,
+        }
+    else:
+        map_kwargs = {"function": strategy.tokenize_prompt}
+    start = time.perf_counter()
+    dataset.map(
+        remove_columns=dataset.column_names,
+        keep_in_memory=True,
+        load_from_cache_file=False,
+        desc=f"{type(strategy).__name__} batched={batched}",
+        **map_kwargs,
+    )
+    return len(dataset) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--tokenizer", "tokenizer_name", type=str, required=True)
+@click.option("--chat-template", type=str, default="chatml")
+@click.option("--num-rows", type=int, default=10_000)
+@click.option("--num-turns", type=int, default=8)
+@click.option("--seed", type=int, default=42)
+def benchmark(tokenizer_name, chat_template, num_rows, num_turns, seed):
+    rng = random.Random(seed)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    strategies = {
+        "alpaca": (
+            AlpacaPromptTokenizingStrategy(AlpacaPrompter(), tokenizer, False, 2048),
+            alpaca_rows(rng, num_rows),
+        ),
+        "chat_template (last turn)": (
+            ChatTemplateStrategy(
+                ChatTemplatePrompter(
+                    tokenizer, chat_template=get_chat_template(chat_template)
+                ),
+                tokenizer,
+                False,
+                8192,
+            ),
+            chat_rows(rng, num_rows, num_turns),
+        ),
+        "chat_template (single pass turns)": (
+            ChatTemplateStrategy(
+                ChatTemplatePrompter(
+                    tokenizer, chat_template=get_chat_template(chat_template)
+                ),
+                tokenizer,
+                False,
+                8192,
+                roles_to_train=["assistant"],
+                train_on_eos="turn",
+                single_pass_turns=True,
+            ),
+            chat_rows(rng, num_rows, num_turns),
+        ),
+    }
+
+    for name, (strategy, dataset) in strategies.items():
+        per_row = rows_per_sec(strategy, dataset, batched=False)
+        batched = rows_per_sec(strategy, dataset, batched=True)
+        print(
+            f"{name}: per-row {per_row:,.0f} rows/s, batched {batched:,.0f} rows/s "
+            f"({batched / per_row:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    benchmark()  # pylint: disable=no-value-for-parameter
@@ -8,6 +8,7 @@ import os
 import random
 import sys
 import tempfile
+import time
 from pathlib import Path
 from threading import Thread
 from typing import Any, Dict, List, Optional, Union
@@ -20,7 +21,7 @@ import yaml
 # add src to the pythonpath so we don't need to pip install this
 from accelerate.commands.config import config_args
 from art import text2art
-from huggingface_hub import HfApi
+from huggingface_hub import HfApi, snapshot_download
 from huggingface_hub.utils import LocalTokenNotFoundError
 from transformers import GenerationConfig, TextIteratorStreamer, TextStreamer
 from transformers.utils import is_torch_bf16_gpu_available
@@ -41,8 +42,11 @@ from axolotl.utils.config import (
     validate_config,
 )
 from axolotl.utils.data import load_prepare_dpo_datasets, prepare_dataset
+from axolotl.utils.data.reference_logps import attach_reference_logps
 from axolotl.utils.dict import DictDefault
 from axolotl.utils.distributed import is_main_process
+from axolotl.utils.generation import iter_generate_batched
+from axolotl.utils.lora_merge import merge_lora_sharded
 from axolotl.utils.mlflow_ import setup_mlflow_env_vars
 from axolotl.utils.models import load_processor, load_tokenizer
 from axolotl.utils.tokenization import check_dataset_labels
@@ -165,6 +169,10 @@ def do_merge_lora(
     cfg: DictDefault,
     cli_args: TrainerCliArgs,
 ):
+    if cfg.merge_lora_streaming:
+        do_merge_lora_streaming(cfg=cfg)
+        return
+
     model, tokenizer = load_model_and_tokenizer(cfg=cfg, cli_args=cli_args)
     safe_serialization = cfg.save_safetensors is True
 
@@ -186,6 +194,33 @@ def do_merge_lora(
         tokenizer.save_pretrained(str(Path(cfg.output_dir) / "merged"))
 
 
+def do_merge_lora_streaming(*, cfg: DictDefault):
+    """
+    Merge the LoRA adapter into the base model's safetensors shards one at a time on CPU,
+    instead of loading the whole model.
+    """
+    base_dir = Path(cfg.base_model)
+    if not base_dir.is_dir():
+        base_dir = Path(
+            snapshot_download(
+                cfg.base_model,
+                allow_patterns=["*.json", "*.safetensors", "*.model", "*.txt"],
+            )
+        )
+    output_dir = Path(cfg.output_dir) / "merged"
+
+    if cfg.local_rank == 0:
+        LOG.info(f"streaming merge of LoRA with base model to: {str(output_dir)}")
+        merge_lora_sharded(
+            base_dir,
+            cfg.lora_model_dir,
+            output_dir,
+            torch_dtype=cfg.torch_dtype,
+            num_workers=cfg.merge_lora_num_workers or 1,
+        )
+        load_tokenizer(cfg).save_pretrained(str(output_dir))
+
+
 def do_inference(
     *,
     cfg: DictDefault,
@@ -270,6 +305,111 @@ def do_inference(
         print(tokenizer.decode(generated["sequences"].cpu().tolist()[0]))
 
 
+def do_inference_batch(
+    *,
+    cfg: DictDefault,
+    cli_args: TrainerCliArgs,
+    input_path: Union[str, Path],
+    output_path: Union[str, Path],
+):
+    """
+    Greedily generate a completion for every record of a JSONL file, in length buckets under
+    a token budget, writing each record with its completion as soon as its bucket is done.
+
+    Records hold either a `prompt` string, formatted with the prompter or chat template
+    like interactive inference, or a list of chat `messages`.
+    """
+    model, tokenizer = load_model_and_tokenizer(cfg=cfg, cli_args=cli_args)
+    prompter = cli_args.prompter
+
+    prompter_module = None
+    chat_template_str = None
+    if prompter:
+        prompter_module = getattr(
+            importlib.import_module("axolotl.prompters"), prompter
+        )
+    elif cfg.chat_template:
+        chat_template_str = get_chat_template(cfg.chat_template)
+    elif cfg.datasets and cfg.datasets[0].type == "chat_template":
+        chat_template_str = get_chat_template_from_config(
+            cfg=cfg, ds_cfg=cfg.datasets[0], tokenizer=tokenizer
+        )
+
+    def tokenize_record(record: Dict[str, Any]) -> List[int]:
+        if "messages" in record:
+            return tokenizer.apply_chat_template(
+                record["messages"],
+                add_generation_prompt=True,
+                chat_template=chat_template_str,
+                tokenize=True,
+            )
+
+        prompt = record["prompt"]
+        if prompter_module:
+            # pylint: disable=stop-iteration-return
+            prompt = next(
+                prompter_module().build_prompt(instruction=prompt.strip("\n"))
+            )
+        if chat_template_str:
+            return tokenizer.apply_chat_template(
+                [{"role": "user", "content": prompt}],
+                add_generation_prompt=True,
+                chat_template=chat_template_str,
+                tokenize=True,
+            )
+        return tokenizer(prompt, add_special_tokens=True)["input_ids"]
+
+    with open(input_path, encoding="utf-8") as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    prompts = [tokenize_record(record) for record in records]
+
+    pad_token_id = (
+        tokenizer.pad_token_id
+        if tokenizer.pad_token_id is not None
+        else tokenizer.eos_token_id
+    )
+    generation_config = GenerationConfig(
+        max_new_tokens=cfg.inference_max_new_tokens or 1024,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=pad_token_id,
+        do_sample=False,
+        use_cache=True,
+    )
+    max_tokens = cfg.inference_max_tokens or 32768
+
+    model = model.to(cfg.device, dtype=cfg.torch_dtype)
+    model.eval()
+
+    LOG.info(f"Generating completions for {len(records)} prompts from {input_path}")
+    num_tokens = 0
+    start = time.perf_counter()
+    with open(output_path, "w", encoding="utf-8") as file:
+        for bucket, generated in iter_generate_batched(
+            model,
+            prompts,
+            generation_config,
+            pad_token_id=pad_token_id,
+            max_tokens=max_tokens,
+            device=cfg.device,
+        ):
+            for idx, tokens in zip(bucket, generated):
+                result = {
+                    **records[idx],
+                    "index": idx,
+                    "completion": tokenizer.decode(tokens, skip_special_tokens=True),
+                    "num_tokens": len(tokens),
+                }
+                file.write(json.dumps(result) + "\n")
+                num_tokens += len(tokens)
+            file.flush()
+    elapsed = time.perf_counter() - start
+    LOG.info(
+        f"Generated {num_tokens} tokens in {elapsed:.1f}s "
+        f"({num_tokens / elapsed:.1f} tokens/sec), wrote {output_path}"
+    )
+
+
 def do_inference_gradio(
     *,
     cfg: DictDefault,
@@ -513,6 +653,10 @@ def load_rl_datasets(
     cli_args: TrainerCliArgs,  # pylint: disable=unused-argument
 ) -> TrainDatasetMeta:
     train_dataset, eval_dataset = load_prepare_dpo_datasets(cfg)
+    if cfg.precompute_reference_logps and not cfg.is_preprocess:
+        train_dataset, eval_dataset = attach_reference_logps(
+            cfg, train_dataset, eval_dataset, load_tokenizer(cfg)
+        )
     total_num_steps = int(
         math.ceil(len(train_dataset) * cfg.num_epochs / cfg.batch_size)
     )
@@ -0,0 +1,44 @@
+"""
+CLI to evict stale prepared datasets from the dataset_prepared_path
+"""
+import logging
+from pathlib import Path
+from typing import Optional, Union
+
+import fire
+import yaml
+from dotenv import load_dotenv
+
+from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH
+from axolotl.utils.data.cache import evict_prepared_datasets
+from axolotl.utils.dict import DictDefault
+
+LOG = logging.getLogger("axolotl.cli.evict_prepared")
+
+
+def do_cli(
+    config: Union[Path, str] = Path("examples/"),
+    max_age_days: Optional[float] = None,
+    max_size_gb: Optional[float] = None,
+    dry_run: bool = False,
+):
+    # only the prepared path is needed, so skip full config validation
+    with open(config, encoding="utf-8") as file:
+        cfg = DictDefault(yaml.safe_load(file))
+
+    prepared_path = Path(cfg.dataset_prepared_path or DEFAULT_DATASET_PREPARED_PATH)
+    if not prepared_path.is_dir():
+        LOG.warning(f"No prepared datasets found at {prepared_path}")
+        return []
+
+    return evict_prepared_datasets(
+        prepared_path,
+        max_age_days=max_age_days,
+        max_size_gb=max_size_gb,
+        dry_run=dry_run,
+    )
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    fire.Fire(do_cli)
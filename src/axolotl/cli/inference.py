@@ -2,7 +2,7 @@
 CLI to run inference on a trained model
 """
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 import fire
 import transformers
@@ -10,6 +10,7 @@ from dotenv import load_dotenv
 
 from axolotl.cli import (
     do_inference,
+    do_inference_batch,
     do_inference_gradio,
     load_cfg,
     print_axolotl_text_art,
@@ -17,7 +18,13 @@ from axolotl.cli import (
 from axolotl.common.cli import TrainerCliArgs
 
 
-def do_cli(config: Union[Path, str] = Path("examples/"), gradio=False, **kwargs):
+def do_cli(
+    config: Union[Path, str] = Path("examples/"),
+    gradio=False,
+    input_path: Optional[str] = None,
+    output_path: Optional[str] = None,
+    **kwargs,
+):
     # pylint: disable=duplicate-code
     print_axolotl_text_art()
     parsed_cfg = load_cfg(config, inference=True, **kwargs)
@@ -28,7 +35,14 @@ def do_cli(config: Union[Path, str] = Path("examples/"), gradio=False, **kwargs)
     )
     parsed_cli_args.inference = True
 
-    if gradio:
+    if input_path:
+        do_inference_batch(
+            cfg=parsed_cfg,
+            cli_args=parsed_cli_args,
+            input_path=input_path,
+            output_path=output_path,
+        )
+    elif gradio:
         do_inference_gradio(cfg=parsed_cfg, cli_args=parsed_cli_args)
     else:
         do_inference(cfg=parsed_cfg, cli_args=parsed_cli_args)
@@ -107,6 +107,18 @@ def evaluate(config: str, accelerate: bool, **kwargs):
     help="Path to base model for non-LoRA models",
 )
 @click.option("--gradio", is_flag=True, help="Launch Gradio interface")
+@click.option(
+    "--input",
+    "input_path",
+    type=click.Path(exists=True, dir_okay=False, path_type=str),
+    help="JSONL file of prompts to generate completions for in batches",
+)
+@click.option(
+    "--output",
+    "output_path",
+    type=click.Path(dir_okay=False, path_type=str),
+    help="JSONL file to write the completions of --input to",
+)
 @click.option("--load-in-8bit", is_flag=True, help="Load model in 8-bit mode")
 @add_options_from_dataclass(TrainerCliArgs)
 @add_options_from_config(AxolotlInputConfig)
@@ -115,9 +127,14 @@ def inference(
     accelerate: bool,
     lora_model_dir: Optional[str] = None,
     base_model: Optional[str] = None,
+    input_path: Optional[str] = None,
+    output_path: Optional[str] = None,
     **kwargs,
 ):
     """Run inference with a trained model."""
+    if bool(input_path) != bool(output_path):
+        raise click.UsageError("--input and --output must be passed together")
+
     kwargs = {k: v for k, v in kwargs.items() if v is not None}
     del kwargs["inference"]  # interferes with inference.do_cli
 
@@ -125,6 +142,9 @@ def inference(
         kwargs["lora_model_dir"] = lora_model_dir
     if base_model:
         kwargs["base_model"] = base_model
+    if input_path:
+        kwargs["input_path"] = input_path
+        kwargs["output_path"] = output_path
 
     if accelerate:
         base_cmd = ["accelerate", "launch", "-m", "axolotl.cli.inference"]
@@ -240,6 +260,36 @@ def merge_lora(
     do_cli(config=config, **kwargs)
 
 
+@cli.command()
+@click.argument("config", type=click.Path(exists=True, path_type=str))
+@click.option(
+    "--max-age-days",
+    type=float,
+    help="Evict prepared datasets not used within this many days",
+)
+@click.option(
+    "--max-size-gb",
+    type=float,
+    help="Evict least recently used prepared datasets until under this size",
+)
+@click.option("--dry-run", is_flag=True, help="Only report what would be evicted")
+def evict_prepared(
+    config: str,
+    max_age_days: Optional[float] = None,
+    max_size_gb: Optional[float] = None,
+    dry_run: bool = False,
+):
+    """Evict stale prepared datasets from the dataset_prepared_path."""
+    from axolotl.cli.evict_prepared import do_cli
+
+    do_cli(
+        config=config,
+        max_age_days=max_age_days,
+        max_size_gb=max_size_gb,
+        dry_run=dry_run,
+    )
+
+
 @cli.command()
 @click.argument("directory", type=click.Choice(["examples", "deepspeed_configs"]))
 @click.option("--dest", help="Destination directory")
@@ -5,8 +5,9 @@ import json
 import logging
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, List, Tuple, Union
 
 import fire
 import torch
@@ -23,7 +24,8 @@ from accelerate.utils import (
 from dotenv import load_dotenv
 from huggingface_hub import split_torch_state_dict_into_shards
 from safetensors.torch import save_file as safe_save_file
-from torch.distributed.checkpoint.format_utils import _EmptyStateDictLoadPlanner
+from torch.distributed.checkpoint.default_planner import DefaultLoadPlanner
+from torch.distributed.checkpoint.metadata import TensorStorageMetadata
 
 from axolotl.cli import load_cfg, print_axolotl_text_art
 from axolotl.common.cli import TrainerCliArgs
@@ -31,45 +33,103 @@ from axolotl.common.cli import TrainerCliArgs
 LOG = logging.getLogger("axolotl.cli.merge_sharded_fsdp_weights")
 
 
-class BFloat16CastPlanner(_EmptyStateDictLoadPlanner):
+def _plan_merged_shards(
+    metadata: dist_cp.Metadata,
+) -> Tuple[Dict[str, str], Dict[str, torch.Tensor]]:
     """
-    A custom planner to cast tensors to bfloat16 on the fly during loading.
+    Map each tensor name of the merged weights to its fqn in the DCP checkpoint, along with
+    a meta tensor of its merged shape and dtype, without reading any tensor data.
     """
+    planner_data = metadata.planner_data or {}
+    paths = {
+        fqn: tuple(planner_data.get(fqn, (fqn,)))
+        for fqn, item in metadata.state_dict_metadata.items()
+        if isinstance(item, TensorStorageMetadata)
+    }
 
-    def commit_tensor(self, read_item, tensor):  # pylint: disable=unused-argument
-        tensor.copy_(tensor.to(torch.bfloat16))
+    # To handle if state is a dict like {model: {...}}
+    fqns = {fqn: fqn for fqn in paths}
+    if len({path[0] for path in paths.values()}) == 1 and all(
+        len(path) > 1 for path in paths.values()
+    ):
+        fqns = {".".join(path[1:]): fqn for fqn, path in paths.items()}
+
+    meta_tensors = {}
+    for name, fqn in fqns.items():
+        properties = metadata.state_dict_metadata[fqn].properties
+        meta_tensors[name] = torch.empty(
+            metadata.state_dict_metadata[fqn].size,
+            dtype=(
+                torch.bfloat16
+                if properties.dtype.is_floating_point
+                else properties.dtype
+            ),
+            device="meta",
+        )
+    return fqns, meta_tensors
 
 
-def _distributed_checkpoint_to_merged_weights(
+def _merge_shard(
     checkpoint_dir: Union[str, Path],
-    save_path: str,
-    safe_serialization: bool = False,
-    max_shard_size: str = "5GB",
+    shard_path: str,
+    tensors: List[Tuple[str, Tuple[str, ...], torch.Size, torch.dtype]],
+    safe_serialization: bool,
 ):
     """
-    Passthrough to `torch.distributed.checkpoint.format_utils.dcp_to_torch_save`
-
-    Will save under `save_path` as either `model.safetensors` or `pytorch_model.bin`.
+    Load only the tensors of one merged shard from the DCP checkpoint, cast them to
+    bfloat16 and write the shard.
     """
-
     state_dict: Dict = {}
-    save_path_ = Path(save_path)
-    save_path_.mkdir(exist_ok=True)
+    for _, path, size, dtype in tensors:
+        # nest each tensor the way it was saved, so the load planner finds its fqn
+        parent = state_dict
+        for key in path[:-1]:
+            parent = parent.setdefault(key, {})
+        parent[path[-1]] = torch.empty(size, dtype=dtype)
     dist_cp_format_utils._load_state_dict(  # pylint: disable=protected-access
         state_dict,
         storage_reader=dist_cp.FileSystemReader(checkpoint_dir),
-        planner=BFloat16CastPlanner(),  # pylint: disable=protected-access
+        planner=DefaultLoadPlanner(),
         no_dist=True,
     )
 
-    # To handle if state is a dict like {model: {...}}
-    if len(state_dict.keys()) == 1:
-        state_dict = state_dict[list(state_dict)[0]]
+    shard = {}
+    for name, path, _, _ in tensors:
+        tensor = state_dict
+        for key in path:
+            tensor = tensor[key]
+        shard[name] = (
+            tensor.to(torch.bfloat16) if tensor.is_floating_point() else tensor
+        )
+    del state_dict
+
+    if safe_serialization:
+        safe_save_file(shard, shard_path, metadata={"format": "pt"})
+    else:
+        torch.save(shard, shard_path)
+
+
+def _distributed_checkpoint_to_merged_weights(
+    checkpoint_dir: Union[str, Path],
+    save_path: str,
+    safe_serialization: bool = False,
+    max_shard_size: str = "5GB",
+    num_workers: int = 1,
+):
+    """
+    Merge a DCP checkpoint into bfloat16 weights saved under `save_path` as either
+    `model.safetensors` or `pytorch_model.bin`, sharded by `max_shard_size`.
 
-    # Ensure all tensors are in bfloat16
-    for key, value in state_dict.items():
-        if isinstance(value, torch.Tensor) and value.dtype != torch.bfloat16:
-            state_dict[key] = value.to(torch.bfloat16)
+    Output shards are planned from the checkpoint metadata, then each one is loaded, cast
+    and written on its own, in `num_workers` processes, so peak memory stays near
+    `num_workers * max_shard_size` instead of the whole model.
+    """
+
+    save_path_ = Path(save_path)
+    save_path_.mkdir(exist_ok=True)
+    metadata = dist_cp.FileSystemReader(checkpoint_dir).read_metadata()
+    fqns, meta_tensors = _plan_merged_shards(metadata)
+    planner_data = metadata.planner_data or {}
 
     weights_name = SAFE_WEIGHTS_NAME if safe_serialization else WEIGHTS_NAME
 
@@ -77,7 +137,7 @@ def _distributed_checkpoint_to_merged_weights(
         ".safetensors", "{suffix}.safetensors"
     )
     state_dict_split = split_torch_state_dict_into_shards(
-        state_dict, filename_pattern=filename_pattern, max_shard_size=max_shard_size
+        meta_tensors, filename_pattern=filename_pattern, max_shard_size=max_shard_size
     )
     # Save index if sharded
     index = None
@@ -87,18 +147,33 @@ def _distributed_checkpoint_to_merged_weights(
             "weight_map": state_dict_split.tensor_to_filename,
         }
 
-    # Save the model
-    filename_to_tensors = state_dict_split.filename_to_tensors.items()
-
-    for shard_file, tensors in filename_to_tensors:
-        shard = {tensor: state_dict[tensor] for tensor in tensors}
-
-        if safe_serialization:
-            safe_save_file(
-                shard, os.path.join(save_path_, shard_file), metadata={"format": "pt"}
+    # Save the model, one shard at a time
+    shard_args = []
+    for shard_file, names in state_dict_split.filename_to_tensors.items():
+        tensors = [
+            (
+                name,
+                tuple(planner_data.get(fqns[name], (fqns[name],))),
+                meta_tensors[name].shape,
+                metadata.state_dict_metadata[fqns[name]].properties.dtype,
+            )
+            for name in names
+        ]
+        shard_args.append(
+            (
+                checkpoint_dir,
+                os.path.join(save_path_, shard_file),
+                tensors,
+                safe_serialization,
             )
-        else:
-            torch.save(shard, os.path.join(save_path_, shard_file))
+        )
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for future in [executor.submit(_merge_shard, *args) for args in shard_args]:
+                future.result()
+    else:
+        for args in shard_args:
+            _merge_shard(*args)
 
     if index is not None:
         save_index_file = (
@@ -118,6 +193,7 @@ def merge_fsdp_weights(
     output_path: str,
     safe_serialization: bool = False,
     remove_checkpoint_dir: bool = False,
+    num_workers: int = 1,
 ):
     """
     Merge the weights from sharded FSDP model checkpoints into a single combined checkpoint. Should be used if
@@ -135,6 +211,8 @@ def merge_fsdp_weights(
             Whether to save the merged weights with safetensors (recommended).
         remove_checkpoint_dir (`bool`, *optional*, defaults to `False`):
             Whether to remove the checkpoint directory after merging.
+        num_workers (`int`, *optional*, defaults to `1`):
+            The number of processes merging output shards concurrently.
     """
     checkpoint_dir_ = Path(checkpoint_dir)
     from accelerate.state import PartialState
@@ -168,7 +246,10 @@ def merge_fsdp_weights(
     if state.is_main_process:
         LOG.info(f"Merging FSDP weights from {checkpoint_dir_}")
         save_path = _distributed_checkpoint_to_merged_weights(
-            checkpoint_dir_, output_path, safe_serialization
+            checkpoint_dir_,
+            output_path,
+            safe_serialization,
+            num_workers=num_workers,
         )
         LOG.info(f"Successfully merged FSDP weights and saved to {save_path}")
         if remove_checkpoint_dir:
@@ -196,6 +277,7 @@ def do_cli(config: Union[Path, str] = Path("examples/"), **kwargs):
         checkpoint_dir=str(fsdp_dir),
         output_path=str(Path(parsed_cfg.output_dir) / "merged"),
         safe_serialization=True,
+        num_workers=parsed_cfg.fsdp_merge_num_workers or 1,
     )
 
 
@@ -23,6 +23,7 @@ from axolotl.cli import (
 )
 from axolotl.common.cli import PreprocessCliArgs
 from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH
+from axolotl.utils.data.reference_logps import precompute_reference_logps
 from axolotl.utils.trainer import disable_datasets_caching
 
 LOG = logging.getLogger("axolotl.cli.preprocess")
@@ -52,7 +53,11 @@ def do_cli(config: Union[Path, str] = Path("examples/"), **kwargs):
 
     with disable_datasets_caching():
         if parsed_cfg.rl:  # and parsed_cfg.rl != "orpo":
-            load_rl_datasets(cfg=parsed_cfg, cli_args=parsed_cli_args)
+            dataset_meta = load_rl_datasets(cfg=parsed_cfg, cli_args=parsed_cli_args)
+            if parsed_cfg.precompute_reference_logps:
+                precompute_reference_logps(
+                    parsed_cfg, dataset_meta.train_dataset, dataset_meta.eval_dataset
+                )
         else:
             load_datasets(cfg=parsed_cfg, cli_args=parsed_cli_args)
 
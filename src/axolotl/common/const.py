@@ -3,3 +3,17 @@ Various shared constants
 """
 
 DEFAULT_DATASET_PREPARED_PATH = "last_run_prepared"
+PACKING_PLANS_DIR = "packing_plans"
+
+# columns of KTO datasets pre-tokenized with `rl_pretokenize`, as the trl KTOTrainer tokenizes them
+KTO_TOKENIZED_COLUMNS = [
+    "prompt_input_ids",
+    "prompt_attention_mask",
+    "answer_input_ids",
+    "answer_attention_mask",
+]
+
+# reference model log-probs of the chosen and rejected completions, as precomputed by trl
+DPO_REFERENCE_LOGPS_COLUMNS = ["ref_chosen_logps", "ref_rejected_logps"]
+# reference model log-probs of the kto completions and of the mismatched KL completions
+KTO_REFERENCE_LOGPS_COLUMNS = ["reference_logps", "reference_KL_logps"]
@@ -4,7 +4,7 @@ ChatML transformation functions for MessageContents
 from typing import Optional
 
 from ..messages import MessageContents, Messages
-from .shared import wrap_tools
+from .shared import wrap_tool_dicts, wrap_tools
 
 
 def format_message(
@@ -32,3 +32,27 @@ def format_message(
 
     message.is_chat_formatted = True
     return message
+
+
+def format_message_dict(
+    message: dict,
+    message_index: Optional[int] = None,  # pylint: disable=unused-argument
+) -> dict:
+    """
+    format_message for a message given as a dict, without validating it into Messages
+    """
+    if message.get("is_chat_formatted"):
+        return message
+
+    weight = message.get("weight")
+    contents = [
+        {"type": "text", "value": f"<|im_start|>{message['role']}\n", "weight": 0},
+        *message["content"],
+        {"type": "text", "value": "<|im_end|>", "weight": weight},
+        {"type": "text", "value": "\n", "weight": 0},
+    ]
+    return {
+        **message,
+        "content": wrap_tool_dicts(contents, weight),
+        "is_chat_formatted": True,
+    }
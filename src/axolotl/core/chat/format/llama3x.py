@@ -4,7 +4,7 @@ Llama 3.x chat formatting functions for MessageContents
 from typing import Optional
 
 from ..messages import MessageContents, Messages
-from .shared import wrap_tools
+from .shared import wrap_tool_dicts, wrap_tools
 
 
 def format_message(message: Messages, message_index: Optional[int] = None) -> Messages:
@@ -43,3 +43,32 @@ def format_message(message: Messages, message_index: Optional[int] = None) -> Me
 
     message.is_chat_formatted = True
     return message
+
+
+def format_message_dict(message: dict, message_index: Optional[int] = None) -> dict:
+    """
+    format_message for a message given as a dict, without validating it into Messages
+    """
+    if message.get("is_chat_formatted"):
+        return message
+
+    message_role = message["role"]
+    if message_role == "tool":
+        message_role = "ipython"
+
+    weight = message.get("weight")
+    contents = [
+        {
+            "type": "text",
+            "value": f"<|start_header_id|>{message_role}<|end_header_id|>\n\n",
+            "weight": 0,
+        },
+        *message["content"],
+        {"type": "text", "value": "<|eot_id|>", "weight": weight},
+    ]
+    contents = wrap_tool_dicts(contents, weight)
+
+    if message_index == 0:
+        contents.insert(0, {"type": "text", "value": "<|begin_of_text|>", "weight": 0})
+
+    return {**message, "content": contents, "is_chat_formatted": True}
@@ -1,6 +1,8 @@
 """
 shared functions for format transforms
 """
+from typing import List
+
 from axolotl.core.chat.messages import MessageContents, Messages
 
 
@@ -45,3 +47,24 @@ def wrap_tools(message: Messages):
             )
 
     return message
+
+
+def wrap_tool_dicts(contents: List[dict], weight) -> List[dict]:
+    """
+    wrap_tools for contents given as dicts, with the weight of their message
+    """
+    wrapped = []
+    for content in contents:
+        if content["type"] in ["tool_call", "tool_response"]:
+            tag = "tool_call" if content["type"] == "tool_call" else "tool_response"
+            wrapped.extend(
+                [
+                    {"type": "text", "value": f"<{tag}>\n", "weight": weight},
+                    # make sure the actual tool content ends with a newline
+                    {**content, "has_newline": True},
+                    {"type": "text", "value": f"</{tag}>\n", "weight": weight},
+                ]
+            )
+        else:
+            wrapped.append(content)
+    return wrapped
@@ -3,8 +3,9 @@ internal message representations of chat messages
 """
 import json
 from enum import Enum
-from typing import Any, Callable, List, Optional, Union
+from typing import Any, Callable, List, Mapping, Optional, Tuple, Union
 
+import numpy as np
 from pydantic import BaseModel
 from transformers import PreTrainedTokenizer
 
@@ -37,6 +38,14 @@ class MessageContentTypes(str, Enum):
     tool_response = "tool_response"  # pylint: disable=invalid-name
 
 
+# content types whose text is tokenized
+TOKENIZED_CONTENT_TYPES = [
+    MessageContentTypes.text.value,
+    MessageContentTypes.tool_call.value,
+    MessageContentTypes.tool_response.value,
+]
+
+
 class SpecialToken(str, Enum):
     """
     Special tokens for beginning of string and end of string
@@ -130,40 +139,56 @@ class Messages(BaseModel):
     def __str__(self) -> str:
         return "".join(str(c) for c in self.content)
 
+    def segments(self) -> List[Tuple[str, bool]]:
+        """
+        The text of each tokenized content part, and whether it is trained on.
+        """
+        return [
+            (str(msg_content), bool(self.weight and msg_content.weight not in [0, 0.0]))
+            for msg_content in self.content
+            # TODO also handle non-text content types
+            if msg_content.type in TOKENIZED_CONTENT_TYPES
+        ]
+
     def tokenized(
         self, tokenizer: PreTrainedTokenizer, ignore_index=-100
     ) -> dict[str, List[int]]:
-        # iterate over the contents, tokenizing the concatenated string values up to the current MessageContents
         # returns a dictionary mapping w input_ids, attention_mask, and labels
+        if tokenizer.is_fast:
+            return tokenize_segments(tokenizer, [self.segments()], ignore_index)[0]
+        return self.tokenized_incremental(tokenizer, ignore_index)
+
+    def tokenized_incremental(
+        self, tokenizer: PreTrainedTokenizer, ignore_index=-100
+    ) -> dict[str, List[int]]:
+        """
+        Tokenize for tokenizers without offset mappings, by re-tokenizing the concatenated
+        contents after each content part.
+        """
+        # iterate over the contents, tokenizing the concatenated string values up to the current MessageContents
         input_ids: List[int] = []
         labels: List[int] = []
         pending_input_ids: List[int] = []
-        pending_weight = self.weight
+        pending_weight: Any = self.weight
         running_content = ""
-        for _, msg_content in enumerate(self.content):
-            # TODO also handle non-text content types
-            if msg_content.type in [
-                MessageContentTypes.text.value,
-                MessageContentTypes.tool_call.value,
-                MessageContentTypes.tool_response.value,
-            ]:
-                running_content += str(msg_content)
-                tok_results = tokenizer(running_content, add_special_tokens=False)
-                tok_input_ids = tok_results["input_ids"]
-                if pending_input_ids:
-                    new_pending_inputs = tok_input_ids[
-                        len(input_ids) : len(input_ids) + len(pending_input_ids)
-                    ]
-                    if new_pending_inputs != pending_input_ids:
-                        # logging.warning("tokenization mismatch from concatenation.")
-                        pending_input_ids = new_pending_inputs
-                    input_ids.extend(pending_input_ids)
-                    if pending_weight:
-                        labels.extend(pending_input_ids)
-                    else:
-                        labels.extend([ignore_index] * len(pending_input_ids))
-                pending_input_ids = tok_results["input_ids"][len(input_ids) :]
-                pending_weight = self.weight and msg_content.weight not in [0, 0.0]
+        for text, trainable in self.segments():
+            running_content += text
+            tok_results = tokenizer(running_content, add_special_tokens=False)
+            tok_input_ids = tok_results["input_ids"]
+            if pending_input_ids:
+                new_pending_inputs = tok_input_ids[
+                    len(input_ids) : len(input_ids) + len(pending_input_ids)
+                ]
+                if new_pending_inputs != pending_input_ids:
+                    # logging.warning("tokenization mismatch from concatenation.")
+                    pending_input_ids = new_pending_inputs
+                input_ids.extend(pending_input_ids)
+                if pending_weight:
+                    labels.extend(pending_input_ids)
+                else:
+                    labels.extend([ignore_index] * len(pending_input_ids))
+            pending_input_ids = tok_results["input_ids"][len(input_ids) :]
+            pending_weight = trainable
         input_ids.extend(pending_input_ids)
         if pending_weight:
             labels.extend(pending_input_ids)
@@ -177,6 +202,123 @@ class Messages(BaseModel):
         }
 
 
+def _is_plain(value: Any, types: Tuple[type, ...]) -> bool:
+    # pydantic would coerce bools and str enums, so leave those to the models
+    return (
+        isinstance(value, types)
+        and not isinstance(value, bool)
+        and not isinstance(value, Enum)
+    )
+
+
+def _tool_contents_text(value: Mapping[str, Any]) -> Optional[str]:
+    if not _is_plain(value.get("name"), (str,)) or not (
+        value.get("id") is None or _is_plain(value["id"], (str,))
+    ):
+        return None
+    fields = set(value) - {"id"}
+    if fields == {"name", "arguments"}:
+        body = value["arguments"]
+        if not isinstance(body, dict) or not all(
+            _is_plain(key, (str,)) and _is_plain(val, (str, int))
+            for key, val in body.items()
+        ):
+            return None
+        data = {"name": value["name"], "arguments": body}
+    elif fields == {"name", "content"}:
+        body = value["content"]
+        if not _is_plain(body, (str,)) and not (
+            isinstance(body, dict)
+            and all(
+                _is_plain(key, (str,)) and _is_plain(val, (str, int, float))
+                for key, val in body.items()
+            )
+        ):
+            return None
+        data = {"name": value["name"], "content": body}
+    else:
+        return None
+    if value.get("id") is not None:
+        data["id"] = value["id"]
+    return json.dumps(data)
+
+
+def content_text(content: Mapping[str, Any]) -> Optional[str]:
+    """
+    The text of a content part given as a dict, like str() of its MessageContents, or None
+    when its value is anything but a plain string or tool call/response.
+    """
+    value = content["value"]
+    if _is_plain(value, (str,)):
+        str_val = value
+    elif isinstance(value, Mapping):
+        str_val = _tool_contents_text(value)
+        if str_val is None:
+            return None
+    else:
+        return None
+    if content.get("has_newline") and not str_val.endswith("\n"):
+        str_val += "\n"
+    return str_val
+
+
+def message_segments(message: Mapping[str, Any]) -> Optional[List[Tuple[str, bool]]]:
+    """
+    Messages.segments() of a message given as a dict, without validating it into the
+    models, or None when one of its contents needs them.
+    """
+    segments = []
+    for msg_content in message["content"]:
+        # TODO also handle non-text content types
+        if msg_content["type"] not in TOKENIZED_CONTENT_TYPES:
+            continue
+        text = content_text(msg_content)
+        if text is None:
+            return None
+        trainable = bool(
+            message.get("weight") and msg_content.get("weight") not in [0, 0.0]
+        )
+        segments.append((text, trainable))
+    return segments
+
+
+def tokenize_segments(
+    tokenizer: PreTrainedTokenizer,
+    messages: List[List[Tuple[str, bool]]],
+    ignore_index=-100,
+) -> List[dict[str, List[int]]]:
+    """
+    Tokenize each message's concatenated segments once, in a single batched call, and label
+    every token by the segment its first character falls in.
+
+    A token spanning a segment boundary belongs to the earlier segment, like it does when
+    re-tokenizing the running content after each segment.
+    """
+    encodings = tokenizer(
+        ["".join(text for text, _ in segments) for segments in messages],
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+    )
+    results = []
+    for segments, input_ids, offsets in zip(
+        messages, encodings["input_ids"], encodings["offset_mapping"]
+    ):
+        segment_ends = np.cumsum([len(text) for text, _ in segments])
+        trainable = np.array([train for _, train in segments] + [False], dtype=bool)
+        token_starts = np.array([start for start, _ in offsets], dtype=np.int64)
+        # segments with no text never own a token
+        token_segments = np.searchsorted(segment_ends, token_starts, side="right")
+        labels = np.where(trainable[token_segments], input_ids, ignore_index)
+        results.append(
+            {
+                "input_ids": input_ids,
+                "attention_mask": [1] * len(input_ids),
+                "labels": labels.tolist(),
+            }
+        )
+    return results
+
+
 class Chats(BaseModel):
     """
     top level data structure for chat conversations
@@ -193,8 +335,19 @@ class Chats(BaseModel):
         input_ids = []
         attention_mask = []
         labels = []
-        for msg in self.conversation:
-            msg_results = msg.tokenized(tokenizer, ignore_index)
+        if getattr(tokenizer, "is_fast", False):
+            # every message of the conversation in one batched tokenizer call
+            msgs_results = tokenize_segments(
+                tokenizer,  # type: ignore[arg-type]
+                [msg.segments() for msg in self.conversation],
+                ignore_index,
+            )
+        else:
+            msgs_results = [
+                msg.tokenized(tokenizer, ignore_index)  # type: ignore[arg-type]
+                for msg in self.conversation
+            ]
+        for msg_results in msgs_results:
             input_ids.extend(msg_results["input_ids"])
             attention_mask.extend(msg_results["attention_mask"])
             labels.extend(msg_results["labels"])
@@ -2,17 +2,25 @@
 chat dataset module
 """
 import os
-from typing import Callable, Optional, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from datasets import Dataset
 from transformers import PreTrainedTokenizer
 
-from axolotl.core.chat.messages import ChatFormattedChats
+from axolotl.core.chat.messages import (
+    ChatFormattedChats,
+    message_segments,
+    tokenize_segments,
+)
 
 
 class TokenizedChatDataset(Dataset):
     """
     Tokenized chat dataset
+
+    With a fast tokenizer and a ``dict_formatter``, the formatter's counterpart for messages
+    given as dicts, rows are tokenized straight from their dicts without validating them into
+    the pydantic models, unless one of their contents needs them.
     """
 
     def __init__(
@@ -22,23 +30,65 @@ class TokenizedChatDataset(Dataset):
         *args,
         message_transform: Optional[Callable] = None,
         formatter=None,
+        dict_formatter: Optional[Callable] = None,
         process_count: Optional[int] = None,
         keep_in_memory: Optional[bool] = False,
         **kwargs,
     ):
-        def map_fn(ex):
-            if message_transform is not None:
-                ex = message_transform(ex)
+        def to_chats(ex) -> ChatFormattedChats:
             if formatter is not None:
-                ex = ChatFormattedChats(
+                return ChatFormattedChats(
                     formatter=formatter,
                     **ex,
                 )
-            else:
-                ex = ChatFormattedChats(
-                    **ex,
+            return ChatFormattedChats(
+                **ex,
+            )
+
+        def to_segments(ex) -> List[List[Tuple[str, bool]]]:
+            if dict_formatter is not None:
+                msgs_segments = []
+                for i, msg in enumerate(ex["conversation"]):
+                    msg = dict_formatter(msg, message_index=i)
+                    if ex.get("train_on_inputs"):
+                        msg = {**msg, "weight": 1}
+                    segments = message_segments(msg)
+                    if segments is None:
+                        break
+                    msgs_segments.append(segments)
+                else:
+                    return msgs_segments
+            return [msg.segments() for msg in to_chats(ex).conversation]
+
+        def map_fn(batch):
+            rows = [dict(zip(batch.keys(), values)) for values in zip(*batch.values())]
+            if message_transform is not None:
+                rows = [message_transform(ex) for ex in rows]
+            if not getattr(model_transform, "is_fast", False):
+                results = [to_chats(ex).tokenized(model_transform) for ex in rows]
+                return {key: [res[key] for res in results] for key in results[0]}
+
+            # tokenize the messages of the whole batch in a single call
+            chats_segments = [to_segments(ex) for ex in rows]
+            msgs_results = iter(
+                tokenize_segments(
+                    model_transform,  # type: ignore[arg-type]
+                    [segments for chat in chats_segments for segments in chat],
                 )
-            return ex.tokenized(model_transform)
+            )
+            tokenized: Dict[str, List[List[int]]] = {
+                "input_ids": [],
+                "attention_mask": [],
+                "labels": [],
+            }
+            for chat_segments in chats_segments:
+                for values in tokenized.values():
+                    values.append([])
+                for _ in chat_segments:
+                    msg_results = next(msgs_results)
+                    for key, values in tokenized.items():
+                        values[-1].extend(msg_results[key])
+            return tokenized
 
         process_or_cpu_count: int = (
             process_count or os.cpu_count()  # type: ignore[assignment]
@@ -47,6 +97,7 @@ class TokenizedChatDataset(Dataset):
         features = data.features.keys()
         tokenized_data = data.map(
             map_fn,
+            batched=True,
             num_proc=num_proc,
             keep_in_memory=keep_in_memory,
             remove_columns=features,
@@ -4,7 +4,6 @@ Builder for the training args and trainer
 """
 
 import abc
-import gc
 import importlib
 import importlib.util
 import inspect
@@ -17,7 +16,7 @@ from collections import defaultdict
 from dataclasses import dataclass, field
 from functools import wraps
 from pathlib import Path
-from typing import Any, Dict, List, Literal, Optional, Type, Union
+from typing import Dict, List, Literal, Optional, Type, Union
 
 import torch
 import transformers
@@ -48,15 +47,20 @@ from trl import (
     RewardConfig,
     RewardTrainer,
 )
+from trl.trainer.dpo_trainer import PreferenceCollator
 from trl.trainer.utils import RewardDataCollatorWithPadding, pad_to_length
 
+from axolotl.common.const import (
+    DPO_REFERENCE_LOGPS_COLUMNS,
+    KTO_REFERENCE_LOGPS_COLUMNS,
+)
 from axolotl.integrations.base import PluginManager
 from axolotl.monkeypatch.multipack import SUPPORTED_MULTIPACK_MODEL_TYPES
 from axolotl.monkeypatch.relora import ReLoRACallback, ReLoRAScheduler
+from axolotl.monkeypatch.utils import set_precomputed_unpad_data
 from axolotl.utils import is_comet_available, is_mlflow_available
 from axolotl.utils.callbacks import (
     EvalFirstStepCallback,
-    GCCallback,
     GPUStatsCallback,
     LossWatchDogCallback,
     SaveAxolotlConfigtoWandBCallback,
@@ -67,17 +71,32 @@ from axolotl.utils.callbacks import (
     log_prediction_callback_factory,
 )
 from axolotl.utils.callbacks.lisa import lisa_callback_factory
+from axolotl.utils.callbacks.memory import MemoryManagerCallback
 from axolotl.utils.callbacks.profiler import PytorchProfilerCallback
 from axolotl.utils.chat_templates import get_chat_template_from_config
 from axolotl.utils.collators import (
     BatchSamplerDataCollatorForSeq2Seq,
     DataCollatorForSeq2Seq,
     MambaDataCollator,
+    PreallocatedBatchSamplerDataCollatorForSeq2Seq,
     V2BatchSamplerDataCollatorForSeq2Seq,
 )
 from axolotl.utils.collators.mm_chat import MultiModalChatDataCollator
+from axolotl.utils.collators.preference import (
+    PackedPreferenceCollator,
+    ReferenceLogpsPreferenceCollator,
+)
 from axolotl.utils.models import ensure_dtype
-from axolotl.utils.samplers import MultipackBatchSampler, get_dataset_lengths
+from axolotl.utils.preference_packing import (
+    packed_preference_attention_mask,
+    packed_preference_logps,
+)
+from axolotl.utils.samplers import (
+    MultipackBatchSampler,
+    get_dataset_lengths,
+    get_packing_plan_cache_dir,
+    get_preference_lengths,
+)
 from axolotl.utils.schedulers import (
     get_cosine_schedule_with_min_lr,
     get_cosine_schedule_with_quadratic_warmup,
@@ -175,6 +194,10 @@ class AxolotlTrainingMixins:
             "help": "The number of samples to group together for packing. Increase for better packing."
         },
     )
+    sample_packing_plan_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory to persist and reuse sample packing plans in."},
+    )
     max_seq_length: int = field(
         default=2048,
         metadata={"help": "The maximum sequence length the model can handle"},
@@ -609,7 +632,7 @@ class AxolotlTrainer(SchedulerMixin, Trainer):
                 )
                 batch_max_len = train_batch_size * self.args.max_seq_length
             return MultipackBatchSampler(
-                RandomSampler(self.train_dataset),
+                RandomSampler(self.train_dataset, generator=torch.Generator()),
                 lengths=get_dataset_lengths(self.train_dataset),
                 packing_efficiency_estimate=self.args.sample_packing_efficiency,
                 batch_max_len=batch_max_len,
@@ -617,6 +640,8 @@ class AxolotlTrainer(SchedulerMixin, Trainer):
                 group_size=self.args.sample_packing_group_size,
                 bin_size=self.args.sample_packing_bin_size,
                 drop_last=True,
+                seed=self.args.seed,
+                plan_cache_dir=self.args.sample_packing_plan_cache_dir,
             )
         if self.args.curriculum_sampling:
             return SequentialSampler(self.train_dataset)
@@ -643,6 +668,7 @@ class AxolotlTrainer(SchedulerMixin, Trainer):
                 group_size=self.args.sample_packing_group_size,
                 bin_size=self.args.sample_packing_bin_size,
                 drop_last=True,
+                plan_cache_dir=self.args.sample_packing_plan_cache_dir,
             )
         return super()._get_eval_sampler(eval_dataset)
 
@@ -760,6 +786,13 @@ class AxolotlTrainer(SchedulerMixin, Trainer):
         #     outputs = model(**inputs)
         #     loss = trainer_weighted_loss(outputs, labels, shift_labels=True)
         #     return (loss, outputs) if return_outputs else loss
+        if "cu_seqlens" in inputs:
+            # computed on CPU by the collator, for the patched `_get_unpad_data`
+            set_precomputed_unpad_data(
+                inputs["attention_mask"],
+                inputs.pop("cu_seqlens"),
+                inputs.pop("max_seqlen"),
+            )
         if self.args.orpo_alpha:
             return self.orpo_compute_loss(
                 model,
@@ -1068,6 +1101,21 @@ class ReLoRATrainer(AxolotlTrainer):
         return self.lr_scheduler
 
 
+class _PretokenizedProcessingClass:
+    """
+    Tokenizer stand-in that returns the token ids it is called with as is
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def __call__(self, input_ids, **kwargs):
+        return {"input_ids": list(input_ids)}
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+
 class AxolotlDPOTrainer(SchedulerMixin, DPOTrainer):
     """
     Extend the base DPOTrainer for axolotl helpers
@@ -1079,6 +1127,110 @@ class AxolotlDPOTrainer(SchedulerMixin, DPOTrainer):
         super().__init__(*args, **kwargs)
         self.dataset_tags = dataset_tags
         self.optimizer = None
+        # keep precomputed reference log-probs, which trl's collator drops
+        # pylint: disable=unidiomatic-typecheck
+        if type(self.data_collator) is PreferenceCollator:
+            self.data_collator = ReferenceLogpsPreferenceCollator(
+                pad_token_id=self.data_collator.pad_token_id
+            )
+
+    def _set_signature_columns_if_needed(self):
+        super()._set_signature_columns_if_needed()
+        if self._signature_columns is not None:
+            self._signature_columns = list(self._signature_columns) + [
+                column
+                for column in DPO_REFERENCE_LOGPS_COLUMNS
+                if column not in self._signature_columns
+            ]
+
+    def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
+        if self.args.sample_packing:
+            return MultipackBatchSampler(
+                RandomSampler(self.train_dataset, generator=torch.Generator()),
+                lengths=get_preference_lengths(
+                    self.train_dataset, self.args.max_length
+                ),
+                packing_efficiency_estimate=self.args.sample_packing_efficiency,
+                # same token budget as the unpacked chosen and rejected sequences
+                batch_max_len=2 * self.args.max_length,
+                batch_size=self.args.per_device_train_batch_size,
+                group_size=self.args.sample_packing_group_size,
+                bin_size=self.args.sample_packing_bin_size,
+                drop_last=True,
+                seed=self.args.seed,
+                plan_cache_dir=self.args.sample_packing_plan_cache_dir,
+            )
+        return super()._get_train_sampler()
+
+    def get_train_dataloader(self) -> DataLoader:
+        if not self.args.sample_packing:
+            return super().get_train_dataloader()
+        if self.precompute_ref_log_probs and not self._precomputed_train_ref_log_probs:
+            # trl adds its precomputed reference log-probs to the train dataset
+            super().get_train_dataloader()
+
+        dataloader_params = {
+            "batch_sampler": self._get_train_sampler(),
+            "collate_fn": self.data_collator,
+            "num_workers": self.args.dataloader_num_workers,
+            "pin_memory": self.args.dataloader_pin_memory,
+            "worker_init_fn": seed_worker,
+        }
+        if self.args.dataloader_prefetch_factor:
+            dataloader_params["prefetch_factor"] = self.args.dataloader_prefetch_factor
+        self.accelerator.even_batches = False
+        return self.accelerator.prepare_data_loader(
+            DataLoader(self.train_dataset, **dataloader_params)
+        )
+
+    def concatenated_forward(
+        self, model: nn.Module, batch: Dict[str, Union[List, torch.LongTensor]]
+    ):
+        if "sequence_ids" in batch:
+            return self.packed_forward(model, batch)
+        return super().concatenated_forward(model, batch)
+
+    def packed_forward(self, model: nn.Module, batch: Dict[str, torch.Tensor]):
+        """
+        Same as `concatenated_forward`, for the prompt, chosen, rejected sequences packed by
+        `PackedPreferenceCollator`, where the prompt is only run once.
+        """
+        model_kwargs = {}
+        if self.aux_loss_enabled:
+            model_kwargs["output_router_logits"] = True
+        attention_mask = packed_preference_attention_mask(
+            batch["sequence_ids"],
+            batch["segment_ids"],
+            dtype=self.accelerator.unwrap_model(model).dtype,
+        )
+        outputs = model(
+            input_ids=batch["input_ids"],
+            attention_mask=attention_mask,
+            position_ids=batch["position_ids"],
+            **model_kwargs,
+        )
+        logps = packed_preference_logps(outputs.logits, batch)
+
+        output = {
+            "chosen_logps": logps["chosen_logps"],
+            "rejected_logps": logps["rejected_logps"],
+            "mean_chosen_logits": logps["mean_chosen_logits"],
+            "mean_rejected_logits": logps["mean_rejected_logits"],
+        }
+        if self.args.rpo_alpha is not None:
+            output["nll_loss"] = (
+                -logps["chosen_logps"].sum() / logps["chosen_num_tokens"].sum()
+            )
+        if self.loss_type == "ipo":
+            output["chosen_logps"] = output["chosen_logps"] / logps[
+                "chosen_num_tokens"
+            ].clamp(min=1)
+            output["rejected_logps"] = output["rejected_logps"] / logps[
+                "rejected_num_tokens"
+            ].clamp(min=1)
+        if self.aux_loss_enabled:
+            output["aux_loss"] = outputs.aux_loss
+        return output
 
     def create_optimizer(self):
         if self.args.loraplus_lr_ratio is None:
@@ -1131,13 +1283,22 @@ class AxolotlDPOTrainer(SchedulerMixin, DPOTrainer):
         max_completion_length,
         add_special_tokens,
     ) -> Dict:
-        res = DPOTrainer.tokenize_row(
-            features,
-            processing_class,
-            max_prompt_length,
-            max_completion_length,
-            add_special_tokens,
-        )
+        if "prompt_input_ids" in features:
+            res = AxolotlDPOTrainer.pretokenized_row(
+                features,
+                processing_class,
+                max_prompt_length,
+                max_completion_length,
+                add_special_tokens,
+            )
+        else:
+            res = DPOTrainer.tokenize_row(
+                features,
+                processing_class,
+                max_prompt_length,
+                max_completion_length,
+                add_special_tokens,
+            )
         # fix when the tokenizer doesn't have a bos_token_id, e.g. Qwen
         if processing_class.bos_token is None and res["prompt_input_ids"][0] is None:
             for key in res.keys():
@@ -1156,16 +1317,28 @@ class AxolotlDPOTrainer(SchedulerMixin, DPOTrainer):
 
         return res
 
-    def training_step(
-        self,
-        model: nn.Module,
-        inputs: Dict[str, Union[torch.Tensor, Any]],
-        num_items_in_batch=None,
-    ) -> torch.Tensor:
-        loss: torch.Tensor = super().training_step(model, inputs, num_items_in_batch)
-        gc.collect()
-        torch.cuda.empty_cache()
-        return loss
+    @staticmethod
+    def pretokenized_row(
+        features,
+        processing_class,
+        max_prompt_length,
+        max_completion_length,
+        add_special_tokens,
+    ) -> Dict:
+        """
+        `DPOTrainer.tokenize_row` for rows already tokenized with `rl_pretokenize`
+        """
+        return DPOTrainer.tokenize_row(
+            {
+                "prompt": features["prompt_input_ids"],
+                "chosen": features["chosen_input_ids"],
+                "rejected": features["rejected_input_ids"],
+            },
+            _PretokenizedProcessingClass(processing_class),
+            max_prompt_length,
+            max_completion_length,
+            add_special_tokens,
+        )
 
     def log(self, logs: Dict[str, float], start_time: Optional[float] = None) -> None:
         # TODO remove once trl supports the updated to the Trainer.log method
@@ -1412,6 +1585,7 @@ class TrainerBuilderBase(abc.ABC):
                     if cb
                 ]
             )
+        callbacks.append(MemoryManagerCallback(self.cfg, trainer))
         return callbacks
 
     def hook_pre_create_training_args(self, training_arguments_kwargs):
@@ -1453,8 +1627,6 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
         if self.cfg.loss_watchdog_threshold is not None:
             callbacks.append(LossWatchDogCallback(self.cfg))
 
-        if self.cfg.gc_steps:
-            callbacks.append(GCCallback(gc_steps=self.cfg.gc_steps))
         callbacks.append(SaveModelCallback())
 
         return callbacks
@@ -1804,6 +1976,10 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
             training_arguments_kwargs[
                 "sample_packing_efficiency"
             ] = self.cfg.sample_packing_eff_est
+        if plan_cache_dir := get_packing_plan_cache_dir(self.cfg):
+            training_arguments_kwargs["sample_packing_plan_cache_dir"] = str(
+                plan_cache_dir
+            )
 
         if self.cfg.relora_steps:
             training_arguments_kwargs["relora_steps"] = self.cfg.relora_steps
@@ -1992,6 +2168,7 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
             Union[
                 V2BatchSamplerDataCollatorForSeq2Seq,
                 BatchSamplerDataCollatorForSeq2Seq,
+                PreallocatedBatchSamplerDataCollatorForSeq2Seq,
                 DataCollatorForSeq2Seq,
                 DataCollatorWithFlattening,
                 RewardDataCollatorWithPadding,
@@ -2012,6 +2189,15 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
                 collator = V2BatchSamplerDataCollatorForSeq2Seq
             else:
                 collator = BatchSamplerDataCollatorForSeq2Seq
+            if self.cfg.sample_packing_preallocated_collator:
+                kwargs["multipack_attn"] = (
+                    collator is V2BatchSamplerDataCollatorForSeq2Seq
+                )
+                collator = PreallocatedBatchSamplerDataCollatorForSeq2Seq
+                kwargs["precompute_cu_seqlens"] = bool(
+                    self.cfg.sample_packing_precompute_cu_seqlens
+                    and kwargs["multipack_attn"]
+                )
         else:
             if self.cfg.processor_type and self.processor:
                 collator = MultiModalChatDataCollator
@@ -2182,6 +2368,24 @@ class HFRLTrainerBuilder(TrainerBuilderBase):
             training_args_kwargs["generate_during_eval"] = self.cfg.use_wandb
             if self.cfg.dpo_use_weighting is not None:
                 training_args_kwargs["use_weighting"] = self.cfg.dpo_use_weighting
+            if self.cfg.rl_sample_packing:
+                training_args_kwargs["sample_packing"] = True
+                training_args_kwargs["generate_during_eval"] = False
+                if self.cfg.sample_packing_bin_size is not None:
+                    training_args_kwargs[
+                        "sample_packing_bin_size"
+                    ] = self.cfg.sample_packing_bin_size
+                if self.cfg.sample_packing_group_size is not None:
+                    training_args_kwargs[
+                        "sample_packing_group_size"
+                    ] = self.cfg.sample_packing_group_size
+                if plan_cache_dir := get_packing_plan_cache_dir(self.cfg):
+                    training_args_kwargs["sample_packing_plan_cache_dir"] = str(
+                        plan_cache_dir
+                    )
+                # the number of packed batches is only known once the trainer packs them
+                training_args_kwargs["num_train_epochs"] = self.cfg.num_epochs
+                total_num_steps = -1
 
         training_args = training_args_cls(  # pylint: disable=unexpected-keyword-arg
             output_dir=self.cfg.output_dir,
@@ -2213,15 +2417,36 @@ class HFRLTrainerBuilder(TrainerBuilderBase):
             dpo_trainer_kwargs[
                 "precompute_ref_log_probs"
             ] = self.cfg.precompute_ref_log_probs
+        reference_logps_columns = (
+            KTO_REFERENCE_LOGPS_COLUMNS
+            if self.cfg.rl == "kto"
+            else DPO_REFERENCE_LOGPS_COLUMNS
+        )
+        reference_logps_cached = all(
+            column in self.train_dataset.column_names
+            for column in reference_logps_columns
+        )
+        if reference_logps_cached:
+            # log-probs cached by `precompute_reference_logps`, see attach_reference_logps
+            dpo_trainer_kwargs["precompute_ref_log_probs"] = True
         if self.cfg.rl in ["dpo", "ipo"]:
             trainer_cls = AxolotlDPOTrainer
             trainer_cls_args = [self.model, self.model_ref]
+            if self.cfg.rl_sample_packing:
+                dpo_trainer_kwargs["data_collator"] = PackedPreferenceCollator(
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    max_length=self.cfg.sequence_len,
+                )
         elif self.cfg.rl == "orpo":
             trainer_cls = AxolotlORPOTrainer
             trainer_cls_args = [self.model]
         elif self.cfg.rl in ["kto"]:
             trainer_cls = AxolotlKTOTrainer
             trainer_cls_args = [self.model]
+            if self.cfg.rl_pretokenize:
+                from axolotl.monkeypatch.trainer_kto_tokenize import patch_kto_tokenize
+
+                patch_kto_tokenize()
         elif self.cfg.rl in ["simpo"]:
             trainer_cls = AxolotlCPOTrainer
             trainer_cls_args = [self.model]
@@ -2245,6 +2470,10 @@ class HFRLTrainerBuilder(TrainerBuilderBase):
             callbacks=self.get_callbacks(),
             **dpo_trainer_kwargs,
         )
+        if reference_logps_cached:
+            # pylint: disable=protected-access,attribute-defined-outside-init
+            dpo_trainer._precomputed_train_ref_log_probs = True
+            dpo_trainer._precomputed_eval_ref_log_probs = True
         if self.cfg.fsdp:
             ensure_dtype(dpo_trainer.model, dtype=self.cfg.torch_dtype)
             if self.cfg.rl in ["dpo", "ipo"] and dpo_trainer.ref_model:
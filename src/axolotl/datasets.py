@@ -49,11 +49,13 @@ class TokenizedPromptDataset(Dataset):
         num_proc = min(64, self.process_count if self.process_count else os.cpu_count())
 
         map_kwargs = {}
+        tokenize_fn = self.prompt_tokenizer.tokenize_prompt
         if self.prompt_tokenizer.supports_batched:
             map_kwargs["batched"] = True
-            map_kwargs["batch_size"] = 100
+            map_kwargs["batch_size"] = self.prompt_tokenizer.map_batch_size
+            tokenize_fn = self.prompt_tokenizer.tokenize_prompt_batched
         return dataset.map(
-            self.prompt_tokenizer.tokenize_prompt,
+            tokenize_fn,
             num_proc=num_proc,
             remove_columns=features,
             keep_in_memory=self.keep_in_memory,
@@ -1,13 +1,43 @@
 """monkey patches for the dataset fetcher to handle batches of packed indexes"""
 # pylint: disable=protected-access
 
+import numpy as np
+import pyarrow as pa
 import torch
+from datasets import Dataset
 from torch.utils.data._utils.fetch import _BaseDatasetFetcher
 from torch.utils.data._utils.worker import _worker_loop
 
 
+def fetch_packed_table(dataset: Dataset, batched_index) -> pa.Table:
+    """
+    Gather the rows of all bins of a packed batch, bin after bin, with one Arrow take.
+    """
+    indices = pa.array(
+        np.concatenate([np.asarray(bin_, dtype=np.int64) for bin_ in batched_index])
+    )
+    if dataset._indices is not None:
+        # follow the select/shuffle mapping to rows of the underlying table
+        indices = dataset._indices.column(0).take(indices)
+    return dataset.data.table.take(indices)
+
+
 class _MapDatasetFetcher(_BaseDatasetFetcher):
     def fetch(self, possibly_batched_index):
+        collate_arrow = getattr(self.collate_fn, "collate_arrow", None)
+        if (
+            collate_arrow is not None
+            and self.auto_collation
+            and isinstance(possibly_batched_index[0], list)
+            and isinstance(self.dataset, Dataset)
+        ):
+            # skip decoding samples into python lists, the collator reads the Arrow buffers
+            table = fetch_packed_table(self.dataset, possibly_batched_index)
+            if self.collate_fn.supports_arrow(table):
+                return collate_arrow(
+                    table, [len(bin_) for bin_ in possibly_batched_index]
+                )
+
         if isinstance(possibly_batched_index[0], list):
             data = [None for i in possibly_batched_index]
             for i, possibly_batched_index_ in enumerate(possibly_batched_index):
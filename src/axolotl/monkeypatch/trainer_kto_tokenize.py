@@ -0,0 +1,31 @@
+"""
+keep rows already tokenized with `rl_pretokenize` when trl's KTOTrainer tokenizes its dataset
+"""
+import logging
+
+from trl.trainer import kto_trainer
+
+from axolotl.common.const import KTO_TOKENIZED_COLUMNS
+
+LOG = logging.getLogger("axolotl.monkeypatch.trainer_kto_tokenize")
+
+ORIGINAL_KTO_TOKENIZE = kto_trainer._tokenize  # pylint: disable=protected-access
+
+
+def kto_tokenize_unless_pretokenized(batch, tokenizer):
+    if all(key in batch for key in KTO_TOKENIZED_COLUMNS):
+        return {key: batch[key] for key in KTO_TOKENIZED_COLUMNS}
+    return ORIGINAL_KTO_TOKENIZE(batch, tokenizer)
+
+
+def patch_kto_tokenize():
+    """
+    monkeypatch the module level `_tokenize` the KTOTrainer maps over its datasets, so it
+    passes pretokenized rows through
+    """
+    # pylint: disable=protected-access
+    if kto_trainer._tokenize is kto_tokenize_unless_pretokenized:
+        return
+
+    LOG.info("patching KTOTrainer _tokenize to keep pretokenized rows")
+    kto_trainer._tokenize = kto_tokenize_unless_pretokenized
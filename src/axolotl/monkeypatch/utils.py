@@ -1,7 +1,8 @@
 """
 Shared utils for the monkeypatches
 """
-from typing import Optional
+import weakref
+from typing import Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -14,28 +15,31 @@ from transformers.utils import is_torch_bf16_gpu_available
 
 @torch.jit.script
 def get_max_seqlen_in_batch(attention_mask: torch.Tensor) -> torch.Tensor:
+    """
+    Lengths of the packed samples of every row, numbered 1..n within a row by the attention mask,
+    in row order and then sample number order.
+    """
     max_num = int(torch.max(attention_mask).item())
     batch_size, _ = attention_mask.shape
-    counts = torch.zeros((batch_size, max_num), dtype=torch.int32)
-    for i in range(1, max_num + 1):
-        mask = attention_mask == i
-        counts[:, i - 1] = torch.sum(mask, dim=-1).to(dtype=torch.int32)
-    result = counts.flatten()
-    nonzero_indices = torch.nonzero(result).squeeze(-1)
-    return result[nonzero_indices]
+    # one bin per (row, sample number), with 0 counting the padding of that row
+    keys = (
+        torch.arange(batch_size, device=attention_mask.device).unsqueeze(1)
+        * (max_num + 1)
+        + attention_mask
+    )
+    counts = torch.bincount(keys.flatten(), minlength=batch_size * (max_num + 1))
+    counts = counts.view(batch_size, max_num + 1)[:, 1:].flatten().to(torch.int32)
+    return counts[counts != 0]
 
 
 @torch.jit.script
-def get_unpad_data(attention_mask: torch.Tensor):
-    device = attention_mask.device
+def _compute_unpad_data(attention_mask: torch.Tensor):
     seqlens_in_batch = get_max_seqlen_in_batch(attention_mask)
     indices = torch.nonzero(attention_mask.flatten()).flatten()
     max_seqlen_in_batch = seqlens_in_batch.max().item()
-    cu_seqlens = (
-        F.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
-        .to(device=device)
-        .detach()
-    )
+    cu_seqlens = F.pad(
+        torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0)
+    ).detach()
     return (
         indices,
         cu_seqlens,
@@ -43,55 +47,102 @@ def get_unpad_data(attention_mask: torch.Tensor):
     )
 
 
+class _UnpadDataCache:
+    """
+    Unpad data of the last attention mask seen, which every attention layer of a forward pass
+    requests again, or precomputed by the collator and registered before the forward pass.
+    """
+
+    # pylint: disable=protected-access
+
+    mask_ref: Optional[weakref.ref] = None
+    mask_version: Optional[int] = None
+    unpad_data = None
+
+    @classmethod
+    def get(cls, attention_mask: torch.Tensor):
+        if (
+            cls.mask_ref is not None
+            and cls.mask_ref() is attention_mask  # pylint: disable=not-callable
+            and cls.mask_version == attention_mask._version
+        ):
+            return cls.unpad_data
+        return None
+
+    @classmethod
+    def set(cls, attention_mask: torch.Tensor, unpad_data):
+        cls.mask_ref = weakref.ref(attention_mask)
+        cls.mask_version = attention_mask._version
+        cls.unpad_data = unpad_data
+
+
+def get_unpad_data(attention_mask: torch.Tensor):
+    unpad_data = _UnpadDataCache.get(attention_mask)
+    if unpad_data is None:
+        unpad_data = _compute_unpad_data(attention_mask)
+        _UnpadDataCache.set(attention_mask, unpad_data)
+    return unpad_data
+
+
+def set_precomputed_unpad_data(
+    attention_mask: torch.Tensor, cu_seqlens: torch.Tensor, max_seqlen: int
+):
+    """
+    Register the `cu_seqlens`/`max_seqlen` computed by the collator for `attention_mask`, so the
+    patched `_get_unpad_data` only has to find the indices of its tokens.
+    """
+    indices = torch.nonzero(attention_mask.flatten()).flatten()
+    _UnpadDataCache.set(
+        attention_mask,
+        (indices, cu_seqlens.to(attention_mask.device, torch.int32), max_seqlen),
+    )
+
+
+def _pad_cu_seqlens(
+    starts: torch.Tensor, ends: torch.Tensor, seq_len: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Gather each row's flagged start positions followed by the `ends` entries (-1 for none) into one
+    (batch, n) tensor, padded with `seq_len`, and the longest sequence of each row.
+    """
+    num_starts = starts.sum(dim=1)
+    width = int((num_starts + (ends >= 0).sum(dim=1)).max())
+    cu_seqlens = torch.full(
+        (starts.size(0), width), seq_len, dtype=torch.long, device=starts.device
+    )
+    # nonzero is row-major, so each start's rank within its row is its offset from the row's first
+    rows, cols = torch.nonzero(starts, as_tuple=True)
+    row_offsets = torch.cumsum(num_starts, dim=0) - num_starts
+    cu_seqlens[
+        rows, torch.arange(rows.size(0), device=rows.device) - row_offsets[rows]
+    ] = cols
+    for col in range(ends.size(1)):
+        valid = ends[:, col] >= 0
+        cu_seqlens[valid, (num_starts + col)[valid]] = ends[valid, col]
+    max_seq_lens = (cu_seqlens[:, 1:] - cu_seqlens[:, :-1]).max(dim=1).values
+    return cu_seqlens.to(dtype=torch.int32), max_seq_lens
+
+
 def get_cu_seqlens(attn_mask):
     """generate a cumulative sequence length mask for flash attention using attn mask"""
     if len(attn_mask.shape) == 1:
         attn_mask = attn_mask.unsqueeze(0)
 
-    device = attn_mask.device
-    results = []
-    max_seq_lens = []
-
-    for row in attn_mask:
-        # Exclude zeros to avoid adding their positions to the mask
-        t_non_zeros = row[row != 0]
-        # Find where the sequence number changes (including the first position)
-        seq_change = torch.cat(
-            [
-                torch.tensor([1], dtype=torch.int32, device=device),
-                t_non_zeros[1:] != t_non_zeros[:-1],
-            ]
-        )
-        # Get the indices where the sequence changes
-        change_indices = torch.cat(
-            [
-                (seq_change == 1).nonzero(as_tuple=True)[0],
-                torch.tensor([len(t_non_zeros)], dtype=torch.int32, device=device),
-            ]
-        )
-        # Calculate the sequence lengths
-        seq_lengths = change_indices[1:] - change_indices[:-1]
-        # Calculate the length of the final sequence or padding
-        final_seq_length = len(row) - change_indices[-1]
-        # Append the length of the final sequence or padding to seq_lengths
-        if final_seq_length.item():
-            seq_lengths = torch.cat(
-                [
-                    seq_lengths,
-                    torch.tensor(
-                        [final_seq_length.item()], dtype=torch.int32, device=device
-                    ),
-                ]
-            )
-        # Calculate the cumulative sequence lengths
-        cu_seqlens = torch.cat(
-            [torch.tensor([0], dtype=torch.int32, device=device), seq_lengths.cumsum(0)]
-        )
-        max_seq_len = (cu_seqlens[1:] - cu_seqlens[:-1]).max()
-        results.append(cu_seqlens)
-        max_seq_lens.append(max_seq_len)
-
-    return torch.stack(results).to(dtype=torch.int32), torch.stack(max_seq_lens)
+    seq_len = attn_mask.size(1)
+    # move the padding of every row to its end, keeping the order of the tokens
+    order = torch.sort((attn_mask == 0).int(), dim=1, stable=True).indices
+    packed = torch.gather(attn_mask, 1, order)
+    num_tokens = (attn_mask != 0).sum(dim=1, keepdim=True)
+    positions = torch.arange(seq_len, device=attn_mask.device).unsqueeze(0)
+
+    # a sequence starts wherever the sample number changes, the padding where the tokens end
+    changes = torch.ones_like(packed, dtype=torch.bool)
+    changes[:, 1:] = packed[:, 1:] != packed[:, :-1]
+    starts = (changes & (positions < num_tokens)) | (positions == num_tokens)
+    ends = torch.full(
+        (attn_mask.size(0), 1), seq_len, dtype=torch.long, device=attn_mask.device
+    )
+    return _pad_cu_seqlens(starts, ends, seq_len)
 
 
 def get_cu_seqlens_from_pos_ids(position_ids):
@@ -99,58 +150,20 @@ def get_cu_seqlens_from_pos_ids(position_ids):
     if len(position_ids.shape) == 1:
         position_ids = position_ids.unsqueeze(0)
 
-    device = position_ids.device
-    results = []
-    max_seq_lens = []
-
-    for row in position_ids:
-        # Count the number of consecutive zeros from the right side
-        padding_length = (row == 0).int().flip(dims=[0]).cumprod(dim=0).sum().item()
-
-        # Adjust the row to exclude padding
-        adjusted_row = row[:-padding_length] if padding_length else row.clone()
-
-        # Find where the position resets to 0 (indicating a new sequence)
-        seq_starts = torch.cat(
-            [
-                torch.tensor([True], dtype=torch.bool, device=device),
-                adjusted_row[1:] == 0,
-            ]
-        )
-        # Get the indices where the sequence starts
-        start_indices = torch.cat(
-            [
-                torch.nonzero(seq_starts).unbind(dim=1)[0],
-                torch.tensor([len(adjusted_row)], dtype=torch.int32, device=device),
-            ]
-        )
-        # Calculate the sequence lengths
-        seq_lengths = start_indices[1:] - start_indices[:-1]
-        # Calculate the cumulative sequence lengths
-        cu_seqlens = torch.cat(
-            [torch.tensor([0], dtype=torch.int32, device=device), seq_lengths.cumsum(0)]
-        )
-        # Append the padding length to the cumulative sequence lengths
-        if padding_length:
-            cu_seqlens = torch.cat(
-                [cu_seqlens, torch.tensor([len(row)], dtype=torch.int32, device=device)]
-            )
-        max_seq_len = (cu_seqlens[1:] - cu_seqlens[:-1]).max()
-        results.append(cu_seqlens)
-        max_seq_lens.append(max_seq_len)
-
-    # Find the maximum value across all tensors
-    max_value = max(t.max() for t in results)
-
-    # Find the length of the longest tensor
-    max_length = max(t.size(0) for t in results)
-
-    # Pad each tensor to the same length and collect them in a list
-    padded_results = [
-        F.pad(t, (0, max_length - t.size(0)), "constant", max_value) for t in results
-    ]
-
-    return torch.stack(padded_results).to(dtype=torch.int32), torch.stack(max_seq_lens)
+    seq_len = position_ids.size(1)
+    positions = torch.arange(seq_len, device=position_ids.device).unsqueeze(0)
+    # trailing zeros are padding, so the tokens end after the last nonzero position id
+    num_tokens = torch.where(position_ids != 0, positions, -1).amax(dim=1) + 1
+    padding_length = seq_len - num_tokens
+
+    # a sequence starts at the first token and wherever the position resets to 0
+    starts = (positions == 0) | (
+        (position_ids == 0) & (positions < num_tokens.unsqueeze(1))
+    )
+    ends = torch.stack(
+        [num_tokens, torch.where(padding_length > 0, seq_len, -1)], dim=1
+    )
+    return _pad_cu_seqlens(starts, ends, seq_len)
 
 
 def set_module_name(model, name, value):
@@ -3,7 +3,10 @@ HF Chat Templates prompt strategy
 """
 
 import logging
-from typing import Any, Dict, List, Optional
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
 
 from transformers import ProcessorMixin
 
@@ -15,6 +18,12 @@ from axolotl.utils.chat_templates import get_chat_template_from_config
 LOG = logging.getLogger("axolotl")
 LOG.setLevel(logging.INFO)
 
+# content `find_turn` renders in place of a turn to find where the turn's tokens differ
+DUMMY_TURN_CONTENT = "[[dummy_message]]"
+# placeholder rendered in place of each turn's content to locate turns in a single pass
+TURN_SENTINEL = "[[axolotl_turn_{}]]"
+TURN_SENTINEL_PATTERN = re.compile(r"\[\[axolotl_turn_(\d+)\]\]")
+
 
 class ChatTemplatePrompter(Prompter):
     """Prompter for HF chat templates"""
@@ -81,6 +90,17 @@ class ChatTemplatePrompter(Prompter):
             chat_template=self.chat_template,
         )
 
+    def render_prompt(self, conversation, add_generation_prompt=False) -> str:
+        """
+        Render the conversation with the chat template without tokenizing it.
+        """
+        return self.tokenizer.apply_chat_template(
+            conversation,
+            add_generation_prompt=add_generation_prompt,
+            chat_template=self.chat_template,
+            tokenize=False,
+        )
+
     def get_offsets_for_train_detail(
         self, text: str, train_details: List[Dict], mask_untrainable: bool = True
     ) -> List[int]:
@@ -199,6 +219,7 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
         sequence_len,
         roles_to_train=None,
         train_on_eos=None,
+        single_pass_turns=False,
     ):
         super().__init__(prompter, tokenizer, train_on_inputs, sequence_len)
 
@@ -210,6 +231,7 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
             ]
 
         self.train_on_eos = train_on_eos
+        self.single_pass_turns = single_pass_turns
         self.images = "images"
 
     @property
@@ -220,14 +242,33 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
     def messages(self, messages):
         self._messages = messages
 
-    def tokenize_prompt(self, prompt):
-        # Old simple legacy behavior that works reliably.
-        if (
+    @property
+    def supports_batched(self):
+        # only single pass tokenization gains from batching, processors and subclasses
+        # customizing per-row tokenization are mapped row by row
+        return (
+            self.single_pass_turns
+            and self.tokenizer.is_fast
+            and not self.prompter.processor
+            and type(self).tokenize_prompt is ChatTemplateStrategy.tokenize_prompt
+        )
+
+    @property
+    def map_batch_size(self):
+        return 1000
+
+    @property
+    def _is_legacy_behavior(self) -> bool:
+        return (
             not self.roles_to_train
             and not self.train_on_eos
             and not self.prompter.message_field_training
             and not self.prompter.message_field_training_detail
-        ):
+        )
+
+    def tokenize_prompt(self, prompt):
+        # Old simple legacy behavior that works reliably.
+        if self._is_legacy_behavior:
             turns = self.get_conversation_thread(prompt)
             images = self.get_images(prompt)
             prompt_ids = self.prompter.build_prompt(
@@ -236,27 +277,91 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
                 images=images,
             )
             tokenized_res = self.prompter.build_prompt(turns, images=images)
-            tokenized_prompt = {}
-            if isinstance(tokenized_res, list):
-                input_ids = prompt_ids + tokenized_res[len(prompt_ids) :]
-                tokenized_prompt["input_ids"] = input_ids
-                tokenized_prompt["attention_mask"] = [1] * len(input_ids)
-            else:
-                input_ids = tokenized_res["input_ids"]
-                tokenized_prompt = tokenized_res
+            return self._label_last_turn(prompt_ids, tokenized_res)
 
-            if not self.train_on_inputs:
-                user_prompt_len = len(prompt_ids)
-                labels = [-100] * user_prompt_len + input_ids[user_prompt_len:]
-            else:
-                labels = input_ids
+        turns = self.get_conversation_thread(prompt)
+        turn_boundaries = None
+        if self.single_pass_turns:
+            single_pass = self._tokenize_turns_single_pass(turns)
+            if single_pass is not None:
+                input_ids, turn_boundaries = single_pass
+        if turn_boundaries is None:
+            input_ids = self.prompter.build_prompt(turns)
+        return self._label_turns(turns, input_ids, turn_boundaries)
+
+    def tokenize_prompt_batched(self, prompts: Dict[str, List]) -> Dict[str, List]:
+        """
+        Tokenize a batch of conversations, rendering each with the chat template and
+        tokenizing the rendered texts with a single tokenizer call where possible.
+        """
+        feature_names = list(prompts.keys())
+        rows = [dict(zip(feature_names, row)) for row in zip(*prompts.values())]
+        turns_batch = [self.get_conversation_thread(row) for row in rows]
+
+        if not self.supports_batched:
+            results = [self.tokenize_prompt(row) for row in rows]
+        elif self._is_legacy_behavior:
+            texts = [
+                self.prompter.render_prompt(turns[:-1], add_generation_prompt=True)
+                for turns in turns_batch
+            ] + [self.prompter.render_prompt(turns) for turns in turns_batch]
+            tokenized = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+            results = [
+                self._label_last_turn(prompt_ids, full_ids)
+                for prompt_ids, full_ids in zip(
+                    tokenized[: len(rows)], tokenized[len(rows) :]
+                )
+            ]
+        else:
+            aligned = [self._align_turns(turns) for turns in turns_batch]
+            texts = [alignment[0] for alignment in aligned if alignment is not None]
+            tokenized = (
+                self.tokenizer(
+                    texts, return_offsets_mapping=True, add_special_tokens=False
+                )
+                if texts
+                else {"input_ids": [], "offset_mapping": []}
+            )
+            tokenized_rows = zip(tokenized["input_ids"], tokenized["offset_mapping"])
+            results = []
+            for turns, alignment in zip(turns_batch, aligned):
+                turn_boundaries = None
+                if alignment is not None:
+                    input_ids, offset_mapping = next(tokenized_rows)
+                    turn_boundaries = self._turn_boundaries_from_offsets(
+                        turns, *alignment, offset_mapping
+                    )
+                if turn_boundaries is None:
+                    input_ids = self.prompter.build_prompt(turns)
+                results.append(self._label_turns(turns, input_ids, turn_boundaries))
+
+        res: Dict[str, List[Any]] = defaultdict(list)
+        for result in results:
+            for key, val in result.items():
+                res[key].append(val)
+        return dict(res)
+
+    def _label_last_turn(self, prompt_ids, tokenized_res):
+        tokenized_prompt = {}
+        if isinstance(tokenized_res, list):
+            input_ids = prompt_ids + tokenized_res[len(prompt_ids) :]
+            tokenized_prompt["input_ids"] = input_ids
+            tokenized_prompt["attention_mask"] = [1] * len(input_ids)
+        else:
+            input_ids = tokenized_res["input_ids"]
+            tokenized_prompt = tokenized_res
 
-            tokenized_prompt["labels"] = labels
+        if not self.train_on_inputs:
+            user_prompt_len = len(prompt_ids)
+            labels = [-100] * user_prompt_len + input_ids[user_prompt_len:]
+        else:
+            labels = input_ids
 
-            return tokenized_prompt
+        tokenized_prompt["labels"] = labels
 
-        turns = self.get_conversation_thread(prompt)
-        input_ids = self.prompter.build_prompt(turns)
+        return tokenized_prompt
+
+    def _label_turns(self, turns, input_ids, turn_boundaries=None):
         labels = [IGNORE_TOKEN_ID] * len(input_ids)
 
         last_eos_idx = -1
@@ -280,7 +385,12 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
 
             LOG.debug(f"Should train: {should_train}")
 
-            turn_start_idx, turn_end_idx = self.find_turn(turns=turns, turn_idx=index)
+            if turn_boundaries is not None:
+                turn_start_idx, turn_end_idx = turn_boundaries[index]
+            else:
+                turn_start_idx, turn_end_idx = self.find_turn(
+                    turns=turns, turn_idx=index
+                )
 
             LOG.debug(f"Turn indices: start={turn_start_idx}, end={turn_end_idx}")
 
@@ -361,7 +471,7 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
 
         empty_turn = {
             "role": turns[turn_idx].get("role"),
-            "content": "[[dummy_message]]",
+            "content": DUMMY_TURN_CONTENT,
         }
 
         # Create conversation versions
@@ -422,6 +532,210 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
 
         return start_idx, end_idx
 
+    def find_turns(self, turns: list[dict]) -> List[Tuple[int, int]]:
+        """
+        Locate the starting and ending indices of every turn in a conversation.
+
+        Renders and tokenizes the conversation once and maps the character span of
+        each turn's content onto the token offsets. Falls back to `find_turn` for the
+        whole conversation if the rendered text cannot be aligned.
+        """
+        single_pass = self._tokenize_turns_single_pass(turns)
+        if single_pass is not None:
+            return single_pass[1]
+
+        return [
+            self.find_turn(turns=turns, turn_idx=turn_idx)
+            for turn_idx in range(len(turns))
+        ]
+
+    def _tokenize_turns_single_pass(
+        self, turns: list[dict]
+    ) -> Optional[Tuple[List[int], List[Tuple[int, int]]]]:
+        """
+        Tokenize the conversation once and derive the token boundaries of each turn.
+        Returns None if the rendering cannot be aligned.
+        """
+        if self.prompter.processor or not self.tokenizer.is_fast:
+            return None
+
+        alignment = self._align_turns(turns)
+        if alignment is None:
+            return None
+
+        text, char_spans = alignment
+        tokenized = self.tokenizer(
+            text, return_offsets_mapping=True, add_special_tokens=False
+        )
+        turn_boundaries = self._turn_boundaries_from_offsets(
+            turns, text, char_spans, tokenized["offset_mapping"]
+        )
+        if turn_boundaries is None:
+            return None
+
+        return tokenized["input_ids"], turn_boundaries
+
+    def _align_turns(
+        self, turns: list[dict]
+    ) -> Optional[Tuple[str, Dict[int, Tuple[int, int]]]]:
+        """
+        Render the conversation and find the character span of each turn's content.
+
+        The conversation is rendered twice, once as is and once with each turn's
+        content replaced by a numbered sentinel. The template text between sentinels
+        is then matched against the real rendering to recover where each turn's
+        content was rendered. Turns without string content (e.g. tool calls) are left
+        as template text and have no span.
+        """
+        sentinel_turns = [
+            {**turn, "content": TURN_SENTINEL.format(turn_idx)}
+            if isinstance(turn.get("content"), str)
+            else turn
+            for turn_idx, turn in enumerate(turns)
+        ]
+        text = self.prompter.render_prompt(turns)
+        sentinel_text = self.prompter.render_prompt(sentinel_turns)
+
+        # split the sentinel rendering into template literals and turn placeholders
+        literals = []
+        placeholders = []
+        cursor = 0
+        for match in TURN_SENTINEL_PATTERN.finditer(sentinel_text):
+            literals.append(sentinel_text[cursor : match.start()])
+            placeholders.append(int(match.group(1)))
+            cursor = match.end()
+        literals.append(sentinel_text[cursor:])
+
+        # walk the real rendering, matching literals verbatim and contents as rendered
+        char_spans: Dict[int, Tuple[int, int]] = {}
+        if not text.startswith(literals[0]):
+            LOG.debug("Could not align chat template rendering, falling back")
+            return None
+        position = len(literals[0])
+        for turn_idx, literal in zip(placeholders, literals[1:]):
+            content = turns[turn_idx]["content"]
+            rendered = next(
+                (
+                    candidate
+                    for candidate in (content, content.strip())
+                    if text.startswith(candidate, position)
+                    and text.startswith(literal, position + len(candidate))
+                ),
+                None,
+            )
+            if rendered is None:
+                LOG.debug(
+                    f"Could not align content of turn {turn_idx} in rendered template, falling back"
+                )
+                return None
+            start, _ = char_spans.get(turn_idx, (position, position))
+            char_spans[turn_idx] = (start, position + len(rendered))
+            position += len(rendered) + len(literal)
+        if position != len(text):
+            LOG.debug("Rendered template has trailing content, falling back")
+            return None
+
+        return text, char_spans
+
+    def _turn_boundaries_from_offsets(
+        self,
+        turns: list[dict],
+        text: str,
+        char_spans: Dict[int, Tuple[int, int]],
+        offset_mapping: List[Tuple[int, int]],
+    ) -> Optional[List[Tuple[int, int]]]:
+        """
+        Map the character span of each turn's content to the tokens overlapping it.
+        Returns None if the token offsets are not monotonic.
+        """
+        token_starts = [start for start, _ in offset_mapping]
+        token_ends = [end for _, end in offset_mapping]
+        if token_starts != sorted(token_starts) or token_ends != sorted(token_ends):
+            LOG.debug("Token offsets are not monotonic, falling back")
+            return None
+
+        boundaries = []
+        for turn_idx, turn in enumerate(turns):
+            if not isinstance(turn.get("content"), str):
+                boundaries.append(self.find_turn(turns=turns, turn_idx=turn_idx))
+                continue
+
+            # mistral does not output message if it contains only system message
+            if (
+                turn_idx == 0
+                and turn.get("role") == "system"
+                and "mistral" in self.tokenizer.name_or_path.lower()
+            ):
+                boundaries.append((-1, -1))
+                continue
+
+            if turn_idx not in char_spans:
+                LOG.warning(f"Turn {turn_idx} was not rendered by the chat template")
+                boundaries.append((-1, -1))
+                continue
+
+            char_start, char_end = char_spans[turn_idx]
+            # tokens overlapping the content span, including ones merged with the template
+            start_idx = bisect_right(token_ends, char_start)
+            end_idx = bisect_left(token_starts, char_end)
+            if (
+                start_idx > 0
+                and token_starts[start_idx - 1]
+                < token_ends[start_idx - 1]
+                == char_start
+                and not text[token_starts[start_idx - 1] : char_start].strip(" ")
+            ):
+                # a space token the content's first word didn't merge with, e.g. a lone
+                # metaspace, belongs to the content or the template depending on the
+                # merges, so leave it to the tokenized diff of find_turn if unresolved
+                space_is_content = self._space_token_is_content(
+                    text, offset_mapping, start_idx - 1
+                )
+                if space_is_content is None:
+                    boundaries.append(self.find_turn(turns=turns, turn_idx=turn_idx))
+                    continue
+                if space_is_content:
+                    start_idx -= 1
+            if end_idx <= start_idx:
+                LOG.warning(
+                    f"Content end boundary is the same as start boundary for turn {turn_idx}. This is likely an empty turn."
+                )
+                boundaries.append((-1, -1))
+                continue
+
+            LOG.debug(f"Content boundaries: {start_idx}, {end_idx}")
+            boundaries.append((start_idx, end_idx))
+
+        return boundaries
+
+    def _space_token_is_content(
+        self, text: str, offset_mapping: List[Tuple[int, int]], space_idx: int
+    ) -> Optional[bool]:
+        """
+        Whether `find_turn` counts the space token at `space_idx`, which the following
+        content didn't merge with, as part of the content.
+
+        `find_turn` diffs the tokens against a rendering with dummy content, so the space
+        is content exactly when it merges with the start of the dummy content. This is
+        checked by tokenizing the space and the token before it followed by the dummy
+        content. Returns None if the merges reach past the token before the space.
+        """
+        window_start = offset_mapping[max(space_idx - 1, 0)][0]
+        space_start, space_end = (
+            offset - window_start for offset in offset_mapping[space_idx]
+        )
+        window = self.tokenizer(
+            text[window_start : window_start + space_end] + DUMMY_TURN_CONTENT,
+            return_offsets_mapping=True,
+            add_special_tokens=False,
+        )["offset_mapping"]
+        for start, end in window:
+            if start == space_start and end > space_start:
+                return end > space_end
+            if end > space_start:
+                break
+        return None
+
     def get_conversation_thread(self, prompt):
         turns = []
         optional_keys = [
@@ -489,6 +803,7 @@ def load(tokenizer, cfg, ds_cfg: Optional[Dict[str, Any]] = None, processor=None
         "sequence_len": cfg.sequence_len,
         "roles_to_train": ds_cfg.get("roles_to_train", ["assistant"]),
         "train_on_eos": ds_cfg.get("train_on_eos", "turn"),
+        "single_pass_turns": ds_cfg.get("single_pass_turns", False),
     }
 
     strategy = ChatTemplateStrategy(
@@ -39,9 +39,13 @@ class CompletionPromptTokenizingStrategy(InstructionPromptTokenizingStrategy):
         )
 
     def tokenize_prompt(self, prompt):
+        return self.tokenize_prompt_batched(prompt)
+
+    def tokenize_prompt_batched(self, prompts):
         res = defaultdict(lambda: [])
-        feature_names = list(prompt.keys())
-        for row in zip(*prompt.values()):
+        feature_names = list(prompts.keys())
+        full_prompts = []
+        for row in zip(*prompts.values()):
             prompt_row = dict(zip(feature_names, row))
             (
                 instruction,
@@ -49,9 +53,9 @@ class CompletionPromptTokenizingStrategy(InstructionPromptTokenizingStrategy):
                 _,
             ) = self.parse_instruction_fields(prompt_row)
 
-            full_prompt = self._build_full_prompt(instruction, None, None)
-            tokenized_full_prompt = self._tokenize(full_prompt)
+            full_prompts.append(self._build_full_prompt(instruction, None, None))
 
+        for tokenized_full_prompt in self._tokenize_batch(full_prompts):
             for key, val in tokenized_full_prompt.items():
                 for i in range(0, len(val), self.sequence_len):
                     res[key].append(val[i : i + self.sequence_len])
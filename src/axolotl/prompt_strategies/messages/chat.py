@@ -18,6 +18,7 @@ class ChatMessageDatasetWrappingStrategy(DatasetWrappingStrategy):
         processor,
         message_transform=None,
         formatter=None,
+        dict_formatter=None,
         **kwargs,  # pylint: disable=unused-argument
     ):
         """
@@ -28,6 +29,7 @@ class ChatMessageDatasetWrappingStrategy(DatasetWrappingStrategy):
         self.dataset = None
         self.message_transform = message_transform
         self.formatter = formatter
+        self.dict_formatter = dict_formatter
 
     def wrap_dataset(
         self,
@@ -41,6 +43,7 @@ class ChatMessageDatasetWrappingStrategy(DatasetWrappingStrategy):
             message_transform=self.message_transform,
             model_transform=self.processor,
             formatter=self.formatter,
+            dict_formatter=self.dict_formatter,
             process_count=process_count,
             keep_in_memory=keep_in_memory,
         )
@@ -69,16 +72,26 @@ def load(tokenizer, cfg, ds_cfg: Optional[Dict[str, Any]] = None):
     format_message = (
         lambda x: x  # noqa E731  # pylint: disable=unnecessary-lambda-assignment
     )
+    format_message_dict = None
     if chat_template == "chatml":
-        from axolotl.core.chat.format.chatml import format_message  # noqa F811
+        from axolotl.core.chat.format.chatml import (  # noqa F811
+            format_message,
+            format_message_dict,
+        )
     if chat_template.startswith("llama3"):
-        from axolotl.core.chat.format.llama3x import format_message  # noqa F811
+        from axolotl.core.chat.format.llama3x import (  # noqa F811
+            format_message,
+            format_message_dict,
+        )
     message_transform: Callable = chat_message_transform_builder(
         train_on_inputs=ds_cfg.get("train_on_inputs", False),
         **builder_kwargs,
     )
     strategy = ChatMessageDatasetWrappingStrategy(
-        tokenizer, message_transform=message_transform, formatter=format_message
+        tokenizer,
+        message_transform=message_transform,
+        formatter=format_message,
+        dict_formatter=format_message_dict,
     )
 
     return strategy
@@ -2,7 +2,8 @@
 
 import abc
 import logging
-from typing import Dict, List, Tuple, Union
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple, Union
 
 from transformers import BatchEncoding, PreTrainedTokenizer
 
@@ -57,39 +58,80 @@ class PromptTokenizingStrategy(abc.ABC):
     def supports_batched(self):
         return False
 
+    @property
+    def map_batch_size(self):
+        # rows per batch when mapping with `tokenize_prompt_batched`
+        return 100
+
+    def tokenize_prompt_batched(self, prompts: Dict[str, List]) -> Dict[str, List]:
+        """
+        Tokenize a batch of prompts given as a dict of lists into a dict of lists.
+        Strategies that only support batching through `tokenize_prompt` use it as is.
+        """
+        return self.tokenize_prompt(prompts)
+
     def _tokenize(
         self, prompt: str, add_eos_token: bool = True, strip_bos_token: bool = False
     ) -> BatchEncoding:
-        empty = BatchEncoding(data={"input_ids": [], "attention_mask": []})
-        if not prompt:
+        return self._tokenize_batch(
+            [prompt], add_eos_token=add_eos_token, strip_bos_token=strip_bos_token
+        )[0]
+
+    def _tokenize_batch(
+        self,
+        prompts: List[str],
+        add_eos_token: bool = True,
+        strip_bos_token: bool = False,
+    ) -> List[BatchEncoding]:
+        """
+        Tokenize a list of prompts with a single tokenizer call, post-processing each
+        result the same way `_tokenize` does for a single prompt.
+        """
+        results = [
+            BatchEncoding(data={"input_ids": [], "attention_mask": []}) for _ in prompts
+        ]
+        non_empty = [idx for idx, prompt in enumerate(prompts) if prompt]
+        if len(non_empty) < len(prompts):
             LOG.warning("Empty text requested for tokenization.")
-            return empty
+        if not non_empty:
+            return results
 
-        result = self.tokenizer(
-            prompt,
+        batch = self.tokenizer(
+            [prompts[idx] for idx in non_empty],
             truncation=True,
             max_length=self.max_length,
             padding=False,
             return_tensors=None,
         )
-        if len(result["input_ids"]) == 0:
-            LOG.warning("Tokenizer result is empty. You may want to audit your dataset")
-            return empty
+        for batch_idx, idx in enumerate(non_empty):
+            result = BatchEncoding(
+                data={key: values[batch_idx] for key, values in batch.items()}
+            )
+            if len(result["input_ids"]) == 0:
+                LOG.warning(
+                    "Tokenizer result is empty. You may want to audit your dataset"
+                )
+                continue
 
-        if (
-            result["input_ids"][-1] != self.tokenizer.eos_token_id
-            and len(result["input_ids"]) < self.max_length
-            and add_eos_token
-        ):
-            result["input_ids"].append(self.tokenizer.eos_token_id)
-            result["attention_mask"].append(1)
+            if (
+                result["input_ids"][-1] != self.tokenizer.eos_token_id
+                and len(result["input_ids"]) < self.max_length
+                and add_eos_token
+            ):
+                result["input_ids"].append(self.tokenizer.eos_token_id)
+                result["attention_mask"].append(1)
 
-        if result["input_ids"][0] == self.tokenizer.bos_token_id and strip_bos_token:
-            result["input_ids"] = result["input_ids"][1:]
-            result["attention_mask"] = result["attention_mask"][1:]
+            if (
+                result["input_ids"][0] == self.tokenizer.bos_token_id
+                and strip_bos_token
+            ):
+                result["input_ids"] = result["input_ids"][1:]
+                result["attention_mask"] = result["attention_mask"][1:]
 
-        result["labels"] = result["input_ids"].copy()
-        return result
+            result["labels"] = result["input_ids"].copy()
+            results[idx] = result
+
+        return results
 
 
 class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
@@ -102,7 +144,51 @@ class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
     ) -> Union[Tuple[str, str, str], Tuple[str, str, str, str]]:
         raise NotImplementedError
 
+    @property
+    def supports_batched(self):
+        # subclasses customizing per-row tokenization are mapped row by row
+        return (
+            type(self).tokenize_prompt
+            is InstructionPromptTokenizingStrategy.tokenize_prompt
+            and type(self)._tokenize is PromptTokenizingStrategy._tokenize
+        )
+
     def tokenize_prompt(self, prompt):
+        user_prompt, response = self._build_user_prompt_and_response(prompt)
+        tokenized_prompt = self._tokenize(user_prompt, add_eos_token=False)
+        tokenized_res_prompt = self._tokenize(
+            response, strip_bos_token=True, add_eos_token=True
+        )
+        return self._join_prompt_and_response(tokenized_prompt, tokenized_res_prompt)
+
+    def tokenize_prompt_batched(self, prompts: Dict[str, List]) -> Dict[str, List]:
+        feature_names = list(prompts.keys())
+        user_prompts, responses = [], []
+        for row in zip(*prompts.values()):
+            user_prompt, response = self._build_user_prompt_and_response(
+                dict(zip(feature_names, row))
+            )
+            user_prompts.append(user_prompt)
+            responses.append(response)
+
+        tokenized_prompts = self._tokenize_batch(user_prompts, add_eos_token=False)
+        tokenized_res_prompts = self._tokenize_batch(
+            responses, strip_bos_token=True, add_eos_token=True
+        )
+
+        res: Dict[str, List[Any]] = defaultdict(list)
+        for tokenized_prompt, tokenized_res_prompt in zip(
+            tokenized_prompts, tokenized_res_prompts
+        ):
+            tokenized_prompt = self._join_prompt_and_response(
+                tokenized_prompt, tokenized_res_prompt
+            )
+            for key, val in tokenized_prompt.items():
+                res[key].append(val)
+
+        return dict(res)
+
+    def _build_user_prompt_and_response(self, prompt) -> Tuple[str, str]:
         (
             instruction,
             input,  # pylint: disable=redefined-builtin
@@ -116,14 +202,15 @@ class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
                 )
             )
         )
-        tokenized_prompt = self._tokenize(user_prompt, add_eos_token=False)
+        return user_prompt, response
+
+    def _join_prompt_and_response(
+        self, tokenized_prompt: BatchEncoding, tokenized_res_prompt: BatchEncoding
+    ) -> BatchEncoding:
         if not self.train_on_inputs:
             user_prompt_len = len(tokenized_prompt["input_ids"])
             # TODO this could be sped up using numpy array slicing
             tokenized_prompt["labels"] = [IGNORE_INDEX] * user_prompt_len
-        tokenized_res_prompt = self._tokenize(
-            response, strip_bos_token=True, add_eos_token=True
-        )
         tokenized_prompt["input_ids"] += tokenized_res_prompt["input_ids"]
         tokenized_prompt["attention_mask"] += tokenized_res_prompt["attention_mask"]
         tokenized_prompt["labels"] += tokenized_res_prompt["input_ids"]
@@ -24,6 +24,7 @@ from axolotl.contribs.lgpl.unsloth import (  # pylint: disable = no-name-in-modu
     fix_untrained_tokens,
 )
 from axolotl.logging_config import configure_logging
+from axolotl.utils.data.reference_logps import has_reference_logps
 from axolotl.utils.dict import DictDefault
 from axolotl.utils.freeze import freeze_layers_except
 from axolotl.utils.models import load_model, load_processor, load_tokenizer
@@ -101,7 +102,10 @@ def train(
 
     model_ref = None
     if cfg.rl and cfg.rl != "orpo":
-        if cfg.adapter and not cfg.rl_adapter_ref_model:
+        if has_reference_logps(train_dataset, cfg.rl):
+            LOG.debug("Reference log-probs are cached, not loading model_ref")
+            model_ref = None
+        elif cfg.adapter and not cfg.rl_adapter_ref_model:
             # use built-in trl autounwrap
             LOG.debug("Passing model_ref: None to RL trainer")
             model_ref = None  # explicit setting to None
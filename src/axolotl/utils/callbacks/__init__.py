@@ -2,7 +2,6 @@
 
 from __future__ import annotations
 
-import gc
 import logging
 import math
 import os
@@ -15,7 +14,6 @@ import evaluate
 import numpy as np
 import pandas as pd
 import torch
-import torch.distributed as dist
 import wandb
 from datasets import load_dataset
 from optimum.bettertransformer import BetterTransformer
@@ -35,15 +33,8 @@ from axolotl.utils import is_comet_available, is_mlflow_available
 from axolotl.utils.bench import log_gpu_memory_usage
 from axolotl.utils.callbacks.perplexity import Perplexity
 from axolotl.utils.config.models.input.v0_4_1 import AxolotlInputConfig
-from axolotl.utils.distributed import (
-    barrier,
-    broadcast_dict,
-    gather_scalar_from_all_ranks,
-    get_world_size,
-    is_distributed,
-    is_main_process,
-    zero_first,
-)
+from axolotl.utils.distributed import broadcast_dict, is_main_process, zero_first
+from axolotl.utils.generation import generate_batched
 
 if TYPE_CHECKING:
     from axolotl.core.trainer_builder import AxolotlTrainingArguments
@@ -160,8 +151,52 @@ class LossWatchDogCallback(TrainerCallback):
         return control
 
 
+def bench_answer_logits(trainer: Trainer, batch: Dict[str, torch.Tensor], abcd_idx):
+    """
+    Bench loss and the logits of the answer tokens `abcd_idx` at every row's answer position.
+
+    Only the hidden states predicting a label are projected by the output embeddings, instead
+    of materializing `(batch, seq_len, vocab)` logits to read a few of them.
+    """
+    model = trainer.model
+    inputs = trainer._prepare_inputs(batch)  # pylint: disable=protected-access
+    labels = inputs.pop("labels")
+    output_embeddings = model.get_output_embeddings()
+    captured = {}
+
+    def capture_hidden_states(module, args):  # pylint: disable=unused-argument
+        captured["hidden_states"] = args[0]
+        # let the model project no position at all
+        return (args[0][:, :0],) + args[1:]
+
+    handle = output_embeddings.register_forward_pre_hook(capture_hidden_states)
+    try:
+        with torch.no_grad(), trainer.compute_loss_context_manager():
+            model(**inputs)
+    finally:
+        handle.remove()
+
+    # the hidden state at each position predicts the label at the next one
+    rows, cols = torch.nonzero(labels[:, 1:] != IGNORE_INDEX, as_tuple=True)
+    with torch.no_grad(), trainer.compute_loss_context_manager():
+        logits = output_embeddings(captured["hidden_states"][rows, cols]).float()
+
+    softcap = getattr(model.config, "final_logit_softcapping", None)
+    if softcap:
+        logits = torch.tanh(logits / softcap) * softcap
+    targets = labels[rows, cols + 1]
+    loss = torch.nn.functional.cross_entropy(logits, targets)
+
+    # the first label of each row is the answer, followed by the eos token
+    is_answer = torch.ones_like(rows, dtype=torch.bool)
+    is_answer[1:] = rows[1:] != rows[:-1]
+    abcd = torch.tensor(abcd_idx, device=logits.device)
+    is_abcd = targets[is_answer].unsqueeze(1) == abcd
+    answer_labels = torch.where(is_abcd.any(dim=1), is_abcd.int().argmax(dim=1), -1)
+    return loss, logits[is_answer][:, abcd], answer_labels
+
+
 def bench_eval_callback_factory(trainer, tokenizer):
-    accuracy = evaluate.load("accuracy")
     abcd_idx = [
         tokenizer("A", add_special_tokens=False).input_ids[0],
         tokenizer("B", add_special_tokens=False).input_ids[0],
@@ -254,6 +289,12 @@ def bench_eval_callback_factory(trainer, tokenizer):
     with zero_first(is_main_process()):
         bench_dataset = bench_dataset.map(tokenize_evals)
         bench_dataset = bench_dataset.filter(lambda x: x["labels"][-2] in abcd_idx)
+    bench_names = bench_dataset["name"]
+    subjects = sorted(set(bench_names))
+    # batched alongside the inputs, so they line up with the rows the loader yields
+    bench_dataset = bench_dataset.add_column(
+        "subject_id", [subjects.index(name) for name in bench_names]
+    )
 
     class BenchEvalCallback(TrainerCallback):
         """
@@ -272,89 +313,55 @@ def bench_eval_callback_factory(trainer, tokenizer):
                 bench_dataset.remove_columns(["input", "subject", "output", "name"])
             )
             trainer.model.eval()
-            preds, refs = [], []
+            preds, refs, subject_ids = [], [], []
             loss_bench = 0
             for batch in tqdm(data_loader, total=len(data_loader)):
-                (loss, logits, labels) = trainer.prediction_step(
-                    trainer.model,
-                    batch,
-                    prediction_loss_only=False,
+                subject_ids.append(batch.pop("subject_id"))
+                loss, answer_logits, answer_labels = bench_answer_logits(
+                    trainer, batch, abcd_idx
                 )
-                # There are two tokens, the output, and eos token.
-                for i, logit in enumerate(logits):
-                    label_non_zero_id = (batch["labels"][i] != IGNORE_INDEX).nonzero()[
-                        0
-                    ][0]
-                    logit_abcd = logit[label_non_zero_id - 1][abcd_idx]
-                    preds.append(torch.argmax(logit_abcd).item())
-                labels = labels[labels != IGNORE_INDEX].view(-1, 2)[:, 0]
-                refs += [
-                    abcd_idx.index(label) if label in abcd_idx else -1
-                    for label in labels.tolist()
-                ]
+                preds.append(torch.argmax(answer_logits, dim=-1))
+                refs.append(answer_labels)
                 loss_bench += loss.item()
-            # Extract results by subject.
-            bench_name = bench_dataset["name"]
-            bench_names: dict = {s: {"refs": [], "preds": []} for s in set(bench_name)}
-            for s, p, r in zip(bench_name, preds, refs):  # pylint: disable=invalid-name
-                bench_names[s]["preds"].append(p)
-                bench_names[s]["refs"].append(r)
-            barrier()
-            local_bench_names = bench_names
-            gathered_bench_names: List[Dict] = [{} for _ in range(get_world_size())]
-            # Gather results from all GPUs to GPU 0
-
-            loss_bench_ranks = gather_scalar_from_all_ranks(
-                lambda: loss_bench, get_world_size()
+
+            # tally correct answers per subject, then sum the tallies over all ranks
+            preds, refs = torch.cat(preds), torch.cat(refs)
+            subject_ids = torch.cat(subject_ids).to(preds.device)
+            correct = torch.bincount(
+                subject_ids, weights=(preds == refs).float(), minlength=len(subjects)
             )
-            len_data_loader_ranks = gather_scalar_from_all_ranks(
-                lambda: len(data_loader), get_world_size()
+            total = torch.bincount(subject_ids, minlength=len(subjects)).float()
+            tallies = torch.cat(
+                [
+                    correct,
+                    total,
+                    torch.tensor(
+                        [loss_bench, len(data_loader)],
+                        dtype=torch.float,
+                        device=preds.device,
+                    ),
+                ]
             )
+            correct, total, (loss_sum, num_batches) = trainer.accelerator.reduce(
+                tallies, reduction="sum"
+            ).split([len(subjects), len(subjects), 2])
 
             results = {}
-            if is_distributed() and not is_main_process():
-                dist.gather_object(local_bench_names, dst=0)
-            else:
-                if is_distributed():
-                    dist.gather_object(local_bench_names, gathered_bench_names, dst=0)
-                else:
-                    gathered_bench_names = [local_bench_names]
-                bench_loss = sum(loss_bench_ranks) / sum(len_data_loader_ranks)
-                results = {f"{bench_split}_bench_loss": bench_loss}
-
-                # Combine results from all GPUs
-                combined_bench_names: Dict[str, Dict[str, List]] = {}
-                for bench_name in gathered_bench_names:
-                    for name, data in bench_name.items():
-                        if name not in combined_bench_names:
-                            combined_bench_names[name] = {"refs": [], "preds": []}
-                        combined_bench_names[name]["refs"].extend(data["refs"])
-                        combined_bench_names[name]["preds"].extend(data["preds"])
-
+            if is_main_process():
+                results = {f"{bench_split}_bench_loss": (loss_sum / num_batches).item()}
                 bench_scores = []
-                bench_refs = []
-                bench_preds = []
-                for (
-                    bench_name
-                ) in combined_bench_names:  # pylint: disable=consider-using-dict-items
-                    bench_score = accuracy.compute(
-                        references=combined_bench_names[bench_name]["refs"],
-                        predictions=combined_bench_names[bench_name]["preds"],
-                    )["accuracy"]
-                    bench_refs.extend(combined_bench_names[bench_name]["refs"])
-                    bench_preds.extend(combined_bench_names[bench_name]["preds"])
-                    if not pd.isna(bench_score):
-                        results[
-                            f"{bench_split}_bench_accuracy_{bench_name}"
-                        ] = bench_score
-                        bench_scores.append(bench_score)
-                    else:
-                        results[f"{bench_split}_bench_accuracy_{bench_name}"] = 0.0
-                        bench_scores.append(0.0)
+                for subject, subject_correct, subject_total in zip(
+                    subjects, correct.tolist(), total.tolist()
+                ):
+                    bench_score = (
+                        subject_correct / subject_total if subject_total else 0.0
+                    )
+                    results[f"{bench_split}_bench_accuracy_{subject}"] = bench_score
+                    bench_scores.append(bench_score)
                 results[f"{bench_split}_bench_average_accuracy"] = np.mean(bench_scores)
-                results[f"{bench_split}_bench_total_accuracy"] = accuracy.compute(
-                    references=bench_refs, predictions=bench_preds
-                )["accuracy"]
+                results[f"{bench_split}_bench_total_accuracy"] = (
+                    correct.sum() / total.sum()
+                ).item()
                 trainer.log(results)
 
             results = broadcast_dict(results)
@@ -476,95 +483,69 @@ def causal_lm_bench_eval_callback_factory(trainer: Trainer, tokenizer):
                 return scores
 
             def predict_with_generate():
-                eval_src, eval_pred, eval_ref = [], [], []
-
-                with unwrap_model_for_generation(
-                    trainer.model_wrapped, trainer.accelerator
-                ) as unwrapped_model:
-                    for batch in tqdm(eval_dataloader, disable=not is_main_process()):
-                        batch_labels = batch["labels"].to(device)
-                        batch_input_ids = batch["input_ids"].to(device)
+                prompt_token_ids_list = []
+                completion_token_ids_list = []
+                for batch in eval_dataloader:
+                    if "position_ids" in batch:
+                        batch_pos_ids = batch["position_ids"].tolist()
+                    else:
+                        batch_pos_ids = [None] * len(batch["input_ids"])
 
-                        if "position_ids" in batch:
-                            batch_pos_ids = batch["position_ids"].tolist()
+                    for input_ids_all, labels_all, pos_ids in zip(
+                        batch["input_ids"],
+                        batch["labels"],
+                        batch_pos_ids,
+                    ):
+                        if pos_ids is None:
+                            pos_ranges = [(0, len(input_ids_all) - 1)]
                         else:
-                            batch_pos_ids = [None] * len(batch["input_ids"])
-
-                        prompt_token_ids_list = []
-                        completion_token_ids_list = []
-
-                        for input_ids_all, labels_all, pos_ids in zip(
-                            batch_input_ids,
-                            batch_labels,
-                            batch_pos_ids,
-                        ):
-                            if pos_ids is None:
-                                pos_ranges = [(0, len(input_ids_all) - 1)]
-                            else:
-                                pos_ranges = find_ranges(pos_ids)
-
-                            for pos_range in pos_ranges:
-                                start, end = pos_range
-                                if start == end:
-                                    continue
-
-                                input_ids = input_ids_all[start : end + 1]
-                                labels = labels_all[start : end + 1]
-
-                                tokens_without_loss = labels == IGNORE_INDEX
-                                tokens_with_loss = labels != IGNORE_INDEX
-                                tokens_exclude_padding = (
-                                    input_ids != tokenizer.pad_token_id
-                                )
-                                prompt_token_includes = (
-                                    tokens_without_loss & tokens_exclude_padding
-                                )
-
-                                prompt_token_ids = input_ids[prompt_token_includes]
-                                prompt_token_ids_list.append(prompt_token_ids)
-
-                                completion_token_ids = input_ids[tokens_with_loss]
-                                completion_token_ids_list.append(completion_token_ids)
-
-                        prompt_texts = tokenizer.batch_decode(
-                            prompt_token_ids_list, skip_special_tokens=True
-                        )
-                        completion_texts = tokenizer.batch_decode(
-                            completion_token_ids_list, skip_special_tokens=True
-                        )
+                            pos_ranges = find_ranges(pos_ids)
 
-                        with torch.no_grad():
-                            prompt_encoding = tokenizer(
-                                prompt_texts, padding=True, return_tensors="pt"
-                            ).to(device)
+                        for pos_range in pos_ranges:
+                            start, end = pos_range
+                            if start == end:
+                                continue
 
-                            predictions = unwrapped_model.generate(
-                                **prompt_encoding, generation_config=generation_config
-                            )
+                            input_ids = input_ids_all[start : end + 1]
+                            labels = labels_all[start : end + 1]
 
-                            del prompt_encoding
-
-                        prediction_all_tokens = predictions["sequences"].cpu().tolist()
-                        prediction_without_prompt_tokens_list = []
-                        for prompt_token_ids, prediction_tokens in zip(
-                            prompt_token_ids_list, prediction_all_tokens
-                        ):
-                            prediction_without_prompt_tokens = prediction_tokens[
-                                len(prompt_token_ids) :
-                            ]
-                            prediction_without_prompt_tokens_list.append(
-                                prediction_without_prompt_tokens
+                            tokens_without_loss = labels == IGNORE_INDEX
+                            tokens_with_loss = labels != IGNORE_INDEX
+                            tokens_exclude_padding = input_ids != tokenizer.pad_token_id
+                            prompt_token_includes = (
+                                tokens_without_loss & tokens_exclude_padding
                             )
 
-                        predicted_texts = tokenizer.batch_decode(
-                            prediction_without_prompt_tokens_list,
-                            skip_special_tokens=True,
-                        )
+                            prompt_token_ids_list.append(
+                                input_ids[prompt_token_includes].tolist()
+                            )
+                            completion_token_ids_list.append(
+                                input_ids[tokens_with_loss].tolist()
+                            )
 
-                        eval_src.extend(prompt_texts)
-                        eval_pred.extend(predicted_texts)
-                        eval_ref.extend(completion_texts)
+                # generate from the prompt token ids directly, in length buckets
+                with unwrap_model_for_generation(
+                    trainer.model_wrapped, trainer.accelerator
+                ) as unwrapped_model:
+                    predicted_token_ids_list = generate_batched(
+                        unwrapped_model,
+                        prompt_token_ids_list,
+                        generation_config,
+                        pad_token_id=tokenizer.pad_token_id,
+                        max_tokens=self.cfg.eval_generation_max_tokens,
+                        device=device,
+                        show_progress=is_main_process(),
+                    )
 
+                eval_src = tokenizer.batch_decode(
+                    prompt_token_ids_list, skip_special_tokens=True
+                )
+                eval_pred = tokenizer.batch_decode(
+                    predicted_token_ids_list, skip_special_tokens=True
+                )
+                eval_ref = tokenizer.batch_decode(
+                    completion_token_ids_list, skip_special_tokens=True
+                )
                 return eval_src, eval_pred, eval_ref
 
             eval_preds = predict_with_generate()
@@ -843,17 +824,3 @@ class SaveModelCallback(TrainerCallback):
     ):
         control.should_save = True
         return control
-
-
-class GCCallback(TrainerCallback):
-    """Callback to garbage collect torch cache"""
-
-    def __init__(self, gc_steps=None):
-        self.gc_steps = gc_steps
-
-    def on_step_end(
-        self, args, state, control, **kwargs  # pylint: disable=unused-argument
-    ):
-        if state.global_step % self.gc_steps == 0:
-            torch.cuda.empty_cache()
-            gc.collect()
@@ -0,0 +1,133 @@
+"""
+HF Trainer callback releasing python garbage and cached CUDA memory under memory pressure,
+rather than on every step
+"""
+import gc
+import logging
+import time
+
+import torch
+from transformers import (
+    Trainer,
+    TrainerCallback,
+    TrainerControl,
+    TrainerState,
+    TrainingArguments,
+)
+
+LOG = logging.getLogger("axolotl.callbacks")
+
+
+class MemoryManagerCallback(TrainerCallback):
+    """
+    Collect garbage and empty the CUDA cache only when the allocator holds most of the device
+    memory and a large part of it is cached but unallocated, so the caching allocator keeps
+    its blocks otherwise. Long-lived objects are frozen when training starts, so collections
+    only traverse the objects created while training.
+
+    The time spent is added to the trainer's logged metrics.
+    """
+
+    def __init__(self, cfg, trainer: Trainer):
+        self.trainer = trainer
+        self.gc_steps = cfg.gc_steps
+        self.gc_freeze = cfg.gc_freeze is not False
+        # fraction of the device memory reserved by the allocator
+        self.memory_pressure = cfg.gc_memory_pressure or 0.9
+        # fraction of the reserved memory cached but not allocated
+        self.fragmentation = cfg.gc_fragmentation or 0.25
+        self.total_memory = (
+            torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+            if torch.cuda.is_available()
+            else 0
+        )
+        # consecutive steps under memory pressure, escalating to older generations
+        self.pressure_steps = 0
+        self.stats = {"gc_seconds": 0.0, "empty_cache_seconds": 0.0, "releases": 0}
+        self.total_stats = dict(self.stats)
+
+    def _under_pressure(self) -> bool:
+        if not self.total_memory:
+            return False
+        reserved = torch.cuda.memory_reserved()
+        cached = reserved - torch.cuda.memory_allocated()
+        return (
+            reserved >= self.memory_pressure * self.total_memory
+            and cached >= self.fragmentation * reserved
+        )
+
+    def collect(self, generation: int):
+        start = time.perf_counter()
+        gc.collect(generation)
+        self.stats["gc_seconds"] += time.perf_counter() - start
+
+    def empty_cache(self):
+        start = time.perf_counter()
+        torch.cuda.empty_cache()
+        self.stats["empty_cache_seconds"] += time.perf_counter() - start
+
+    def on_train_begin(  # pylint: disable=unused-argument
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        if self.gc_freeze:
+            # the model, optimizer and datasets are loaded by now and live until the end
+            self.collect(2)
+            gc.freeze()
+            LOG.debug(
+                f"froze {gc.get_freeze_count()} objects out of garbage collection"
+            )
+        return control
+
+    def on_step_end(  # pylint: disable=unused-argument
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        if self._under_pressure():
+            self.pressure_steps += 1
+            # the garbage of the last steps is young, escalate while the pressure stays
+            self.collect(min(self.pressure_steps, 2))
+            self.empty_cache()
+            self.stats["releases"] += 1
+        else:
+            self.pressure_steps = 0
+        if self.gc_steps and state.global_step % self.gc_steps == 0:
+            self.collect(2)
+            self.empty_cache()
+
+        if control.should_log:
+            self._flush_stats(log=True)
+        return control
+
+    def on_train_end(  # pylint: disable=unused-argument
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        if self.gc_freeze:
+            gc.unfreeze()
+        self._flush_stats(log=False)
+        LOG.info(
+            f"memory manager: {self.total_stats['releases']} release(s) under memory "
+            f"pressure, {self.total_stats['gc_seconds']:.2f}s in gc.collect, "
+            f"{self.total_stats['empty_cache_seconds']:.2f}s emptying the CUDA cache"
+        )
+        return control
+
+    def _flush_stats(self, log: bool):
+        for key, value in self.stats.items():
+            self.total_stats[key] += value
+        if log and hasattr(self.trainer, "store_metrics"):
+            self.trainer.store_metrics(
+                {f"memory/{key}": float(value) for key, value in self.stats.items()},
+                train_eval="train",
+            )
+        self.stats = {key: type(value)() for key, value in self.stats.items()}
@@ -1,10 +1,15 @@
 """
-shared axolotl collators for multipack, mamba, multimodal
+shared axolotl collators for multipack, mamba, multimodal, preference
 """
 from .batching import (  # noqa: F401
     BatchSamplerDataCollatorForSeq2Seq,
     DataCollatorForSeq2Seq,
+    PreallocatedBatchSamplerDataCollatorForSeq2Seq,
     PretrainingBatchSamplerDataCollatorForSeq2Seq,
     V2BatchSamplerDataCollatorForSeq2Seq,
 )
 from .mamba import MambaDataCollator  # noqa: F401
+from .preference import (  # noqa: F401
+    PackedPreferenceCollator,
+    ReferenceLogpsPreferenceCollator,
+)
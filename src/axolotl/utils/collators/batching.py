@@ -3,12 +3,16 @@ DataCollator for axolotl to pad labels and position_ids for packed sequences
 """
 
 from dataclasses import dataclass
-from typing import Any, Optional, Union
+from typing import Any, List, Optional, Tuple, Union
 
 import numpy as np
-from transformers import PreTrainedTokenizerBase
+import pyarrow as pa
+import torch
+from transformers import BatchEncoding, PreTrainedTokenizerBase
 from transformers.utils import PaddingStrategy
 
+from axolotl.utils.dataset_stats import list_lengths
+
 
 @dataclass
 class DataCollatorForSeq2Seq:
@@ -180,6 +184,179 @@ class V2BatchSamplerDataCollatorForSeq2Seq(DataCollatorForSeq2Seq):
         return super().__call__(out_features, return_tensors=return_tensors)
 
 
+def packed_cu_seqlens(attention_mask: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+    Cumulative lengths of the samples packed into the rows of a multipack attention mask, in the
+    order of the patched `_get_unpad_data`, and the longest sample.
+    """
+    batch_size = attention_mask.shape[0]
+    max_num = int(attention_mask.max(initial=0))
+    keys = np.arange(batch_size)[:, None] * (max_num + 1) + attention_mask
+    counts = np.bincount(keys.ravel(), minlength=batch_size * (max_num + 1))
+    seqlens = counts.reshape(batch_size, max_num + 1)[:, 1:].ravel()
+    seqlens = seqlens[seqlens != 0]
+    cu_seqlens = np.zeros(len(seqlens) + 1, dtype=np.int32)
+    np.cumsum(seqlens, out=cu_seqlens[1:])
+    return cu_seqlens, int(seqlens.max(initial=0))
+
+
+@dataclass
+class PreallocatedBatchSamplerDataCollatorForSeq2Seq(DataCollatorForSeq2Seq):
+    """
+    Collator for multipack that writes every sample of each bin straight into an int64 buffer of the
+    final padded shape, matching `V2BatchSamplerDataCollatorForSeq2Seq` (or
+    `BatchSamplerDataCollatorForSeq2Seq` without `multipack_attn`) without `tokenizer.pad`.
+    """
+
+    multipack_attn: bool = True
+    precompute_cu_seqlens: bool = False
+
+    def pad_values(self) -> dict:
+        return {
+            "input_ids": self.tokenizer.pad_token_id,
+            "labels": self.label_pad_token_id,
+            "position_ids": self.position_pad_token_id,
+            "attention_mask": 0,
+            "token_type_ids": self.tokenizer.pad_token_type_id,
+        }
+
+    def padded_length(self, longest: int) -> int:
+        length = longest
+        if self.padding in ("max_length", PaddingStrategy.MAX_LENGTH):
+            length = self.max_length or length
+        if self.pad_to_multiple_of is not None:
+            length = (
+                (length + self.pad_to_multiple_of - 1)
+                // self.pad_to_multiple_of
+                * self.pad_to_multiple_of
+            )
+        return length
+
+    def __call__(self, features, return_tensors=None):
+        if return_tensors is None:
+            return_tensors = self.return_tensors
+        if not isinstance(features[0], list):
+            features = [features]
+
+        keys = [key for key in features[0][0].keys() if key != "length"]
+        add_attention_mask = (
+            "attention_mask" not in keys
+            and "attention_mask" in self.tokenizer.model_input_names
+        )
+        bin_lengths = [
+            sum(len(item["input_ids"]) for item in features_) for features_ in features
+        ]
+        width = self.padded_length(max(bin_lengths))
+        right = self.tokenizer.padding_side == "right"
+        pad_values = self.pad_values()
+
+        batch = {}
+        for key in keys + (["attention_mask"] if add_attention_mask else []):
+            buffer = np.full((len(features), width), pad_values.get(key, 0), np.int64)
+            for row, features_ in enumerate(features):
+                pos = 0 if right else width - bin_lengths[row]
+                for idx, item in enumerate(features_):
+                    length = len(item["input_ids"])
+                    if key not in item:
+                        if key == "attention_mask":
+                            # `tokenizer.pad` would attend to every token of the packed row
+                            buffer[row, pos : pos + length] = 1
+                    elif key == "attention_mask" and self.multipack_attn:
+                        buffer[row, pos : pos + length] = item[key]
+                        buffer[row, pos : pos + length] *= idx + 1
+                    else:
+                        buffer[row, pos : pos + length] = item[key]
+                    pos += length
+            batch[key] = buffer
+        return self.to_batch_encoding(batch, return_tensors)
+
+    def collate_arrow(self, table: pa.Table, bin_sizes: List[int], return_tensors=None):
+        """
+        Collate bins of consecutive rows of an Arrow table, copying each bin's tokens from the
+        flat values buffer of every list column in one slice.
+        """
+        if return_tensors is None:
+            return_tensors = self.return_tensors
+        columns = {
+            key: table.column(key).combine_chunks()
+            for key in table.column_names
+            if key != "length"
+        }
+        sample_offsets = np.zeros(table.num_rows + 1, dtype=np.int64)
+        np.cumsum(list_lengths(columns["input_ids"]), out=sample_offsets[1:])
+        bin_offsets = np.zeros(len(bin_sizes) + 1, dtype=np.int64)
+        np.cumsum(bin_sizes, out=bin_offsets[1:])
+        token_offsets = sample_offsets[bin_offsets]
+        bin_lengths = np.diff(token_offsets)
+        width = self.padded_length(int(bin_lengths.max()))
+        right = self.tokenizer.padding_side == "right"
+        pad_values = self.pad_values()
+
+        if (
+            "attention_mask" not in columns
+            and "attention_mask" in self.tokenizer.model_input_names
+        ):
+            columns["attention_mask"] = None
+
+        batch = {}
+        for key, column in columns.items():
+            if column is None:
+                # `tokenizer.pad` would attend to every token of the packed row
+                values = np.ones(sample_offsets[-1], dtype=np.int64)
+            else:
+                values = column.flatten().to_numpy(zero_copy_only=False)
+            if key == "attention_mask" and column is not None and self.multipack_attn:
+                # number samples within their bin, starting at 1
+                sample_idx = np.arange(table.num_rows) - np.repeat(
+                    bin_offsets[:-1], bin_sizes
+                )
+                values = values * np.repeat(sample_idx + 1, np.diff(sample_offsets))
+            buffer = np.full((len(bin_sizes), width), pad_values.get(key, 0), np.int64)
+            for row, length in enumerate(bin_lengths):
+                pos = 0 if right else width - length
+                buffer[row, pos : pos + length] = values[
+                    token_offsets[row] : token_offsets[row + 1]
+                ]
+            batch[key] = buffer
+        return self.to_batch_encoding(batch, return_tensors)
+
+    def supports_arrow(self, table: pa.Table) -> bool:
+        """
+        Whether `collate_arrow` can collate the table, i.e. every column besides `length` is a list
+        column with the same per-row lengths as `input_ids`.
+        """
+        if "input_ids" not in table.column_names:
+            return False
+        lengths = list_lengths(table.column("input_ids"))
+        for key in table.column_names:
+            if key in ("input_ids", "length"):
+                continue
+            if not pa.types.is_list(table.schema.field(key).type) or not np.array_equal(
+                list_lengths(table.column(key)), lengths
+            ):
+                return False
+        return True
+
+    def to_batch_encoding(self, batch: dict, return_tensors: str) -> BatchEncoding:
+        if self.precompute_cu_seqlens and "attention_mask" in batch:
+            cu_seqlens, max_seqlen = packed_cu_seqlens(batch["attention_mask"])
+            batch["cu_seqlens"] = cu_seqlens
+        if return_tensors == "pt":
+            batch = {key: torch.from_numpy(val) for key, val in batch.items()}
+        if (
+            "labels" in batch
+            and self.model is not None
+            and hasattr(self.model, "prepare_decoder_input_ids_from_labels")
+        ):
+            batch[
+                "decoder_input_ids"
+            ] = self.model.prepare_decoder_input_ids_from_labels(labels=batch["labels"])
+        if "cu_seqlens" in batch:
+            # a python int, so moving the batch to the device does not make it a tensor
+            batch["max_seqlen"] = max_seqlen
+        return BatchEncoding(batch)
+
+
 @dataclass
 class PretrainingBatchSamplerDataCollatorForSeq2Seq(DataCollatorForSeq2Seq):
     """
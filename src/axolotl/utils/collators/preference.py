@@ -0,0 +1,131 @@
+"""
+collators for preference datasets
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from trl.trainer.dpo_trainer import PreferenceCollator
+
+from axolotl.common.const import DPO_REFERENCE_LOGPS_COLUMNS
+from axolotl.utils.preference_packing import (
+    CHOSEN_SEGMENT,
+    PAD_SEGMENT,
+    PROMPT_SEGMENT,
+    REJECTED_SEGMENT,
+)
+
+
+@dataclass
+class ReferenceLogpsPreferenceCollator(PreferenceCollator):
+    """
+    Pad preference rows like trl's `PreferenceCollator`, also collating the precomputed
+    reference model log-probs of the rows, which it drops.
+    """
+
+    def torch_call(self, examples: List[Dict[str, Any]]) -> Dict[str, Any]:
+        output = super().torch_call(examples)
+        for key in DPO_REFERENCE_LOGPS_COLUMNS:
+            if key in examples[0]:
+                output[key] = torch.tensor(
+                    [example[key] for example in examples], dtype=torch.float32
+                )
+        return output
+
+
+def _pack_preference_row(
+    prompt: List[int],
+    chosen: List[int],
+    rejected: List[int],
+    offset: int,
+) -> Dict[str, np.ndarray]:
+    # lay out prompt, chosen, rejected, both responses continuing the prompt's positions
+    num_prompt, num_chosen, num_rejected = len(prompt), len(chosen), len(rejected)
+    chosen_positions = np.arange(num_prompt, num_prompt + num_chosen)
+    rejected_positions = np.arange(num_prompt, num_prompt + num_rejected)
+    # the logits predicting each response token, the first ones read the last prompt token
+    chosen_logits = offset + chosen_positions - 1
+    rejected_logits = offset + num_chosen + rejected_positions - 1
+    if num_rejected:
+        rejected_logits[0] = offset + num_prompt - 1
+    if not num_prompt:
+        chosen_logits[:1] = -1
+        rejected_logits[:1] = -1
+    return {
+        "input_ids": np.concatenate([prompt, chosen, rejected]),
+        "position_ids": np.concatenate(
+            [np.arange(num_prompt), chosen_positions, rejected_positions]
+        ),
+        "segment_ids": np.repeat(
+            [PROMPT_SEGMENT, CHOSEN_SEGMENT, REJECTED_SEGMENT],
+            [num_prompt, num_chosen, num_rejected],
+        ),
+        "logits_positions": np.concatenate(
+            [np.full(num_prompt, -1), chosen_logits, rejected_logits]
+        ),
+    }
+
+
+@dataclass
+class PackedPreferenceCollator:
+    """
+    Pack tokenized preference rows into sequences of prompt, chosen and rejected tokens, so
+    the prompt is only run once, along with the sequence and segment ids masking attention
+    between the two responses, and the positions of the logits predicting them.
+
+    Takes the bins of a `MultipackBatchSampler`, or a plain batch with one row per sequence.
+    """
+
+    pad_token_id: int
+    # truncate prompt + response to this length, like trl does for unpacked rows
+    max_length: Optional[int] = None
+
+    def __call__(self, features: List[Any]) -> Dict[str, torch.Tensor]:
+        if not isinstance(features[0], list):
+            features = [[feature] for feature in features]
+
+        packed: List[Dict[str, np.ndarray]] = []
+        ref_logps: Dict[str, List[float]] = {}
+        sequence_id = 0
+        for bin_ in features:
+            parts: Dict[str, List[np.ndarray]] = {}
+            offset = 0
+            for feature in bin_:
+                prompt = feature["prompt_input_ids"]
+                chosen, rejected = (
+                    feature["chosen_input_ids"],
+                    feature["rejected_input_ids"],
+                )
+                if self.max_length is not None:
+                    max_response_len = max(self.max_length - len(prompt), 0)
+                    chosen = chosen[:max_response_len]
+                    rejected = rejected[:max_response_len]
+                row = _pack_preference_row(prompt, chosen, rejected, offset)
+                row["sequence_ids"] = np.full(len(row["input_ids"]), sequence_id)
+                for key, value in row.items():
+                    parts.setdefault(key, []).append(value)
+                for key in DPO_REFERENCE_LOGPS_COLUMNS:
+                    if key in feature:
+                        ref_logps.setdefault(key, []).append(feature[key])
+                offset += len(row["input_ids"])
+                sequence_id += 1
+            packed.append({key: np.concatenate(value) for key, value in parts.items()})
+
+        width = max(len(row["input_ids"]) for row in packed)
+        pad_values = {
+            "input_ids": self.pad_token_id,
+            "position_ids": 0,
+            "sequence_ids": -1,
+            "segment_ids": PAD_SEGMENT,
+            "logits_positions": -1,
+        }
+        output = {}
+        for key, pad_value in pad_values.items():
+            batch = np.full((len(packed), width), pad_value, dtype=np.int64)
+            for idx, row in enumerate(packed):
+                batch[idx, : len(row[key])] = row[key]
+            output[key] = torch.from_numpy(batch)
+        for key, values in ref_logps.items():
+            output[key] = torch.tensor(values, dtype=torch.float32)
+        return output
@@ -70,6 +70,14 @@ def normalize_config(cfg):
     cfg.local_rank = int(os.environ.get("LOCAL_RANK", 0))
     cfg.eval_table_size = cfg.eval_table_size or 0
     cfg.eval_max_new_tokens = cfg.eval_max_new_tokens or 128
+    # by default, no more tokens in flight than a full eval batch plus its generations
+    cfg.eval_generation_max_tokens = cfg.eval_generation_max_tokens or (
+        cfg.eval_batch_size * ((cfg.sequence_len or 512) + cfg.eval_max_new_tokens)
+    )
+    # reference log-probs need no gradients, so batch several micro batches worth of tokens
+    cfg.reference_logps_max_tokens = cfg.reference_logps_max_tokens or (
+        8 * cfg.micro_batch_size * (cfg.sequence_len or 512)
+    )
     cfg.eval_causal_lm_metrics = cfg.eval_causal_lm_metrics or [
         "sacrebleu",
         "comet",
@@ -128,6 +128,8 @@ class PretrainingDataset(BaseModel):
     text_column: Optional[str] = "text"
     type: Optional[str] = "pretrain"
     trust_remote_code: Optional[bool] = False
+    weight: Optional[float] = None
+    final_weight: Optional[float] = None
 
 
 class UserDefinedPrompterType(BaseModel):
@@ -179,6 +181,7 @@ class SFTDataset(BaseModel):
     train_on_eos: Optional[str] = None
     roles: Optional[Dict[str, List[str]]] = None
     drop_system_message: Optional[bool] = None
+    single_pass_turns: Optional[bool] = None
     trust_remote_code: Optional[bool] = False
     revision: Optional[str] = None
 
@@ -319,6 +322,8 @@ class LoraConfig(BaseModel):
     )
 
     merge_lora: Optional[bool] = None
+    merge_lora_streaming: Optional[bool] = None
+    merge_lora_num_workers: Optional[int] = None
 
     @model_validator(mode="before")
     @classmethod
@@ -607,6 +612,10 @@ class AxolotlInputConfig(
     mean_resizing_embeddings: Optional[bool] = False
 
     rl: Optional[RLType] = None
+    rl_pretokenize: Optional[bool] = None
+    precompute_reference_logps: Optional[bool] = None
+    reference_logps_max_tokens: Optional[int] = None
+    rl_sample_packing: Optional[bool] = None
     reward_model: Optional[bool] = None
     dpo_use_weighting: Optional[
         bool
@@ -616,6 +625,8 @@ class AxolotlInputConfig(
     test_datasets: Optional[conlist(Union[SFTDataset, DPODataset, KTODataset], min_length=1)] = None  # type: ignore
     shuffle_merged_datasets: Optional[bool] = True
     dataset_prepared_path: Optional[str] = None
+    dataset_prepared_cache_per_source: Optional[bool] = None
+    dataset_sharded_preprocessing: Optional[bool] = None
     dataset_shard_num: Optional[int] = None
     dataset_shard_idx: Optional[int] = None
     skip_prepare_dataset: Optional[bool] = False
@@ -626,8 +637,14 @@ class AxolotlInputConfig(
         default=None,
         json_schema_extra={"description": "streaming dataset to use for pretraining"},
     )
+    pretraining_mixture_temperature: Optional[float] = None
     dataset_processes: Optional[int] = Field(default=os.cpu_count())
     dataset_exact_deduplication: Optional[bool] = None
+    dataset_near_deduplication: Optional[bool] = None
+    dataset_near_dedup_threshold: Optional[float] = 0.8
+    dataset_near_dedup_num_perm: Optional[int] = 128
+    dataset_near_dedup_ngram_size: Optional[int] = 5
+    dataset_near_dedup_max_entries: Optional[int] = 1_000_000
     dataset_keep_in_memory: Optional[bool] = None
     dataloader_pin_memory: Optional[bool] = None
     dataloader_num_workers: Optional[int] = None
@@ -655,6 +672,9 @@ class AxolotlInputConfig(
 
     eval_table_size: Optional[int] = None
     eval_max_new_tokens: Optional[int] = None
+    eval_generation_max_tokens: Optional[int] = None
+    inference_max_new_tokens: Optional[int] = None
+    inference_max_tokens: Optional[int] = None
     do_causal_lm_eval: Optional[bool] = None
     eval_causal_lm_metrics: Optional[List[str]] = None
     do_bench_eval: Optional[bool] = None
@@ -667,6 +687,9 @@ class AxolotlInputConfig(
     loss_watchdog_patience: Optional[int] = None
 
     gc_steps: Optional[int] = None
+    gc_freeze: Optional[bool] = None
+    gc_memory_pressure: Optional[float] = None
+    gc_fragmentation: Optional[float] = None
 
     bf16: Optional[Union[Literal["auto"], bool]] = "auto"
     fp16: Optional[bool] = None
@@ -693,6 +716,8 @@ class AxolotlInputConfig(
     sample_packing: Optional[bool] = None
     sample_packing_group_size: Optional[int] = 100_000
     sample_packing_bin_size: Optional[int] = 200
+    sample_packing_preallocated_collator: Optional[bool] = None
+    sample_packing_precompute_cu_seqlens: Optional[bool] = None
     eval_sample_packing: Optional[bool] = None
     pad_to_sequence_len: Optional[bool] = None
     curriculum_sampling: Optional[bool] = None
@@ -736,6 +761,7 @@ class AxolotlInputConfig(
     deepspeed: Optional[Union[str, Dict[str, Any]]] = None
     fsdp: Optional[List[str]] = None
     fsdp_config: Optional[Dict[str, Any]] = None
+    fsdp_merge_num_workers: Optional[int] = None
     fsdp_final_state_dict_type: Optional[
         Literal["FULL_STATE_DICT", "LOCAL_STATE_DICT", "SHARDED_STATE_DICT"]
     ] = None
@@ -849,6 +875,20 @@ class AxolotlInputConfig(
             )
         return data
 
+    @model_validator(mode="before")
+    @classmethod
+    def check_pretraining_mixture_weights(cls, data):
+        for ds_cfg in data.get("pretraining_dataset") or []:
+            if not isinstance(ds_cfg, dict):
+                continue
+            for key in ("weight", "final_weight"):
+                if ds_cfg.get(key) is not None and ds_cfg[key] < 0:
+                    raise ValueError(f"pretraining_dataset {key} must be non-negative")
+        temperature = data.get("pretraining_mixture_temperature")
+        if temperature is not None and temperature <= 0:
+            raise ValueError("pretraining_mixture_temperature must be positive")
+        return data
+
     @model_validator(mode="before")
     @classmethod
     def check_pretraining_w_group_by_length(cls, data):
@@ -876,6 +916,17 @@ class AxolotlInputConfig(
                     data["accelerator_config"]["dispatch_batches"] = False
         return data
 
+    @model_validator(mode="before")
+    @classmethod
+    def check_sharded_preprocessing_w_prepared_path(cls, data):
+        if data.get("dataset_sharded_preprocessing") and not data.get(
+            "dataset_prepared_path"
+        ):
+            raise ValueError(
+                "dataset_sharded_preprocessing requires a dataset_prepared_path shared by all ranks"
+            )
+        return data
+
     @model_validator(mode="before")
     @classmethod
     def check_gptq_w_revision(cls, data):
@@ -1207,6 +1258,13 @@ class AxolotlInputConfig(
             raise ValueError("neftune_noise_alpha must be > 0.0")
         return neftune_noise_alpha
 
+    @field_validator("gc_memory_pressure", "gc_fragmentation")
+    @classmethod
+    def validate_gc_fraction(cls, value, info):
+        if value is not None and not 0.0 < value <= 1.0:
+            raise ValueError(f"{info.field_name} must be in (0, 1]")
+        return value
+
     @model_validator(mode="after")
     def check_rl_beta(self):
         if self.dpo_beta and not self.rl_beta:
@@ -1525,6 +1583,42 @@ class AxolotlInputConfig(
 
         return data
 
+    @model_validator(mode="before")
+    @classmethod
+    def check_precompute_reference_logps(cls, data):
+        if data.get("precompute_reference_logps") and data.get("rl") not in [
+            "dpo",
+            "ipo",
+            "kto",
+        ]:
+            raise ValueError(
+                "precompute_reference_logps is only supported with dpo, ipo and kto"
+            )
+        return data
+
+    @model_validator(mode="before")
+    @classmethod
+    def check_rl_pretokenize(cls, data):
+        if data.get("rl_pretokenize") and data.get("rl") not in ["dpo", "ipo", "kto"]:
+            raise ValueError("rl_pretokenize is only supported with dpo, ipo and kto")
+        return data
+
+    @model_validator(mode="before")
+    @classmethod
+    def check_rl_sample_packing(cls, data):
+        if not data.get("rl_sample_packing"):
+            return data
+        if data.get("rl") not in ["dpo", "ipo"]:
+            raise ValueError("rl_sample_packing is only supported with dpo and ipo")
+        if data.get("flash_attention") or data.get("xformers_attention"):
+            raise ValueError(
+                "rl_sample_packing masks attention between the responses with a 4D mask, "
+                "use sdp_attention or eager attention instead"
+            )
+        if data.get("dpo_use_weighting"):
+            raise ValueError("rl_sample_packing does not support dpo_use_weighting")
+        return data
+
 
 class AxolotlConfigWCapabilities(AxolotlInputConfig):
     """wrapper to valdiate gpu capabilities with the configured options"""
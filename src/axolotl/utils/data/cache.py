@@ -0,0 +1,229 @@
+"""per-source prepared dataset cache and eviction helpers"""
+import json
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+from datasets import Dataset, concatenate_datasets, load_from_disk
+from transformers import PreTrainedTokenizerBase
+
+from axolotl.common.const import PACKING_PLANS_DIR
+from axolotl.utils.data.utils import md5
+from axolotl.utils.dict import DictDefault
+
+LOG = logging.getLogger("axolotl")
+
+# subdirectory of the prepared path holding one tokenized dataset per source
+PREPARED_SOURCES_DIR = "sources"
+# subdirectory of the prepared path holding reference model log-probs of RL datasets
+REFERENCE_LOGPS_DIR = "reference_logps"
+
+# top-level config fields that change how a single source dataset is tokenized
+SOURCE_HASH_CFG_KEYS = [
+    "sequence_len",
+    "train_on_inputs",
+    "chat_template",
+    "chat_template_jinja",
+    "default_system_message",
+    "processor_type",
+    "skip_prepare_dataset",
+]
+
+
+@dataclass
+class PreparedCacheStats:
+    """
+    Hit and miss counts for the per-source prepared dataset cache
+    """
+
+    hits: List[str] = field(default_factory=list)
+    misses: List[str] = field(default_factory=list)
+
+    def log_summary(self):
+        LOG.info(
+            f"Prepared dataset cache: {len(self.hits)} hit(s), {len(self.misses)} miss(es)"
+        )
+        for path in self.misses:
+            LOG.debug(f"Prepared dataset cache miss: {path}")
+
+
+def get_tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    """
+    Hash what the tokenizer produces rather than where it was loaded from, so that a changed
+    vocab, added special tokens or chat template invalidate prepared datasets.
+    """
+    if tokenizer.is_fast:
+        # covers the vocab, merges, normalizer, pre/post processors and added tokens
+        backend_state = json.loads(tokenizer.backend_tokenizer.to_str())
+        # truncation/padding are runtime settings left behind by earlier tokenizer calls
+        backend_state.pop("truncation", None)
+        backend_state.pop("padding", None)
+        backend = json.dumps(backend_state, sort_keys=True)
+    else:
+        backend = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    to_hash = json.dumps(
+        {
+            "class": type(tokenizer).__name__,
+            "backend": md5(backend),
+            "added_tokens": {
+                idx: repr(token)
+                for idx, token in tokenizer.added_tokens_decoder.items()
+            },
+            "special_tokens": tokenizer.special_tokens_map,
+            "chat_template": tokenizer.chat_template,
+            "padding_side": tokenizer.padding_side,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return md5(to_hash)
+
+
+def get_source_dataset_hash(
+    cfg: DictDefault, config_dataset: DictDefault, dataset: Dataset, tokenizer_hash: str
+) -> str:
+    """
+    Key a single source dataset by the fingerprint of its raw rows, its dataset config,
+    the tokenizer and the top-level config fields affecting its tokenization.
+    """
+    to_hash = json.dumps(
+        {
+            "fingerprint": dataset._fingerprint,  # pylint: disable=protected-access
+            "dataset": dict(config_dataset),
+            "tokenizer": tokenizer_hash,
+            "cfg": {key: cfg[key] for key in SOURCE_HASH_CFG_KEYS},
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return md5(to_hash)
+
+
+def get_source_prepared_path(prepared_path: Path, source_hash: str) -> Path:
+    return prepared_path / PREPARED_SOURCES_DIR / source_hash
+
+
+def load_prepared_source(source_path: Path) -> Optional[Dataset]:
+    """
+    Load a cached source dataset, marking it as recently used for eviction.
+    """
+    if not source_path.is_dir() or not any(source_path.glob("*")):
+        return None
+
+    try:
+        dataset = load_from_disk(str(source_path))
+    except FileNotFoundError:
+        LOG.warning(f"Ignoring incomplete prepared dataset at {source_path}")
+        return None
+    os.utime(source_path)
+    return dataset
+
+
+def save_prepared_source(dataset: Dataset, source_path: Path):
+    # write to a temporary directory first so readers never see partial shards
+    tmp_path = source_path.with_name(f"{source_path.name}.tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    dataset.save_to_disk(str(tmp_path))
+    if source_path.exists():
+        shutil.rmtree(source_path)
+    tmp_path.rename(source_path)
+
+
+def get_source_shard_path(source_path: Path, index: int, num_shards: int) -> Path:
+    return source_path.with_name(f"{source_path.name}.shards") / (
+        f"{index:05d}-of-{num_shards:05d}"
+    )
+
+
+def load_prepared_source_shards(
+    source_path: Path, num_shards: int
+) -> Optional[Dataset]:
+    """
+    Concatenate the shards of a source dataset tokenized by each rank, in rank order,
+    or return None unless every shard was written.
+    """
+    shards = []
+    for index in range(num_shards):
+        shard = load_prepared_source(
+            get_source_shard_path(source_path, index, num_shards)
+        )
+        if shard is None:
+            return None
+        shards.append(shard)
+    return concatenate_datasets(shards)
+
+
+def remove_prepared_source_shards(source_path: Path):
+    shards_path = source_path.with_name(f"{source_path.name}.shards")
+    if shards_path.is_dir():
+        shutil.rmtree(shards_path)
+
+
+def _entry_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def evict_prepared_datasets(
+    prepared_path: Path,
+    max_age_days: Optional[float] = None,
+    max_size_gb: Optional[float] = None,
+    dry_run: bool = False,
+) -> List[Path]:
+    """
+    Remove prepared datasets (merged and per-source), reference log-probs and packing plans
+    not used within `max_age_days`, then remove the least recently used ones until the
+    directory fits in `max_size_gb`.
+
+    Returns the list of evicted paths.
+    """
+    entries = [
+        path
+        for path in prepared_path.iterdir()
+        if path.is_dir()
+        and path.name
+        not in (PREPARED_SOURCES_DIR, REFERENCE_LOGPS_DIR, PACKING_PLANS_DIR)
+    ]
+    for subdir in (PREPARED_SOURCES_DIR, REFERENCE_LOGPS_DIR):
+        subdir_path = prepared_path / subdir
+        if subdir_path.is_dir():
+            entries += [path for path in subdir_path.iterdir() if path.is_dir()]
+    packing_plans_path = prepared_path / PACKING_PLANS_DIR
+    if packing_plans_path.is_dir():
+        entries += list(packing_plans_path.glob("*.npy"))
+    entries.sort(key=lambda path: path.stat().st_mtime)
+
+    sizes = {path: _entry_size(path) for path in entries}
+    total_size = sum(sizes.values())
+    now = time.time()
+    evicted = []
+    for path in entries:
+        expired = (
+            max_age_days is not None
+            and now - path.stat().st_mtime > max_age_days * 24 * 60 * 60
+        )
+        oversized = max_size_gb is not None and total_size > max_size_gb * 1024**3
+        if not expired and not oversized:
+            continue
+
+        LOG.info(
+            f"{'Would evict' if dry_run else 'Evicting'} prepared dataset {path} "
+            f"({sizes[path] / 1024**2:.1f} MiB)"
+        )
+        if not dry_run and path.is_file():
+            path.unlink()
+        elif not dry_run:
+            shutil.rmtree(path)
+        total_size -= sizes[path]
+        evicted.append(path)
+
+    LOG.info(
+        f"Evicted {len(evicted)} prepared dataset(s), {total_size / 1024**3:.2f} GiB remaining"
+    )
+    return evicted
@@ -0,0 +1,378 @@
+"""
+near-duplicate removal with MinHash signatures over token n-grams and LSH banding
+"""
+import functools
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+import numba
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+
+from axolotl.utils.dataset_stats import list_lengths
+
+LOG = logging.getLogger("axolotl")
+
+# odd multiplier used to combine the tokens of an n-gram
+NGRAM_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+# stands in for tokens past the end of rows shorter than the n-gram size
+PAD_TOKEN = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def optimal_lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Number of bands and rows per band minimizing the sum of the false positive and
+    false negative probability mass around the Jaccard `threshold`.
+    """
+    similarities = np.linspace(0.0, 1.0, 1001)
+    below = similarities < threshold
+    best, best_error = (1, num_perm), np.inf
+    for num_bands in range(1, num_perm + 1):
+        rows = num_perm // num_bands
+        candidate = 1.0 - (1.0 - similarities**rows) ** num_bands
+        error = candidate[below].sum() + (1.0 - candidate[~below]).sum()
+        if error < best_error:
+            best, best_error = (num_bands, rows), error
+    return best
+
+
+def permutations(num_perm: int, seed: int = 42) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    # multiply-shift hashing needs odd multipliers
+    mult = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(
+        2
+    ) + np.uint64(1)
+    add = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    return mult, add
+
+
+def _shingle_hashes(
+    values: np.ndarray, offsets: np.ndarray, ngram_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hash every token n-gram of every row. Rows shorter than `ngram_size` get one padded
+    n-gram, empty rows none. Returns the hashes and the per-row offsets into them.
+    """
+    lengths = np.diff(offsets)
+    num_shingles = np.where(lengths > 0, np.maximum(lengths - ngram_size + 1, 1), 0)
+    shingle_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(num_shingles, out=shingle_offsets[1:])
+
+    rows = np.repeat(np.arange(len(lengths)), num_shingles)
+    starts = offsets[:-1][rows] + (
+        np.arange(shingle_offsets[-1]) - shingle_offsets[rows]
+    )
+    ends = offsets[1:][rows]
+
+    values = values.astype(np.uint64)
+    hashes = np.zeros(len(starts), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for pos in range(ngram_size):
+            index = starts + pos
+            token = np.where(
+                index < ends, values[np.minimum(index, len(values) - 1)], PAD_TOKEN
+            )
+            hashes = hashes * NGRAM_MULTIPLIER + token
+        # finalize so nearby token ids spread over the whole 64 bits
+        hashes ^= hashes >> np.uint64(33)
+        hashes *= np.uint64(0xFF51AFD7ED558CCD)
+        hashes ^= hashes >> np.uint64(33)
+    return hashes, shingle_offsets
+
+
+def minhash_signatures(
+    values: np.ndarray,
+    offsets: np.ndarray,
+    mult: np.ndarray,
+    add: np.ndarray,
+    ngram_size: int = 5,
+) -> np.ndarray:
+    """
+    MinHash signatures of the rows of a flattened list column, as a (rows, num_perm) uint32
+    array. Empty rows get an all-ones signature.
+    """
+    hashes, shingle_offsets = _shingle_hashes(values, offsets, ngram_size)
+    return _min_hashes(hashes, shingle_offsets, mult, add)
+
+
+@numba.njit
+def _min_hashes(hashes, shingle_offsets, mult, add):
+    num_rows, num_perm = len(shingle_offsets) - 1, len(mult)
+    signatures = np.full((num_rows, num_perm), np.iinfo(np.uint32).max, np.uint32)
+    for row in range(num_rows):
+        for shingle in range(shingle_offsets[row], shingle_offsets[row + 1]):
+            for perm in range(num_perm):
+                # multiply-shift hashing, the top 32 bits of a * h + b modulo 2**64
+                value = np.uint32((hashes[shingle] * mult[perm] + add[perm]) >> 32)
+                if value < signatures[row, perm]:
+                    signatures[row, perm] = value
+    return signatures
+
+
+def _flatten_rows(rows: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    values = np.fromiter(
+        (token for row in rows for token in row), dtype=np.int64, count=offsets[-1]
+    )
+    return values, offsets
+
+
+def _signature_batch(
+    batch: pa.Table, column: str, num_perm: int, ngram_size: int, seed: int
+) -> pa.Table:
+    mult, add = permutations(num_perm, seed)
+    chunk = batch[column].combine_chunks()
+    offsets = np.zeros(len(chunk) + 1, dtype=np.int64)
+    np.cumsum(list_lengths(chunk), out=offsets[1:])
+    values = chunk.flatten().to_numpy(zero_copy_only=False)
+    signatures = minhash_signatures(values, offsets, mult, add, ngram_size)
+    return pa.table(
+        {
+            "minhash": pa.FixedSizeListArray.from_arrays(
+                pa.array(signatures.ravel()), num_perm
+            ),
+            "empty": pa.array(offsets[1:] == offsets[:-1]),
+        }
+    )
+
+
+def compute_minhash_signatures(
+    dataset: Dataset,
+    column: str = "input_ids",
+    num_perm: int = 128,
+    ngram_size: int = 5,
+    seed: int = 42,
+    num_proc: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    MinHash signatures of every row of a tokenized dataset and a mask of its empty rows.
+    """
+    result = dataset.with_format("arrow").map(
+        functools.partial(
+            _signature_batch,
+            column=column,
+            num_perm=num_perm,
+            ngram_size=ngram_size,
+            seed=seed,
+        ),
+        batched=True,
+        num_proc=num_proc if num_proc and len(dataset) > num_proc else None,
+        remove_columns=dataset.column_names,
+        keep_in_memory=True,
+        desc="Computing MinHash signatures",
+    )
+    signatures = (
+        result.data.column("minhash")
+        .combine_chunks()
+        .flatten()
+        .to_numpy()
+        .reshape(-1, num_perm)
+    )
+    empty = result.data.column("empty").to_numpy(zero_copy_only=False)
+    return signatures, empty
+
+
+def cluster_signatures(
+    signatures: np.ndarray, num_bands: int, rows_per_band: int, empty: np.ndarray
+) -> np.ndarray:
+    """
+    Label every row with the lowest index of the rows it is connected to by a shared LSH
+    band, so each cluster of near duplicates is labeled by its first row.
+    """
+    num_rows = len(signatures)
+    labels = np.arange(num_rows)
+    candidates = np.flatnonzero(~empty)
+    band_groups = []
+    for band in range(num_bands):
+        keys = np.ascontiguousarray(
+            signatures[candidates, band * rows_per_band : (band + 1) * rows_per_band]
+        ).view(np.dtype((np.void, 4 * rows_per_band)))
+        _, groups = np.unique(keys.ravel(), return_inverse=True)
+        band_groups.append(groups)
+
+    # propagate the minimum label through every band's buckets until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        for groups in band_groups:
+            group_min = np.full(groups.max(initial=-1) + 1, num_rows)
+            np.minimum.at(group_min, groups, labels[candidates])
+            new_labels = np.minimum(labels[candidates], group_min[groups])
+            if np.any(new_labels != labels[candidates]):
+                labels[candidates] = new_labels
+                changed = True
+        # point each label at its own root so chains collapse in one step
+        labels = labels[labels]
+    return labels
+
+
+def log_near_dedup_stats(name: str, labels: np.ndarray, keep: np.ndarray):
+    clustered = labels != np.arange(len(labels))
+    num_clusters = len(np.unique(labels[clustered]))
+    removed = len(labels) - int(keep.sum())
+    LOG.info(
+        f"Near-deduplication of {name}: {num_clusters} duplicate cluster(s), "
+        f"removed {removed} of {len(labels)} rows "
+        f"({removed / max(len(labels), 1):.2%})"
+    )
+
+
+def near_deduplicate_dataset(
+    dataset: Dataset,
+    seen_signatures: Optional[np.ndarray] = None,
+    threshold: float = 0.8,
+    num_perm: int = 128,
+    ngram_size: int = 5,
+    seed: int = 42,
+    num_proc: Optional[int] = None,
+    name: str = "dataset",
+) -> Tuple[Dataset, np.ndarray]:
+    """
+    Keep the first row of each cluster of near duplicates (estimated Jaccard similarity of
+    token n-grams above `threshold`), also dropping rows near a row of `seen_signatures`.
+    Returns the deduplicated dataset and the signatures of its rows.
+    """
+    signatures, empty = compute_minhash_signatures(
+        dataset, num_perm=num_perm, ngram_size=ngram_size, seed=seed, num_proc=num_proc
+    )
+    num_seen = 0
+    if seen_signatures is not None and len(seen_signatures):
+        num_seen = len(seen_signatures)
+        signatures = np.concatenate([seen_signatures, signatures])
+        empty = np.concatenate([np.zeros(num_seen, dtype=bool), empty])
+
+    num_bands, rows_per_band = optimal_lsh_params(threshold, num_perm)
+    labels = cluster_signatures(signatures, num_bands, rows_per_band, empty)
+    # rows labeled with a seen row's index belong to a cluster already kept
+    keep = labels[num_seen:] == np.arange(num_seen, len(labels))
+    log_near_dedup_stats(name, labels[num_seen:] - num_seen, keep)
+
+    if not keep.all():
+        dataset = dataset.select(np.flatnonzero(keep))
+    return dataset, signatures[num_seen:][keep]
+
+
+def near_deduplicate_and_log_datasets(
+    cfg,
+    *,
+    train_dataset: Dataset = None,
+    eval_dataset: Dataset = None,
+    dataset: Dataset = None,
+) -> Tuple[Dataset, Dataset, Dataset]:
+    """
+    Near-deduplicates train, eval (against train as well) and an optional combined dataset.
+    """
+    kwargs = {
+        "threshold": cfg.dataset_near_dedup_threshold,
+        "num_perm": cfg.dataset_near_dedup_num_perm,
+        "ngram_size": cfg.dataset_near_dedup_ngram_size,
+        "seed": cfg.seed or 42,
+        "num_proc": cfg.dataset_processes,
+    }
+    train_signatures = None
+    if train_dataset is not None:
+        train_dataset, train_signatures = near_deduplicate_dataset(
+            train_dataset, name="train dataset", **kwargs
+        )
+    if eval_dataset is not None:
+        eval_dataset, _ = near_deduplicate_dataset(
+            eval_dataset,
+            seen_signatures=train_signatures,
+            name="eval dataset",
+            **kwargs,
+        )
+    if dataset is not None and (eval_dataset is None and train_dataset is None):
+        dataset, _ = near_deduplicate_dataset(
+            dataset, name="combined dataset", **kwargs
+        )
+    return train_dataset, eval_dataset, dataset
+
+
+class StreamingNearDeduplicator:
+    """
+    Drops near duplicates from a stream of tokenized rows, remembering at most `max_entries`
+    LSH buckets per band and forgetting the least recently matched ones first.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        ngram_size: int = 5,
+        max_entries: int = 1_000_000,
+        seed: int = 42,
+        log_every: int = 100_000,
+    ):
+        self.ngram_size = ngram_size
+        self.max_entries = max_entries
+        self.log_every = log_every
+        self.mult, self.add = permutations(num_perm, seed)
+        self.num_bands, self.rows_per_band = optimal_lsh_params(threshold, num_perm)
+        # band -> bucket key -> [id of the row that created the bucket, matched since]
+        self.buckets: List[OrderedDict] = [OrderedDict() for _ in range(self.num_bands)]
+        self.num_seen = 0
+        self.num_removed = 0
+        self.num_clusters = 0
+
+    def keep_mask(self, rows: Sequence[Sequence[int]]) -> np.ndarray:
+        values, offsets = _flatten_rows(rows)
+        signatures = minhash_signatures(
+            values, offsets, self.mult, self.add, self.ngram_size
+        )
+        band_width = self.rows_per_band * 4
+        keep = np.ones(len(rows), dtype=bool)
+        for idx, signature in enumerate(signatures):
+            row_id = self.num_seen + idx
+            if offsets[idx + 1] == offsets[idx]:
+                continue
+            band_bytes = signature[: self.num_bands * self.rows_per_band].tobytes()
+            keys = [
+                band_bytes[band * band_width : (band + 1) * band_width]
+                for band in range(self.num_bands)
+            ]
+            match = None
+            for band, key in enumerate(keys):
+                entry = self.buckets[band].get(key)
+                if entry is not None:
+                    self.buckets[band].move_to_end(key)
+                    match = match or entry
+            if match is not None:
+                keep[idx] = False
+                self.num_removed += 1
+                if not match[1]:
+                    match[1] = True
+                    self.num_clusters += 1
+                continue
+            entry = [row_id, False]
+            for band, key in enumerate(keys):
+                self.buckets[band][key] = entry
+                if len(self.buckets[band]) > self.max_entries:
+                    self.buckets[band].popitem(last=False)
+
+        previous = self.num_seen
+        self.num_seen += len(rows)
+        if self.num_seen // self.log_every > previous // self.log_every:
+            self.log_stats()
+        return keep
+
+    def log_stats(self):
+        LOG.info(
+            f"Streaming near-deduplication: {self.num_clusters} duplicate cluster(s), "
+            f"removed {self.num_removed} of {self.num_seen} rows "
+            f"({self.num_removed / max(self.num_seen, 1):.2%})"
+        )
+
+
+def get_streaming_near_deduplicator(cfg) -> Optional[StreamingNearDeduplicator]:
+    if not cfg.dataset_near_deduplication:
+        return None
+    return StreamingNearDeduplicator(
+        threshold=cfg.dataset_near_dedup_threshold,
+        num_perm=cfg.dataset_near_dedup_num_perm,
+        ngram_size=cfg.dataset_near_dedup_ngram_size,
+        max_entries=cfg.dataset_near_dedup_max_entries,
+        seed=cfg.seed or 42,
+    )
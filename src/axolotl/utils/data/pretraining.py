@@ -5,12 +5,17 @@ import logging
 from collections import defaultdict
 from typing import Callable, Dict, List, Optional
 
+import numpy as np
 import torch
-from datasets import Dataset
+from datasets import Dataset, IterableDataset
 from torch.utils.data import RandomSampler
 from transformers import PreTrainedTokenizerBase
 
 from axolotl.utils.collators import PretrainingBatchSamplerDataCollatorForSeq2Seq
+from axolotl.utils.data.near_dedup import (
+    StreamingNearDeduplicator,
+    get_streaming_near_deduplicator,
+)
 from axolotl.utils.samplers import MultipackBatchSampler, get_dataset_lengths
 from axolotl.utils.trainer import process_pretraining_datasets_for_packing
 
@@ -18,7 +23,10 @@ LOG = logging.getLogger("axolotl")
 
 
 def encode_pretraining(
-    tokenizer: PreTrainedTokenizerBase, max_tokens: int, examples: Dict[str, List]
+    tokenizer: PreTrainedTokenizerBase,
+    max_tokens: int,
+    examples: Dict[str, List],
+    near_dedup: Optional[StreamingNearDeduplicator] = None,
 ) -> Dict[str, List]:
     res = tokenizer(
         examples["text"],
@@ -26,6 +34,12 @@ def encode_pretraining(
         max_length=max_tokens - 2,
         add_special_tokens=True,
     )
+    if near_dedup is not None:
+        keep = near_dedup.keep_mask(res["input_ids"])
+        res = {
+            key: [row for row, kept in zip(rows, keep) if kept]
+            for key, rows in res.items()
+        }
     # Convert to PyTorch tensors
     input_ids = [torch.tensor(seq) for seq in res["input_ids"]]
     targets = [torch.tensor(seq) for seq in res["input_ids"]]
@@ -165,6 +179,119 @@ def encode_pretraining(
     return ret
 
 
+class PretrainingMixture:
+    """
+    Interleave encoded streaming pretraining sources row by row, drawing each row's source
+    from the mixture weights with a seeded generator, and count the tokens of each source.
+
+    Source weights move linearly from `weight` to `final_weight` over `total_rows` rows and
+    are sharpened or flattened by `temperature`, i.e. sampled with probability
+    proportional to `weight ** (1 / temperature)`. Exhausted sources drop out of the mixture,
+    which ends once the remaining sources all have a weight of 0. Each pass reseeds the draws
+    and the sources' shuffles from the epoch.
+    """
+
+    def __init__(
+        self,
+        datasets: List[IterableDataset],
+        names: List[str],
+        weights: List[float],
+        final_weights: Optional[List[Optional[float]]] = None,
+        temperature: float = 1.0,
+        seed: int = 42,
+        total_rows: Optional[int] = None,
+        log_every: int = 1000,
+    ):
+        self.datasets = datasets
+        self.names = names
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.final_weights = np.asarray(
+            [
+                weight if final is None else final
+                for weight, final in zip(
+                    weights, final_weights or [None] * len(weights)
+                )
+            ],
+            dtype=np.float64,
+        )
+        self.temperature = temperature
+        self.seed = seed
+        self.total_rows = total_rows
+        self.log_every = log_every
+        self.num_rows = np.zeros(len(datasets), dtype=np.int64)
+        self.num_tokens = np.zeros(len(datasets), dtype=np.int64)
+        self.epoch = 0
+        self._epoch_started = False
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self._epoch_started = False
+
+    def probabilities(self, row: int, active: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Sampling probabilities of the sources at `row`, or None if the active sources
+        all have a weight of 0.
+        """
+        progress = min(1.0, row / self.total_rows) if self.total_rows else 0.0
+        weights = self.weights + (self.final_weights - self.weights) * progress
+        weights = np.where(active, weights, 0.0) ** (1.0 / self.temperature)
+        total = weights.sum()
+        if total <= 0:
+            return None
+        return weights / total
+
+    def log_stats(self):
+        total_tokens = max(int(self.num_tokens.sum()), 1)
+        for name, num_rows, num_tokens in zip(
+            self.names, self.num_rows, self.num_tokens
+        ):
+            LOG.info(
+                f"Pretraining source {name}: {num_rows} rows, {num_tokens} tokens "
+                f"({num_tokens / total_tokens:.1%})"
+            )
+
+    def __call__(self):
+        # the generator is rebuilt on every pass and IterableDataset.from_generator doesn't
+        # forward set_epoch, so move on to the next epoch unless set_epoch was just called
+        if self._epoch_started:
+            self.epoch += 1
+        self._epoch_started = True
+        for dataset in self.datasets:
+            dataset.set_epoch(self.epoch)
+        rng = np.random.default_rng(self.seed + self.epoch)
+        iterators = [iter(dataset) for dataset in self.datasets]
+        active = np.ones(len(iterators), dtype=bool)
+        self.num_rows[:] = 0
+        self.num_tokens[:] = 0
+        row = 0
+        while active.any():
+            probabilities = self.probabilities(row, active)
+            if probabilities is None:
+                # the row count doesn't move without draws, so the weights won't either
+                remaining = [self.names[idx] for idx in np.flatnonzero(active)]
+                LOG.info(
+                    f"Remaining pretraining sources {', '.join(remaining)} have a "
+                    "weight of 0, ending the mixture"
+                )
+                break
+            source = rng.choice(len(iterators), p=probabilities)
+            try:
+                example = next(iterators[source])
+            except StopIteration:
+                LOG.info(f"Pretraining source {self.names[source]} is exhausted")
+                active[source] = False
+                continue
+
+            self.num_rows[source] += 1
+            # packed attention masks hold sequence ids, padding is always 0
+            self.num_tokens[source] += np.count_nonzero(example["attention_mask"])
+            row += 1
+            if row % self.log_every == 0:
+                self.log_stats()
+            yield example
+        self.log_stats()
+
+
 def wrap_pretraining_dataset(
     dataset,
     tokenizer,
@@ -174,7 +301,21 @@ def wrap_pretraining_dataset(
     batch_size=1,
     seed=42,
     buffer_size=10_000,
+    weights: Optional[List[float]] = None,
+    final_weights: Optional[List[Optional[float]]] = None,
+    names: Optional[List[str]] = None,
 ):
+    """
+    Encode a streaming pretraining dataset, or a list of them along with a list of their
+    `ds_wrapper_fn`, in which case the encoded sources are interleaved by `weights`.
+    """
+    is_mixture = isinstance(dataset, list)
+    if not is_mixture:
+        dataset, ds_wrapper_fn = [dataset], [ds_wrapper_fn]
+
+    # shared by every buffer so duplicates are found across the whole stream
+    near_dedup = get_streaming_near_deduplicator(cfg)
+    collate_fn = None
     if cfg.sample_packing:
         collate_fn = PretrainingBatchSamplerDataCollatorForSeq2Seq(
             tokenizer,
@@ -183,45 +324,74 @@ def wrap_pretraining_dataset(
             pad_to_multiple_of=max_tokens * batch_size,
             multipack_attn=cfg.pretrain_multipack_attn,
         )
-        encode = functools.partial(
-            encode_packed_pretraining,
-            collate_fn,
-            ds_wrapper_fn,
-            max_seq_length=max_tokens,
-            batch_size=batch_size,
-            multipack_attn=cfg.pretrain_multipack_attn,
-            group_size=cfg.sample_packing_group_size,
-            bin_size=cfg.sample_packing_bin_size,
-        )
         # set this to 1 so downstream data_loader doesn't try to increase the batch again
         cfg.micro_batch_size = 1
-    else:
-        encode = functools.partial(encode_pretraining, tokenizer, max_tokens)
-
-    if cfg.shuffle_merged_datasets:
-        dataset = dataset.shuffle(seed=seed, buffer_size=buffer_size)
-    else:
-        LOG.debug("NOT shuffling merged pretraining datasets")
-
-    # remove all the existing columns after mapping since they end up having
-    # a different length than the encoded/tokenized column
-    # this is empty during streaming/pretraining
-    remove_columns = []
-    if dataset.features is None:
-        for first_row in dataset:
-            remove_columns = first_row.keys()
-            break
-    else:
-        remove_columns = dataset.features.keys()
-
-    dataset = dataset.map(
-        encode,
-        batched=True,
-        batch_size=buffer_size,
-        # input_columns="text",
-        remove_columns=remove_columns,
+
+    encoded = []
+    for idx, (source, source_ds_wrapper_fn) in enumerate(zip(dataset, ds_wrapper_fn)):
+        if collate_fn is not None:
+            encode = functools.partial(
+                encode_packed_pretraining,
+                collate_fn,
+                source_ds_wrapper_fn,
+                max_seq_length=max_tokens,
+                batch_size=batch_size,
+                multipack_attn=cfg.pretrain_multipack_attn,
+                group_size=cfg.sample_packing_group_size,
+                bin_size=cfg.sample_packing_bin_size,
+                near_dedup=near_dedup,
+            )
+        else:
+            encode = functools.partial(
+                encode_pretraining, tokenizer, max_tokens, near_dedup=near_dedup
+            )
+
+        if cfg.shuffle_merged_datasets:
+            # offset the seed so sources don't share a shuffle order
+            source = source.shuffle(seed=seed + idx, buffer_size=buffer_size)
+        else:
+            LOG.debug("NOT shuffling merged pretraining datasets")
+
+        # remove all the existing columns after mapping since they end up having
+        # a different length than the encoded/tokenized column
+        # this is empty during streaming/pretraining
+        remove_columns = []
+        if source.features is None:
+            for first_row in source:
+                remove_columns = first_row.keys()
+                break
+        else:
+            remove_columns = source.features.keys()
+
+        encoded.append(
+            source.map(
+                encode,
+                batched=True,
+                batch_size=buffer_size,
+                # input_columns="text",
+                remove_columns=remove_columns,
+            )
+        )
+
+    if not is_mixture:
+        return encoded[0]
+    mixture = PretrainingMixture(
+        encoded,
+        names or [str(idx) for idx in range(len(encoded))],
+        weights or [1.0] * len(encoded),
+        final_weights=final_weights,
+        temperature=(
+            1.0
+            if cfg.pretraining_mixture_temperature is None
+            else cfg.pretraining_mixture_temperature
+        ),
+        seed=seed,
+        # rows drawn per rank to reach max_steps, packed rows already hold a full batch
+        total_rows=(cfg.max_steps or 0)
+        * (cfg.gradient_accumulation_steps or 1)
+        * (1 if cfg.sample_packing else batch_size),
     )
-    return dataset
+    return IterableDataset.from_generator(mixture)
 
 
 def encode_packed_pretraining(
@@ -233,11 +403,16 @@ def encode_packed_pretraining(
     multipack_attn: Optional[bool] = False,
     group_size: int = 100000,
     bin_size: int = 200,
+    near_dedup: Optional[StreamingNearDeduplicator] = None,
 ) -> Dict[str, List]:
     # pylint: disable=duplicate-code
     # tokenize all the examples
     # rows get split with stride (overlap)
     train_dataset = ds_wrapper(Dataset.from_dict(examples))[0]
+    if near_dedup is not None:
+        keep = near_dedup.keep_mask(train_dataset["input_ids"])
+        if not keep.all():
+            train_dataset = train_dataset.select(np.flatnonzero(keep))
 
     train_dataset = process_pretraining_datasets_for_packing(
         train_dataset,
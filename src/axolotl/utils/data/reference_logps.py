@@ -0,0 +1,244 @@
+"""
+offline cache of reference model log-probs for preference datasets, so RL training doesn't
+need to load the reference model
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from datasets import Dataset, concatenate_datasets
+from tqdm import tqdm
+from transformers import PreTrainedTokenizerBase
+
+from axolotl.common.const import (
+    DEFAULT_DATASET_PREPARED_PATH,
+    DPO_REFERENCE_LOGPS_COLUMNS,
+    KTO_REFERENCE_LOGPS_COLUMNS,
+)
+from axolotl.utils.data.cache import (
+    REFERENCE_LOGPS_DIR,
+    get_tokenizer_fingerprint,
+    load_prepared_source,
+    save_prepared_source,
+)
+from axolotl.utils.data.utils import md5
+from axolotl.utils.dataset_stats import get_row_lengths
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.generation import bucket_by_token_budget
+from axolotl.utils.models import load_model, load_tokenizer
+from axolotl.utils.trainer import setup_trainer
+
+LOG = logging.getLogger("axolotl")
+
+# config fields selecting the reference model and how its inputs are truncated
+REFERENCE_HASH_CFG_KEYS = [
+    "base_model",
+    "revision_of_model",
+    "torch_dtype",
+    "bf16",
+    "fp16",
+    "load_in_8bit",
+    "load_in_4bit",
+    "rl",
+    "sequence_len",
+    "max_prompt_len",
+    "seed",
+]
+
+
+def get_reference_logps_columns(rl) -> List[str]:  # pylint: disable=invalid-name
+    if rl == "kto":
+        return KTO_REFERENCE_LOGPS_COLUMNS
+    return DPO_REFERENCE_LOGPS_COLUMNS
+
+
+def has_reference_logps(
+    dataset: Optional[Dataset], rl
+) -> bool:  # pylint: disable=invalid-name
+    return dataset is not None and all(
+        column in dataset.column_names for column in get_reference_logps_columns(rl)
+    )
+
+
+def get_reference_logps_hash(
+    cfg: DictDefault,
+    split: str,
+    dataset: Dataset,
+    tokenizer: PreTrainedTokenizerBase,
+) -> str:
+    """
+    Key the reference log-probs of a prepared split by its datasets config and length, the
+    reference model, and the tokenizer.
+    """
+    cfg_values = {key: cfg[key] for key in REFERENCE_HASH_CFG_KEYS}
+    # with trl autounwrap, the reference model is the base model with the adapter disabled
+    if cfg.rl_adapter_ref_model or not cfg.adapter:
+        cfg_values["lora_model_dir"] = cfg.lora_model_dir
+    if cfg.rl == "kto":
+        # the KL completions are paired within each micro batch
+        cfg_values["micro_batch_size"] = cfg.micro_batch_size
+    to_hash = json.dumps(
+        {
+            "datasets": cfg.datasets if split == "train" else cfg.test_datasets,
+            "split": split,
+            "num_rows": len(dataset),
+            "cfg": cfg_values,
+            "tokenizer": get_tokenizer_fingerprint(tokenizer),
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return md5(to_hash)
+
+
+def get_reference_logps_path(
+    cfg: DictDefault, split: str, dataset: Dataset, tokenizer: PreTrainedTokenizerBase
+) -> Path:
+    prepared_path = Path(cfg.dataset_prepared_path or DEFAULT_DATASET_PREPARED_PATH)
+    return (
+        prepared_path
+        / REFERENCE_LOGPS_DIR
+        / get_reference_logps_hash(cfg, split, dataset, tokenizer)
+    )
+
+
+def attach_reference_logps(
+    cfg: DictDefault,
+    train_dataset: Dataset,
+    eval_dataset: Optional[Dataset],
+    tokenizer: PreTrainedTokenizerBase,
+) -> Tuple[Dataset, Optional[Dataset]]:
+    """
+    Add the cached reference log-probs as columns of the train and eval datasets, only if
+    both are cached, as the reference model is then not loaded at all.
+    """
+    splits = {"train": train_dataset, "eval": eval_dataset}
+    cached = {}
+    for split, dataset in splits.items():
+        if dataset is None:
+            continue
+        logps = load_prepared_source(
+            get_reference_logps_path(cfg, split, dataset, tokenizer)
+        )
+        if logps is None or len(logps) != len(dataset):
+            LOG.warning(
+                f"No cached reference log-probs for the {split} dataset, run `axolotl "
+                "preprocess` with `precompute_reference_logps: true` to compute them"
+            )
+            return train_dataset, eval_dataset
+        cached[split] = concatenate_datasets([dataset, logps], axis=1)
+
+    LOG.info("Using cached reference log-probs, the reference model won't be loaded")
+    return cached["train"], cached.get("eval")
+
+
+def _reference_row_lengths(
+    dataset: Dataset, rl
+) -> np.ndarray:  # pylint: disable=invalid-name
+    # tokens of a row once collated, i.e. both of its sequences padded to the longest
+    if rl == "kto":
+        lengths = get_row_lengths(dataset, "completion_input_ids")
+        if "KL_completion_input_ids" in dataset.column_names:
+            lengths = 2 * np.maximum(
+                lengths, get_row_lengths(dataset, "KL_completion_input_ids")
+            )
+        return lengths
+    return 2 * (
+        get_row_lengths(dataset, "prompt_input_ids")
+        + np.maximum(
+            get_row_lengths(dataset, "chosen_input_ids"),
+            get_row_lengths(dataset, "rejected_input_ids"),
+        )
+    )
+
+
+def _reference_logps_batch(
+    trainer, batch, rl
+) -> Dict[str, torch.Tensor]:  # pylint: disable=invalid-name
+    if rl == "kto":
+        completion_logps, kl_logps = trainer.compute_reference_log_probs(batch)
+        logps = {"reference_logps": completion_logps}
+        if kl_logps is not None:
+            logps["reference_KL_logps"] = kl_logps
+        return logps
+    chosen_logps, rejected_logps = trainer.compute_ref_log_probs(batch)
+    return {"ref_chosen_logps": chosen_logps, "ref_rejected_logps": rejected_logps}
+
+
+def compute_reference_logps(
+    trainer, dataset: Dataset, rl, max_tokens: int  # pylint: disable=invalid-name
+) -> Dataset:
+    """
+    Run the reference model of an RL trainer over a dataset it tokenized, in batches sorted
+    by length holding at most `max_tokens` tokens.
+
+    Returns the reference log-probs columns, in the order of `dataset`.
+    """
+    buckets = bucket_by_token_budget(_reference_row_lengths(dataset, rl), 0, max_tokens)
+    columns: Dict[str, np.ndarray] = {}
+    for bucket in tqdm(buckets, desc="Computing reference log-probs"):
+        batch = trainer.data_collator(dataset.select(bucket).to_list())
+        batch = trainer._prepare_inputs(batch)  # pylint: disable=protected-access
+        for key, logps in _reference_logps_batch(trainer, batch, rl).items():
+            if key not in columns:
+                columns[key] = np.zeros(len(dataset), dtype=np.float32)
+            columns[key][bucket] = logps.float().cpu().numpy()
+    return Dataset.from_dict(columns)
+
+
+def precompute_reference_logps(
+    cfg: DictDefault, train_dataset: Dataset, eval_dataset: Optional[Dataset]
+):
+    """
+    Compute and cache the reference log-probs of the prepared RL datasets not cached yet.
+    """
+    tokenizer = load_tokenizer(cfg)
+    splits = {
+        split: dataset
+        for split, dataset in (("train", train_dataset), ("eval", eval_dataset))
+        if dataset is not None and not has_reference_logps(dataset, cfg.rl)
+    }
+    paths = {
+        split: get_reference_logps_path(cfg, split, dataset, tokenizer)
+        for split, dataset in splits.items()
+    }
+    splits = {
+        split: dataset
+        for split, dataset in splits.items()
+        if load_prepared_source(paths[split]) is None
+    }
+    if not splits:
+        LOG.info("Reference log-probs are already cached")
+        return
+
+    ref_cfg = DictDefault(dict(cfg))
+    if cfg.adapter and not cfg.rl_adapter_ref_model:
+        # trl uses the base model with the adapter disabled as the reference
+        ref_cfg.lora_model_dir = None
+    # the trainer then uses the loaded model as the reference, without copying it
+    ref_cfg.precompute_ref_log_probs = True
+    # batches are bucketed by length here rather than packed
+    ref_cfg.rl_sample_packing = False
+    model, _ = load_model(ref_cfg, tokenizer, reference_model=True)
+    model.eval()
+    trainer = setup_trainer(
+        ref_cfg,
+        splits.get("train", train_dataset),
+        splits.get("eval"),
+        (model, None, None),
+        tokenizer,
+        None,
+        1,
+    )
+
+    for split in splits:
+        dataset = trainer.train_dataset if split == "train" else trainer.eval_dataset
+        logps = compute_reference_logps(
+            trainer, dataset, cfg.rl, cfg.reference_logps_max_tokens
+        )
+        paths[split].parent.mkdir(parents=True, exist_ok=True)
+        save_prepared_source(logps, paths[split])
+        LOG.info(f"Saved {split} reference log-probs to {paths[split]}")
@@ -8,11 +8,13 @@ from typing import Any, List
 
 import yaml
 from datasets import DatasetDict, concatenate_datasets, load_dataset, load_from_disk
+from trl.trainer.kto_trainer import _tokenize as kto_tokenize
 
-from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH
+from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH, KTO_TOKENIZED_COLUMNS
 from axolotl.prompt_strategies.dpo import load as load_dpo
 from axolotl.prompt_strategies.kto import load as load_kto
 from axolotl.prompt_strategies.orpo import load as load_orpo
+from axolotl.utils.data.cache import get_tokenizer_fingerprint
 from axolotl.utils.data.utils import deduplicate_and_log_datasets, md5
 from axolotl.utils.dict import DictDefault
 from axolotl.utils.distributed import is_main_process, zero_first
@@ -31,8 +33,23 @@ def _get_path(ds_hash, cfg):
     return prepared_ds_path
 
 
-def _load_preprocessed_ds(cfg, sub_cfg):
-    ds_hash = md5(yaml.dump(sub_cfg, Dumper=yaml.Dumper))
+def _get_ds_hash(cfg, sub_cfg, tokenizer=None):
+    to_hash = yaml.dump(sub_cfg, Dumper=yaml.Dumper)
+    if cfg.rl_pretokenize:
+        # token ids are stored, so a different tokenizer or length filter invalidates them
+        to_hash += yaml.dump(
+            {
+                "rl": str(cfg.rl),
+                "sequence_len": cfg.sequence_len,
+                "tokenizer": get_tokenizer_fingerprint(tokenizer),
+            },
+            Dumper=yaml.Dumper,
+        )
+    return md5(to_hash)
+
+
+def _load_preprocessed_ds(cfg, sub_cfg, tokenizer=None):
+    ds_hash = _get_ds_hash(cfg, sub_cfg, tokenizer)
     prepared_ds_path = _get_path(ds_hash, cfg)
     dataset = None
 
@@ -48,8 +65,8 @@ def _load_preprocessed_ds(cfg, sub_cfg):
     return dataset
 
 
-def _save_preprocessed_ds(cfg, sub_cfg, dataset):
-    ds_hash = md5(yaml.dump(sub_cfg, Dumper=yaml.Dumper))
+def _save_preprocessed_ds(cfg, sub_cfg, dataset, tokenizer=None):
+    ds_hash = _get_ds_hash(cfg, sub_cfg, tokenizer)
     prepared_ds_path = _get_path(ds_hash, cfg)
 
     if cfg.is_preprocess and is_main_process():
@@ -69,6 +86,7 @@ def map_dataset(cfg, data_set, ds_transform_fn, tokenizer):
 
     data_set = data_set.map(
         ds_transform_fn,
+        num_proc=cfg.dataset_processes,
         desc="Mapping RL Dataset",
     )
 
@@ -115,8 +133,58 @@ def drop_long_rl_seq(
     raise ValueError("Unknown RL type")
 
 
+def tokenize_rl_batch(batch, rl, tokenizer):  # pylint: disable=invalid-name
+    """
+    Tokenize each text field of a batch of preference rows exactly once, into the columns
+    the DPO and KTO trainers otherwise tokenize themselves.
+    """
+    if rl in ("dpo", "ipo"):
+        if not (batch.get("prompt") and batch.get("chosen") and batch.get("rejected")):
+            raise ValueError(
+                "Prompt, chosen and rejected keys are required for DPO datasets"
+            )
+        return {
+            f"{key}_input_ids": tokenizer(batch[key], add_special_tokens=False)[
+                "input_ids"
+            ]
+            for key in ("prompt", "chosen", "rejected")
+        }
+
+    if rl == "kto":
+        if not (batch.get("prompt") and batch.get("completion")):
+            raise ValueError("Prompt and completion keys are required for KTO datasets")
+        # same prompt/answer split as the KTOTrainer, which then skips tokenizing
+        tokenized = kto_tokenize(batch, tokenizer)
+        return {
+            key: [list(map(int, values)) for values in tokenized[key]]
+            for key in KTO_TOKENIZED_COLUMNS
+        }
+
+    raise ValueError(f"Pre-tokenizing isn't supported for rl: {rl}")
+
+
+def drop_long_rl_seq_tokenized(batch, rl, sequence_len):  # pylint: disable=invalid-name
+    """
+    Batched filter by the lengths of the columns written by `tokenize_rl_batch`.
+    """
+    len_prompts = [len(input_ids) for input_ids in batch["prompt_input_ids"]]
+    if rl == "kto":
+        return [
+            len_prompt + len(answer_input_ids) <= sequence_len
+            for len_prompt, answer_input_ids in zip(
+                len_prompts, batch["answer_input_ids"]
+            )
+        ]
+    return [
+        len_prompt + max(len(chosen_input_ids), len(rejected_input_ids)) <= sequence_len
+        for len_prompt, chosen_input_ids, rejected_input_ids in zip(
+            len_prompts, batch["chosen_input_ids"], batch["rejected_input_ids"]
+        )
+    ]
+
+
 def load_prepare_dpo_datasets(cfg):
-    def load_split(dataset_cfgs, _cfg):
+    def load_split(dataset_cfgs, _cfg, tokenizer):
         split_datasets: List[Any] = []
         for i, ds_cfg in enumerate(dataset_cfgs):
             if ds_cfg["ds_type"] == "json":
@@ -136,8 +204,6 @@ def load_prepare_dpo_datasets(cfg):
                 )
                 split_datasets.insert(i, ds)
 
-        tokenizer = load_tokenizer(cfg)
-
         for i, data_set in enumerate(split_datasets):
             _type = dataset_cfgs[i]["type"]
             if _type:
@@ -163,20 +229,37 @@ def load_prepare_dpo_datasets(cfg):
                 # "prompt", "chosen" and "rejected" already preprocessed
                 split_datasets[i] = data_set
 
-            drop_long = partial(
-                drop_long_rl_seq,
-                rl=_cfg.rl,
-                tokenizer=tokenizer,
-                sequence_len=cfg.sequence_len,
-            )
-
             prior_len = len(split_datasets[i])
-            split_datasets[i] = split_datasets[i].filter(
-                drop_long,
-                num_proc=cfg.dataset_processes,
-                load_from_cache_file=not cfg.is_preprocess,
-                desc="Dropping Long Sequences",
-            )
+            if cfg.rl_pretokenize:
+                split_datasets[i] = split_datasets[i].map(
+                    tokenize_rl_batch,
+                    fn_kwargs={"rl": _cfg.rl, "tokenizer": tokenizer},
+                    batched=True,
+                    num_proc=cfg.dataset_processes,
+                    load_from_cache_file=not cfg.is_preprocess,
+                    desc="Tokenizing RL Dataset",
+                )
+                split_datasets[i] = split_datasets[i].filter(
+                    drop_long_rl_seq_tokenized,
+                    fn_kwargs={"rl": _cfg.rl, "sequence_len": cfg.sequence_len},
+                    batched=True,
+                    num_proc=cfg.dataset_processes,
+                    load_from_cache_file=not cfg.is_preprocess,
+                    desc="Dropping Long Sequences",
+                )
+            else:
+                drop_long = partial(
+                    drop_long_rl_seq,
+                    rl=_cfg.rl,
+                    tokenizer=tokenizer,
+                    sequence_len=cfg.sequence_len,
+                )
+                split_datasets[i] = split_datasets[i].filter(
+                    drop_long,
+                    num_proc=cfg.dataset_processes,
+                    load_from_cache_file=not cfg.is_preprocess,
+                    desc="Dropping Long Sequences",
+                )
             dropped = prior_len - len(split_datasets[i])
             if dropped:
                 LOG.warning(f"Dropped {dropped} long samples from dataset index {i}")
@@ -187,30 +270,33 @@ def load_prepare_dpo_datasets(cfg):
         return combined_datasets
 
     with zero_first(is_main_process()):
+        tokenizer = load_tokenizer(cfg)
         train_is_preprocessed = False
         eval_is_preprocessed = False
-        if train_dataset := _load_preprocessed_ds(cfg, cfg.datasets):
+        if train_dataset := _load_preprocessed_ds(cfg, cfg.datasets, tokenizer):
             train_is_preprocessed = True
         else:
-            train_dataset = load_split(cfg.datasets, cfg)
+            train_dataset = load_split(cfg.datasets, cfg, tokenizer)
 
         eval_dataset = None
         if cfg.test_datasets:
-            if eval_dataset := _load_preprocessed_ds(cfg, cfg.test_datasets):
+            if eval_dataset := _load_preprocessed_ds(cfg, cfg.test_datasets, tokenizer):
                 eval_is_preprocessed = True
             else:
-                eval_dataset = load_split(cfg.test_datasets, cfg)
+                eval_dataset = load_split(cfg.test_datasets, cfg, tokenizer)
         if not eval_dataset:
             eval_dataset = None
 
         if not train_is_preprocessed:
-            _save_preprocessed_ds(cfg, cfg.datasets, train_dataset)
+            _save_preprocessed_ds(cfg, cfg.datasets, train_dataset, tokenizer)
         if eval_dataset and not eval_is_preprocessed:
-            _save_preprocessed_ds(cfg, cfg.test_datasets, eval_dataset)
+            _save_preprocessed_ds(cfg, cfg.test_datasets, eval_dataset, tokenizer)
 
     if cfg.dataset_exact_deduplication:
         train_dataset, eval_dataset, _ = deduplicate_and_log_datasets(
-            train_dataset=train_dataset, eval_dataset=eval_dataset
+            train_dataset=train_dataset,
+            eval_dataset=eval_dataset,
+            num_proc=cfg.dataset_processes,
         )
 
     return train_dataset, eval_dataset
@@ -3,7 +3,7 @@
 import functools
 import logging
 from pathlib import Path
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 from datasets import (
     Dataset,
@@ -39,6 +39,18 @@ from axolotl.prompters import (
     SummarizeTLDRPrompter,
     UnsupportedPrompter,
 )
+from axolotl.utils.data.cache import (
+    PreparedCacheStats,
+    get_source_dataset_hash,
+    get_source_prepared_path,
+    get_source_shard_path,
+    get_tokenizer_fingerprint,
+    load_prepared_source,
+    load_prepared_source_shards,
+    remove_prepared_source_shards,
+    save_prepared_source,
+)
+from axolotl.utils.data.near_dedup import near_deduplicate_and_log_datasets
 from axolotl.utils.data.pretraining import wrap_pretraining_dataset
 from axolotl.utils.data.shared import load_dataset_w_config
 from axolotl.utils.data.utils import (
@@ -47,7 +59,14 @@ from axolotl.utils.data.utils import (
     retry_on_request_exceptions,
 )
 from axolotl.utils.dict import DictDefault
-from axolotl.utils.distributed import is_local_main_process, zero_first
+from axolotl.utils.distributed import (
+    barrier,
+    get_rank,
+    get_world_size,
+    is_local_main_process,
+    is_main_process,
+    zero_first,
+)
 from axolotl.utils.trainer import (
     calculate_total_num_steps,
     process_datasets_for_packing,
@@ -60,7 +79,14 @@ LOG = logging.getLogger("axolotl")
 def prepare_dataset(cfg, tokenizer, processor=None):
     prompters = []
     if not cfg.pretraining_dataset:
-        with zero_first(is_local_main_process()):
+        if cfg.dataset_sharded_preprocessing and get_world_size() > 1:
+            # every rank tokenizes its own shard of each source, then rank 0 alone merges them
+            prepare_dataset_shards(cfg, tokenizer, processor=processor)
+            barrier()
+            is_main = is_main_process()
+        else:
+            is_main = is_local_main_process()
+        with zero_first(is_main):
             if cfg.test_datasets:
                 train_dataset, _, prompters = load_prepare_datasets(
                     tokenizer,
@@ -84,35 +110,57 @@ def prepare_dataset(cfg, tokenizer, processor=None):
                     processor=processor,
                 )
     else:
-        # Load streaming dataset if pretraining_dataset is given
-        path = cfg.pretraining_dataset
-        split = "train"
-        name = None
-        if isinstance(cfg.pretraining_dataset, list) and isinstance(
-            cfg.pretraining_dataset[0], dict
-        ):
-            path = cfg.pretraining_dataset[0]["path"]
-            name = cfg.pretraining_dataset[0]["name"]
-            if "split" in cfg.pretraining_dataset[0]:
-                split = cfg.pretraining_dataset[0]["split"]
-
-        ds_wrapper_partial = functools.partial(
-            get_dataset_wrapper,
-            cfg.pretraining_dataset[0],
-            tokenizer,
-            cfg,
-            cfg.pretraining_dataset[0]["type"] or "pretrain",
-        )
+        # Load streaming datasets if pretraining_dataset is given
+        datasets, ds_wrapper_fns, names, weights, final_weights = [], [], [], [], []
+        for config_dataset in cfg.pretraining_dataset:
+            path = config_dataset
+            split = "train"
+            name = None
+            if isinstance(config_dataset, dict):
+                path = config_dataset["path"]
+                name = config_dataset["name"]
+                if "split" in config_dataset:
+                    split = config_dataset["split"]
+
+            datasets.append(load_dataset(path, streaming=True, split=split, name=name))
+            ds_wrapper_fns.append(
+                functools.partial(
+                    get_dataset_wrapper,
+                    config_dataset,
+                    tokenizer,
+                    cfg,
+                    config_dataset["type"] or "pretrain",
+                )
+            )
+            names.append(f"{path}:{name}" if name else path)
+            weight = config_dataset.get("weight")
+            weights.append(1.0 if weight is None else weight)
+            final_weights.append(config_dataset.get("final_weight"))
+
+        if len(datasets) > 1:
+            # interleave the sources by weight instead of using only the first one
+            mixture_kwargs = {
+                "weights": weights,
+                "final_weights": final_weights,
+                "names": names,
+            }
+        else:
+            datasets, ds_wrapper_fns, mixture_kwargs = (
+                datasets[0],
+                ds_wrapper_fns[0],
+                {},
+            )
 
         train_dataset = wrap_pretraining_dataset(
-            load_dataset(path, streaming=True, split=split, name=name),
+            datasets,
             tokenizer,
             cfg,
-            ds_wrapper_partial,
+            ds_wrapper_fns,
             max_tokens=cfg.sequence_len,
             batch_size=cfg.micro_batch_size,
             seed=cfg.seed or 42,
             buffer_size=cfg.pretrain_multipack_buffer_size or 10_000,
+            **mixture_kwargs,
         )
         # https://discuss.huggingface.co/t/how-to-use-huggingface-trainer-streaming-datasets-without-wrapping-it-with-torchdatas-iterablewrapper/25230
         train_dataset = train_dataset.with_format("torch")
@@ -151,15 +199,36 @@ def prepare_dataset(cfg, tokenizer, processor=None):
     return train_dataset, eval_dataset, total_num_steps, prompters
 
 
+def prepare_dataset_shards(cfg, tokenizer, processor=None):
+    """
+    Tokenize this rank's shard of every train (and test) source into `dataset_prepared_path`.
+    """
+    shard = (get_rank(), get_world_size())
+    for split in ["train", "test"] if cfg.test_datasets else ["train"]:
+        load_tokenized_prepared_datasets(
+            tokenizer,
+            cfg,
+            DEFAULT_DATASET_PREPARED_PATH,
+            split=split,
+            processor=processor,
+            shard=shard,
+        )
+
+
 def load_tokenized_prepared_datasets(
     tokenizer,
     cfg,
     default_dataset_prepared_path,
     split="train",
     processor=None,
+    shard: Optional[Tuple[int, int]] = None,
 ) -> Tuple[DatasetDict, List[Prompter]]:
+    """
+    Load or tokenize and merge the datasets of `split`. With `shard=(index, num_shards)` only
+    that shard of each source is tokenized and saved for the merging rank, returning no dataset.
+    """
     cfg_datasets = cfg.test_datasets if split == "test" else cfg.datasets
-    tokenizer_name = cfg.tokenizer_config
+    tokenizer_hash = get_tokenizer_fingerprint(tokenizer)
     ds_hash = str(
         md5(
             (
@@ -171,16 +240,19 @@ def load_tokenized_prepared_datasets(
                 + "@"
                 + str(cfg.group_by_length)
                 + "@"
+                + str(cfg.train_on_inputs)
+                + "@"
                 + "|".join(
                     sorted(
                         [
                             f"{d.path}:{d.type}:{d.shards}:{d.conversation}{d.split}"
+                            f":{d.roles_to_train}:{d.train_on_eos}"
                             for d in cfg_datasets
                         ]
                     )
                 )
                 + "|"
-                + tokenizer_name
+                + tokenizer_hash
             )
         )
     )
@@ -218,6 +290,7 @@ def load_tokenized_prepared_datasets(
     ):
         LOG.info(f"Loading prepared dataset from disk at {prepared_ds_path}...")
         dataset = load_from_disk(str(prepared_ds_path))
+        prepared_ds_path.touch()
         LOG.info("Prepared dataset loaded from disk...")
     else:
         if cfg.push_dataset_to_hub:
@@ -241,6 +314,12 @@ def load_tokenized_prepared_datasets(
             seed = 42
 
         datasets = []
+        cache_stats = PreparedCacheStats()
+        cache_per_source = (
+            cfg.dataset_prepared_cache_per_source and not cfg.skip_prepare_dataset
+        )
+        num_shards = get_world_size() if cfg.dataset_sharded_preprocessing else 1
+        merged_shards = []
 
         def for_d_in_datasets(dataset_configs):
             for dataset in dataset_configs:
@@ -282,6 +361,58 @@ def load_tokenized_prepared_datasets(
                     num_shards=config_dataset.shards, index=shards_idx
                 )
 
+            source_path = None
+            if cache_per_source or num_shards > 1:
+                source_path = get_source_prepared_path(
+                    prepared_ds_path.parent,
+                    get_source_dataset_hash(cfg, config_dataset, ds, tokenizer_hash),
+                )
+            if cache_per_source:
+                dataset_wrapper = load_prepared_source(source_path)
+                if dataset_wrapper is not None:
+                    LOG.info(
+                        f"Loaded prepared dataset for {config_dataset.path} from {source_path}"
+                    )
+                    cache_stats.hits.append(str(source_path))
+                    datasets.append(dataset_wrapper)
+                    continue
+                cache_stats.misses.append(str(source_path))
+
+            if shard is not None:
+                shard_path = get_source_shard_path(source_path, *shard)
+                if load_prepared_source(shard_path) is None:
+                    ds_shard = ds.shard(
+                        num_shards=shard[1], index=shard[0], contiguous=True
+                    )
+                    LOG.info(
+                        f"Preparing shard {shard[0]} of {shard[1]} for {config_dataset.path}"
+                    )
+                    dataset_wrapper, _ = get_dataset_wrapper(
+                        config_dataset=config_dataset,
+                        tokenizer=tokenizer,
+                        cfg=cfg,
+                        d_base_type=d_base_type,
+                        dataset=ds_shard,
+                        d_prompt_style=d_prompt_style,
+                        processor=processor,
+                    )
+                    # already tokenized datasets are left for the merging rank to load
+                    if dataset_wrapper is not ds_shard:
+                        save_prepared_source(dataset_wrapper, shard_path)
+                continue
+
+            if num_shards > 1:
+                dataset_wrapper = load_prepared_source_shards(source_path, num_shards)
+                if dataset_wrapper is not None:
+                    LOG.info(
+                        f"Merged {num_shards} prepared shards for {config_dataset.path}"
+                    )
+                    if cache_per_source and cfg.local_rank == 0:
+                        save_prepared_source(dataset_wrapper, source_path)
+                    merged_shards.append(source_path)
+                    datasets.append(dataset_wrapper)
+                    continue
+
             dataset_wrapper, dataset_prompter = get_dataset_wrapper(
                 config_dataset=config_dataset,
                 tokenizer=tokenizer,
@@ -291,9 +422,20 @@ def load_tokenized_prepared_datasets(
                 d_prompt_style=d_prompt_style,
                 processor=processor,
             )
+            if source_path and cfg.local_rank == 0 and dataset_wrapper is not ds:
+                LOG.info(
+                    f"Saving prepared dataset for {config_dataset.path} to {source_path}"
+                )
+                save_prepared_source(dataset_wrapper, source_path)
             datasets.append(dataset_wrapper)
             prompters.append(dataset_prompter)
 
+        if shard is not None:
+            return None, prompters
+
+        if cache_per_source:
+            cache_stats.log_summary()
+
         if len(datasets) == 1:
             dataset = datasets[0]
         else:
@@ -313,6 +455,11 @@ def load_tokenized_prepared_datasets(
         if cfg.local_rank == 0 and not cfg.skip_prepare_dataset:
             LOG.info(f"Saving merged prepared dataset to disk... {prepared_ds_path}")
             dataset.save_to_disk(str(prepared_ds_path))
+            if merged_shards:
+                # the merged dataset holds its own copy of the shards, stop reading from them
+                dataset = load_from_disk(str(prepared_ds_path))
+                for source_path in merged_shards:
+                    remove_prepared_source_shards(source_path)
             if cfg.push_dataset_to_hub:
                 LOG.info(
                     f"Pushing merged prepared dataset to Huggingface hub at {cfg.push_dataset_to_hub} (version {ds_hash})..."
@@ -377,7 +524,11 @@ def load_prepare_datasets(
         train_fingerprint = md5(to_hash_train)
         test_fingerprint = md5(to_hash_test)
         if cfg.dataset_exact_deduplication:
-            _, _, dataset = deduplicate_and_log_datasets(dataset=dataset)
+            _, _, dataset = deduplicate_and_log_datasets(
+                dataset=dataset, num_proc=cfg.dataset_processes
+            )
+        if cfg.dataset_near_deduplication:
+            _, _, dataset = near_deduplicate_and_log_datasets(cfg, dataset=dataset)
         dataset = dataset.train_test_split(
             test_size=val_set_size,
             shuffle=False,
@@ -390,15 +541,27 @@ def load_prepare_datasets(
         eval_dataset = dataset["test"]
     elif split == "test":
         if cfg.dataset_exact_deduplication:
-            _, eval_dataset, _ = deduplicate_and_log_datasets(eval_dataset=dataset)
+            _, eval_dataset, _ = deduplicate_and_log_datasets(
+                eval_dataset=dataset, num_proc=cfg.dataset_processes
+            )
         else:
             eval_dataset = dataset
+        if cfg.dataset_near_deduplication:
+            _, eval_dataset, _ = near_deduplicate_and_log_datasets(
+                cfg, eval_dataset=eval_dataset
+            )
         train_dataset = None
     else:
         if cfg.dataset_exact_deduplication:
-            train_dataset, _, _ = deduplicate_and_log_datasets(train_dataset=dataset)
+            train_dataset, _, _ = deduplicate_and_log_datasets(
+                train_dataset=dataset, num_proc=cfg.dataset_processes
+            )
         else:
             train_dataset = dataset
+        if cfg.dataset_near_deduplication:
+            train_dataset, _, _ = near_deduplicate_and_log_datasets(
+                cfg, train_dataset=train_dataset
+            )
         eval_dataset = None
     return train_dataset, eval_dataset, prompters
 
@@ -4,8 +4,12 @@ import hashlib
 import logging
 import time
 from enum import Enum
+from typing import Callable, Optional
 
 import huggingface_hub
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests
 from datasets import Dataset
 
@@ -63,40 +67,109 @@ def sha256(to_hash: str, encoding: str = "utf-8") -> str:
     return hashlib.sha256(to_hash.encode(encoding)).hexdigest()
 
 
+def _column_row_bytes(chunk: pa.Array) -> Callable[[int], bytes]:
+    """
+    The bytes of each row of a column: the raw buffer of integer token lists, the value of
+    numeric scalars, and the repr of anything else.
+    """
+    if (
+        chunk.null_count == 0
+        and (pa.types.is_list(chunk.type) or pa.types.is_large_list(chunk.type))
+        and pa.types.is_integer(chunk.type.value_type)
+    ):
+        offsets = np.zeros(len(chunk) + 1, dtype=np.int64)
+        np.cumsum(
+            pc.list_value_length(chunk).to_numpy(  # pylint: disable=no-member
+                zero_copy_only=False
+            ),
+            out=offsets[1:],
+        )
+        values = (
+            pc.list_flatten(chunk)  # pylint: disable=no-member
+            .to_numpy(zero_copy_only=False)
+            .astype(np.int64)
+        )
+        return lambda idx: (
+            int(offsets[idx + 1] - offsets[idx]).to_bytes(8, "little")
+            + values[offsets[idx] : offsets[idx + 1]].tobytes()
+        )
+    if chunk.null_count == 0 and pa.types.is_integer(chunk.type):
+        integers = chunk.to_numpy(zero_copy_only=False).astype(np.int64)
+        return lambda idx: integers[idx].tobytes()
+    if chunk.null_count == 0 and pa.types.is_floating(chunk.type):
+        floats = chunk.to_numpy(zero_copy_only=False).astype(np.float64)
+        return lambda idx: floats[idx].tobytes()
+
+    rows = chunk.to_pylist()
+
+    def repr_bytes(idx: int) -> bytes:
+        encoded = repr(rows[idx]).encode("utf-8")
+        return len(encoded).to_bytes(8, "little") + encoded
+
+    return repr_bytes
+
+
+def _row_digests(batch: pa.Table) -> dict[str, np.ndarray]:
+    columns = [
+        (
+            column.encode("utf-8") + b"\0",
+            _column_row_bytes(batch[column].combine_chunks()),
+        )
+        for column in sorted(batch.column_names)
+    ]
+    digests = np.empty((batch.num_rows, 2), dtype=np.uint64)
+    for idx in range(batch.num_rows):
+        row_hash = hashlib.blake2b(digest_size=16)
+        for name, row_bytes in columns:
+            row_hash.update(name)
+            row_hash.update(row_bytes(idx))
+        digests[idx] = np.frombuffer(row_hash.digest(), dtype=np.uint64)
+    return {"digest_hi": digests[:, 0], "digest_lo": digests[:, 1]}
+
+
+def compute_row_digests(dataset: Dataset, num_proc: Optional[int] = None) -> np.ndarray:
+    """
+    128-bit blake2b digest of every row over all of its columns, as an array of 16 byte
+    void scalars that numpy can sort and compare. Token lists hash their raw buffers.
+    """
+    if len(dataset) == 0:
+        return np.empty(0, dtype=np.dtype((np.void, 16)))
+    digests = (
+        dataset.with_format("arrow")
+        .map(
+            _row_digests,
+            batched=True,
+            num_proc=num_proc if num_proc and len(dataset) > num_proc else None,
+            remove_columns=dataset.column_names,
+            keep_in_memory=True,
+            desc="Hashing rows for deduplication",
+        )
+        .with_format("numpy")
+    )
+    digests = np.stack([digests["digest_hi"], digests["digest_lo"]], axis=1).astype(
+        np.uint64
+    )
+    return np.ascontiguousarray(digests).view(np.dtype((np.void, 16))).ravel()
+
+
 def deduplicate_dataset(
-    dataset: Dataset, seen_hashes: dict[str, list[int]], other_dataset: Dataset = None
-) -> Dataset:
-    unique_indices = []
-
-    for idx, row in enumerate(dataset):
-        row_hash = sha256(str(row))  # Using SHA256 for collision resistance.
-        if row_hash not in seen_hashes:
-            seen_hashes[row_hash] = [idx]
-            unique_indices.append(idx)
-        else:
-            # Check for collision by looking up the original dataset indices
-            original_indices = seen_hashes[row_hash]
-            is_duplicate = False
-            for original_idx in original_indices:
-                if (
-                    not idx == original_idx
-                    and original_idx < len(dataset)
-                    and str(dataset[original_idx]) == str(row)
-                ):
-                    is_duplicate = True
-                    break
-                # Check in the other dataset if provided
-                if other_dataset is not None:
-                    if original_idx < len(other_dataset) and str(
-                        other_dataset[original_idx]
-                    ) == str(row):
-                        is_duplicate = True
-                        break
-            if not is_duplicate:
-                seen_hashes[row_hash].append(idx)
-                unique_indices.append(idx)
-                continue
-    return dataset.select(unique_indices)
+    dataset: Dataset,
+    seen_digests: Optional[np.ndarray] = None,
+    num_proc: Optional[int] = None,
+) -> tuple[Dataset, np.ndarray]:
+    """
+    Keep the first occurrence of each row, also dropping rows whose digest is in
+    `seen_digests`. Returns the deduplicated dataset and the digests of its rows.
+    """
+    digests = compute_row_digests(dataset, num_proc=num_proc)
+    _, first_indices = np.unique(digests, return_index=True)
+    first_indices = np.sort(first_indices)
+    if seen_digests is not None and len(seen_digests):
+        first_indices = first_indices[~np.isin(digests[first_indices], seen_digests)]
+
+    if len(first_indices) < len(dataset):
+        dataset = dataset.select(first_indices)
+    return dataset, digests[first_indices]
 
 
 def deduplicate_and_log_datasets(
@@ -104,6 +177,7 @@ def deduplicate_and_log_datasets(
     train_dataset: Dataset = None,
     eval_dataset: Dataset = None,
     dataset: Dataset = None,
+    num_proc: Optional[int] = None,
 ) -> tuple[Dataset, Dataset, Dataset]:
     """
     Deduplicates train, eval, and an optional dataset if provided, logging original and new sizes.
@@ -111,15 +185,16 @@ def deduplicate_and_log_datasets(
     Returns:
         tuple: Deduplicated train, eval, and additional datasets.
     """
-    seen_hashes: dict[str, list[int]] = {}
+    # digests of the deduplicated train rows, reused to drop eval rows seen in train
+    train_digests = None
 
     # Handle cases where datasets are None
     if train_dataset is not None:
         LOG.info(
             f"Starting deduplication for train dataset. Original size: {len(train_dataset)}"
         )
-        train_dataset = deduplicate_dataset(
-            dataset=train_dataset, seen_hashes=seen_hashes
+        train_dataset, train_digests = deduplicate_dataset(
+            dataset=train_dataset, num_proc=num_proc
         )
         LOG.info(
             f"Deduplication complete for train dataset. New size: {len(train_dataset)}"
@@ -131,8 +206,8 @@ def deduplicate_and_log_datasets(
         LOG.info(
             f"Starting deduplication for eval dataset. Original size: {len(eval_dataset)}"
         )
-        eval_dataset = deduplicate_dataset(
-            dataset=eval_dataset, seen_hashes=seen_hashes, other_dataset=train_dataset
+        eval_dataset, _ = deduplicate_dataset(
+            dataset=eval_dataset, seen_digests=train_digests, num_proc=num_proc
         )
         LOG.info(
             f"Deduplication complete for eval dataset. New size: {len(eval_dataset)}"
@@ -144,7 +219,7 @@ def deduplicate_and_log_datasets(
         LOG.info(
             f"Starting deduplication for combined dataset. Original size: {len(dataset)}"
         )
-        dataset = deduplicate_dataset(dataset=dataset, seen_hashes=seen_hashes)
+        dataset, _ = deduplicate_dataset(dataset=dataset, num_proc=num_proc)
         LOG.info(
             f"Deduplication complete for combined dataset. New size: {len(dataset)}"
         )
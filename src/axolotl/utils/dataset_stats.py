@@ -0,0 +1,77 @@
+"""
+per-row token statistics computed from the Arrow buffers of tokenized datasets
+"""
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import Dataset
+
+# pylint: disable=no-member
+
+
+def list_lengths(column: pa.ChunkedArray) -> np.ndarray:
+    """
+    Per-row lengths of a list column, i.e. the differences of its offsets buffer.
+    """
+    return pc.list_value_length(column).to_numpy(zero_copy_only=False)
+
+
+def count_trainable_tokens(labels: pa.ChunkedArray) -> np.ndarray:
+    """
+    Per-row count of labels not equal to -100, reduced by segment over the flattened values.
+    """
+    counts = []
+    # one chunk at a time, so the boolean mask never spans the whole column
+    for chunk in labels.chunks:
+        offsets = np.zeros(len(chunk) + 1, dtype=np.int64)
+        np.cumsum(list_lengths(chunk), out=offsets[1:])
+        trainable = np.zeros(offsets[-1] + 1, dtype=np.int64)
+        np.cumsum(
+            pc.not_equal(pc.list_flatten(chunk), -100).to_numpy(zero_copy_only=False),
+            out=trainable[1:],
+        )
+        counts.append(trainable[offsets[1:]] - trainable[offsets[:-1]])
+    if not counts:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(counts)
+
+
+def last_values(column: pa.ChunkedArray) -> np.ndarray:
+    """
+    Last element of each (non-empty) row of a list column.
+    """
+    values = []
+    for chunk in column.chunks:
+        ends = np.cumsum(list_lengths(chunk)) - 1
+        values.append(
+            pc.list_flatten(chunk).to_numpy(zero_copy_only=False)[ends].astype(np.int64)
+        )
+    if not values:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(values)
+
+
+def _select_rows(dataset: Dataset, values: np.ndarray) -> np.ndarray:
+    # stats are computed over the underlying table, so follow any select/shuffle mapping
+    indices = dataset._indices  # pylint: disable=protected-access
+    if indices is None:
+        return values
+    return values[indices.column(0).to_numpy()]
+
+
+def get_row_lengths(dataset: Dataset, column: str = "input_ids") -> np.ndarray:
+    return _select_rows(dataset, list_lengths(dataset.data.column(column)))
+
+
+def get_trainable_token_counts(dataset: Dataset) -> np.ndarray:
+    return _select_rows(dataset, count_trainable_tokens(dataset.data.column("labels")))
+
+
+def get_position_id_lengths(dataset: Dataset) -> np.ndarray:
+    return _select_rows(dataset, last_values(dataset.data.column("position_ids")) + 1)
+
+
+def get_length_column(dataset: Dataset) -> np.ndarray:
+    return _select_rows(
+        dataset, dataset.data.column("length").to_numpy().astype(np.int64)
+    )
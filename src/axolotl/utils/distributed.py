@@ -86,6 +86,10 @@ def get_world_size():
     return int(os.getenv("WORLD_SIZE", "1"))
 
 
+def get_rank():
+    return int(os.getenv("RANK", "0"))
+
+
 @contextmanager
 def zero_only():
     """
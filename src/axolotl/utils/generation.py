@@ -0,0 +1,254 @@
+"""
+token-native batched generation: prompts are bucketed by length under a token budget,
+left padded, and rows are dropped from the batch and its kv cache as soon as they finish
+"""
+import inspect
+import logging
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import (
+    DynamicCache,
+    GenerationConfig,
+    LogitsProcessorList,
+    PreTrainedModel,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+LOG = logging.getLogger("axolotl")
+
+
+def bucket_by_token_budget(
+    prompt_lengths: Sequence[int], max_new_tokens: int, max_tokens: int
+) -> List[List[int]]:
+    """
+    Group prompt indices into batches of similar lengths, such that the left padded prompts
+    plus `max_new_tokens` generated tokens of every batch fit in `max_tokens` tokens.
+
+    Batches are returned longest first, so running out of memory happens on the first one.
+    """
+    lengths = np.asarray(prompt_lengths, dtype=np.int64)
+    order = np.argsort(-lengths, kind="stable")
+    buckets: List[List[int]] = []
+    bucket: List[int] = []
+    for idx in order.tolist():
+        # the first prompt of a bucket is its longest, so it sets the padded width
+        width = lengths[bucket[0] if bucket else idx] + max_new_tokens
+        if bucket and (len(bucket) + 1) * width > max_tokens:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(idx)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def left_pad(
+    prompts: Sequence[Sequence[int]], pad_token_id: int, device=None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    width = max(len(prompt) for prompt in prompts)
+    input_ids = torch.full((len(prompts), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(prompts), width), dtype=torch.long)
+    for row, prompt in enumerate(prompts):
+        if len(prompt):
+            input_ids[row, -len(prompt) :] = torch.as_tensor(prompt, dtype=torch.long)
+            attention_mask[row, -len(prompt) :] = 1
+    return input_ids.to(device), attention_mask.to(device)
+
+
+def _eos_token_ids(generation_config: GenerationConfig) -> List[int]:
+    eos_token_id = generation_config.eos_token_id
+    if eos_token_id is None:
+        return []
+    if isinstance(eos_token_id, int):
+        return [eos_token_id]
+    return list(eos_token_id)
+
+
+def _truncate_after_eos(
+    tokens: List[int], generation_config: GenerationConfig
+) -> List[int]:
+    # drop the padding `generate` appends to rows finishing before the rest of the batch
+    eos_token_ids = set(_eos_token_ids(generation_config))
+    for idx, token in enumerate(tokens):
+        if token in eos_token_ids:
+            return tokens[: idx + 1]
+    return tokens
+
+
+def _logits_processors(generation_config: GenerationConfig) -> LogitsProcessorList:
+    processors = LogitsProcessorList()
+    if generation_config.repetition_penalty not in (None, 1.0):
+        processors.append(
+            RepetitionPenaltyLogitsProcessor(generation_config.repetition_penalty)
+        )
+    if not generation_config.do_sample:
+        return processors
+    if generation_config.temperature not in (None, 1.0):
+        processors.append(TemperatureLogitsWarper(generation_config.temperature))
+    if generation_config.top_k:
+        processors.append(TopKLogitsWarper(generation_config.top_k))
+    if generation_config.top_p not in (None, 1.0):
+        processors.append(TopPLogitsWarper(generation_config.top_p))
+    return processors
+
+
+def _supports_early_exit(model: PreTrainedModel) -> bool:
+    # rows are dropped from a DynamicCache, other caches fall back to `generate`
+    return bool(getattr(model, "_supports_cache_class", False))
+
+
+def _supports_num_logits_to_keep(model: PreTrainedModel) -> bool:
+    base_model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    return "num_logits_to_keep" in inspect.signature(base_model.forward).parameters
+
+
+@torch.no_grad()
+def generate_with_early_exit(
+    model: PreTrainedModel,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    generation_config: GenerationConfig,
+) -> List[List[int]]:
+    """
+    Decode a left padded batch, removing each row from the batch and the kv cache once it
+    emits an eos token, so the remaining steps only compute the unfinished rows.
+
+    Returns the generated tokens of every row, including the final eos token.
+    """
+    eos_token_ids = torch.tensor(
+        _eos_token_ids(generation_config), device=input_ids.device
+    )
+    processors = _logits_processors(generation_config)
+    forward_kwargs = {}
+    if _supports_num_logits_to_keep(model):
+        forward_kwargs["num_logits_to_keep"] = 1
+
+    generated: List[List[int]] = [[] for _ in range(len(input_ids))]
+    rows = list(range(len(input_ids)))
+    sequences = input_ids
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    next_input_ids = input_ids
+    cache = DynamicCache()
+    for step in range(generation_config.max_new_tokens):
+        logits = model(
+            input_ids=next_input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+            **forward_kwargs,
+        ).logits[:, -1, :]
+        scores = processors(sequences, logits.float())
+        if generation_config.do_sample:
+            next_tokens = torch.multinomial(scores.softmax(dim=-1), 1).squeeze(1)
+        else:
+            next_tokens = scores.argmax(dim=-1)
+
+        for row, token in zip(rows, next_tokens.tolist()):
+            generated[row].append(token)
+        if step == generation_config.max_new_tokens - 1:
+            break
+
+        unfinished = ~torch.isin(next_tokens, eos_token_ids)
+        if not unfinished.any():
+            break
+        if not unfinished.all():
+            keep = unfinished.nonzero().squeeze(1)
+            cache.batch_select_indices(keep)
+            rows = [rows[idx] for idx in keep.tolist()]
+            next_tokens = next_tokens[keep]
+            sequences = sequences[keep]
+            attention_mask = attention_mask[keep]
+            position_ids = position_ids[keep]
+
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_ones((len(rows), 1))], dim=-1
+        )
+        position_ids = position_ids[:, -1:] + 1
+        next_input_ids = next_tokens[:, None]
+
+    return generated
+
+
+def iter_generate_batched(
+    model: PreTrainedModel,
+    prompts: Sequence[Sequence[int]],
+    generation_config: GenerationConfig,
+    pad_token_id: int,
+    max_tokens: int,
+    device=None,
+    show_progress: bool = True,
+) -> Iterator[Tuple[List[int], List[List[int]]]]:
+    """
+    Generate completions for tokenized prompts, in batches of similar prompt lengths holding
+    at most `max_tokens` prompt and generated tokens.
+
+    Yields the prompt indices of each batch along with their generated tokens, as soon as
+    the batch is done.
+    """
+    device = device if device is not None else model.device
+    buckets = bucket_by_token_budget(
+        [len(prompt) for prompt in prompts],
+        generation_config.max_new_tokens,
+        max_tokens,
+    )
+    LOG.debug(f"Generating {len(prompts)} completions in {len(buckets)} batches")
+
+    for bucket in tqdm(buckets, disable=not show_progress):
+        input_ids, attention_mask = left_pad(
+            [prompts[idx] for idx in bucket], pad_token_id, device=device
+        )
+        if _supports_early_exit(model):
+            generated = generate_with_early_exit(
+                model, input_ids, attention_mask, generation_config
+            )
+        else:
+            with torch.no_grad():
+                sequences = model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    generation_config=generation_config,
+                )
+            if not isinstance(sequences, torch.Tensor):
+                sequences = sequences["sequences"]
+            generated = [
+                _truncate_after_eos(tokens, generation_config)
+                for tokens in sequences[:, input_ids.shape[1] :].tolist()
+            ]
+        yield bucket, generated
+
+
+def generate_batched(
+    model: PreTrainedModel,
+    prompts: Sequence[Sequence[int]],
+    generation_config: GenerationConfig,
+    pad_token_id: int,
+    max_tokens: int,
+    device=None,
+    show_progress: bool = True,
+) -> List[List[int]]:
+    """
+    Generate completions for tokenized prompts with `iter_generate_batched`.
+
+    Returns the generated tokens for each prompt, in the order of `prompts`.
+    """
+    completions: List[Optional[List[int]]] = [None] * len(prompts)
+    for bucket, generated in iter_generate_batched(
+        model,
+        prompts,
+        generation_config,
+        pad_token_id,
+        max_tokens,
+        device=device,
+        show_progress=show_progress,
+    ):
+        for idx, tokens in zip(bucket, generated):
+            completions[idx] = tokens
+    return completions  # type: ignore[return-value]
@@ -0,0 +1,244 @@
+"""
+merge a LoRA adapter into the safetensors shards of its base model one shard at a time,
+without loading the model
+"""
+import json
+import logging
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import safetensors.torch as st
+import torch
+from safetensors import safe_open
+
+LOG = logging.getLogger("axolotl")
+
+SAFETENSORS_INDEX_NAME = "model.safetensors.index.json"
+PEFT_KEY_PREFIX = "base_model.model."
+# weight files of the base model, which are written merged rather than copied
+WEIGHT_FILE_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".index.json")
+
+
+def get_weight_map(model_dir: Path) -> Dict[str, str]:
+    """
+    Map each tensor name of a safetensors checkpoint to the shard holding it.
+    """
+    index_path = model_dir / SAFETENSORS_INDEX_NAME
+    if index_path.exists():
+        with open(index_path, encoding="utf-8") as file:
+            return json.load(file)["weight_map"]
+
+    single_path = model_dir / "model.safetensors"
+    if not single_path.exists():
+        raise ValueError(
+            f"Streaming LoRA merge requires safetensors weights, none found in {model_dir}"
+        )
+    with safe_open(str(single_path), framework="pt") as file:
+        return {key: single_path.name for key in file.keys()}
+
+
+def _pattern_value(pattern: Dict[str, Union[int, float]], module_name: str, default):
+    # same matching as peft uses for rank_pattern / alpha_pattern
+    for key, value in pattern.items():
+        if re.match(rf"(.*\.)?{key}$", module_name):
+            return value
+    return default
+
+
+class LoraAdapter:
+    """
+    LoRA factors of a saved adapter, keyed by the base model weight they update.
+    """
+
+    def __init__(self, adapter_dir: Path):
+        with open(adapter_dir / "adapter_config.json", encoding="utf-8") as file:
+            self.config = json.load(file)
+        if self.config.get("peft_type", "LORA") != "LORA":
+            raise ValueError(f"Can't merge a {self.config['peft_type']} adapter")
+        if self.config.get("use_dora") or self.config.get("lora_bias"):
+            raise ValueError(
+                "Streaming LoRA merge doesn't support DoRA or LoRA bias adapters"
+            )
+
+        adapter_path = adapter_dir / "adapter_model.safetensors"
+        if adapter_path.exists():
+            tensors = st.load_file(str(adapter_path))
+        else:
+            tensors = torch.load(
+                adapter_dir / "adapter_model.bin", map_location="cpu", weights_only=True
+            )
+
+        # base weight name -> (lora A, lora B, is embedding)
+        self.factors: Dict[str, Tuple[torch.Tensor, torch.Tensor, bool]] = {}
+        # base weight name -> full tensor saved with the adapter, i.e. modules_to_save
+        self.replacements: Dict[str, torch.Tensor] = {}
+        lora_a: Dict[str, Tuple[torch.Tensor, bool]] = {}
+        lora_b: Dict[str, torch.Tensor] = {}
+        for key, tensor in tensors.items():
+            key = key.removeprefix(PEFT_KEY_PREFIX)
+            if key.endswith(".lora_A.weight"):
+                lora_a[key[: -len(".lora_A.weight")]] = (tensor, False)
+            elif key.endswith(".lora_embedding_A"):
+                lora_a[key[: -len(".lora_embedding_A")]] = (tensor, True)
+            elif key.endswith(".lora_B.weight"):
+                lora_b[key[: -len(".lora_B.weight")]] = tensor
+            elif key.endswith(".lora_embedding_B"):
+                lora_b[key[: -len(".lora_embedding_B")]] = tensor
+            else:
+                self.replacements[key.replace(".base_layer.", ".")] = tensor
+        for module_name, (tensor_a, is_embedding) in lora_a.items():
+            self.factors[module_name + ".weight"] = (
+                tensor_a,
+                lora_b[module_name],
+                is_embedding,
+            )
+
+    def scaling(self, module_name: str) -> float:
+        rank = _pattern_value(
+            self.config.get("rank_pattern") or {}, module_name, self.config["r"]
+        )
+        alpha = _pattern_value(
+            self.config.get("alpha_pattern") or {},
+            module_name,
+            self.config["lora_alpha"],
+        )
+        if self.config.get("use_rslora"):
+            return alpha / rank**0.5
+        return alpha / rank
+
+    def delta_weight(self, key: str) -> torch.Tensor:
+        tensor_a, tensor_b, is_embedding = self.factors[key]
+        delta = tensor_b.float() @ tensor_a.float()
+        # embeddings store A as (r, num_embeddings), fan_in_fan_out stores weights transposed
+        if is_embedding or self.config.get("fan_in_fan_out"):
+            delta = delta.T
+        return delta * self.scaling(key.removesuffix(".weight"))
+
+
+def merge_lora_shard(
+    base_dir: Path,
+    output_dir: Path,
+    shard_name: str,
+    keys: List[str],
+    adapter: LoraAdapter,
+    torch_dtype: Optional[torch.dtype] = None,
+) -> Dict[str, Tuple[int, ...]]:
+    """
+    Merge the LoRA deltas of one base shard, reading its tensors lazily one at a time, and
+    write it to `output_dir`. Adapter tensors in `keys` but not in the shard are added to it.
+
+    Returns the shapes of the tensors replaced with differently shaped adapter tensors.
+    """
+    out_tensors: Dict[str, torch.Tensor] = {}
+    resized: Dict[str, Tuple[int, ...]] = {}
+    with safe_open(str(base_dir / shard_name), framework="pt") as file:
+        shard_keys = set(file.keys())
+        for key in keys:
+            if key in adapter.replacements:
+                tensor = adapter.replacements[key]
+                if key in shard_keys and file.get_slice(key).get_shape() != list(
+                    tensor.shape
+                ):
+                    resized[key] = tuple(tensor.shape)
+            else:
+                tensor = file.get_tensor(key)
+            if key in adapter.factors:
+                tensor = (tensor.float() + adapter.delta_weight(key)).to(tensor.dtype)
+            if torch_dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(torch_dtype)
+            out_tensors[key] = tensor.contiguous()
+        metadata = file.metadata() or {"format": "pt"}
+
+    st.save_file(out_tensors, str(output_dir / shard_name), metadata=metadata)
+    LOG.debug(f"merged {len(out_tensors)} tensors into {output_dir / shard_name}")
+    return resized
+
+
+def merge_lora_sharded(
+    base_dir: Union[str, Path],
+    adapter_dir: Union[str, Path],
+    output_dir: Union[str, Path],
+    torch_dtype: Optional[torch.dtype] = None,
+    num_workers: int = 1,
+):
+    """
+    Merge a LoRA adapter into a safetensors checkpoint shard by shard, so that peak memory
+    is about `num_workers` shards plus the adapter rather than the whole model.
+    """
+    base_dir, adapter_dir, output_dir = (
+        Path(base_dir),
+        Path(adapter_dir),
+        Path(output_dir),
+    )
+    output_dir.mkdir(parents=True, exist_ok=True)
+    adapter = LoraAdapter(adapter_dir)
+    weight_map = get_weight_map(base_dir)
+
+    missing = [key for key in adapter.factors if key not in weight_map]
+    if missing:
+        raise ValueError(
+            f"LoRA adapter updates weights missing from the base model: {missing[:5]}"
+        )
+    # tensors only saved with the adapter, e.g. an untied lm_head, go to the last shard
+    shard_names = sorted(set(weight_map.values()))
+    for key in adapter.replacements:
+        weight_map.setdefault(key, shard_names[-1])
+    shard_keys: Dict[str, List[str]] = {name: [] for name in shard_names}
+    for key, shard_name in weight_map.items():
+        shard_keys[shard_name].append(key)
+
+    LOG.info(
+        f"merging {len(adapter.factors)} LoRA weights into {len(shard_names)} shards "
+        f"with {num_workers} worker(s)"
+    )
+    resized: Dict[str, Tuple[int, ...]] = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for shard_resized in executor.map(
+            lambda shard_name: merge_lora_shard(
+                base_dir,
+                output_dir,
+                shard_name,
+                shard_keys[shard_name],
+                adapter,
+                torch_dtype=torch_dtype,
+            ),
+            shard_names,
+        ):
+            resized.update(shard_resized)
+
+    if (base_dir / SAFETENSORS_INDEX_NAME).exists():
+        total_size = sum((output_dir / name).stat().st_size for name in shard_names)
+        with open(output_dir / SAFETENSORS_INDEX_NAME, "w", encoding="utf-8") as file:
+            json.dump(
+                {"metadata": {"total_size": total_size}, "weight_map": weight_map},
+                file,
+                indent=2,
+            )
+
+    for path in base_dir.iterdir():
+        if path.is_file() and not path.name.endswith(WEIGHT_FILE_SUFFIXES):
+            shutil.copy(path, output_dir / path.name)
+    _update_config(output_dir, resized, torch_dtype)
+
+
+def _update_config(
+    output_dir: Path,
+    resized: Dict[str, Tuple[int, ...]],
+    torch_dtype: Optional[torch.dtype],
+):
+    config_path = output_dir / "config.json"
+    if not config_path.exists():
+        return
+    with open(config_path, encoding="utf-8") as file:
+        config = json.load(file)
+    # embeddings resized for added tokens are saved whole with the adapter
+    for key, shape in resized.items():
+        if key.endswith("embed_tokens.weight") or key.endswith("lm_head.weight"):
+            config["vocab_size"] = shape[0]
+    if torch_dtype is not None:
+        config["torch_dtype"] = str(torch_dtype).removeprefix("torch.")
+    with open(config_path, "w", encoding="utf-8") as file:
+        json.dump(config, file, indent=2)
@@ -0,0 +1,73 @@
+"""
+prefix-shared packing of preference rows: the prompt of a row is laid out once, followed by
+its chosen and rejected responses, which both attend to the prompt but not to each other
+"""
+from typing import Dict
+
+import torch
+
+# segment ids of the tokens of a packed preference sequence
+PAD_SEGMENT = -1
+PROMPT_SEGMENT = 0
+CHOSEN_SEGMENT = 1
+REJECTED_SEGMENT = 2
+
+
+def packed_preference_attention_mask(
+    sequence_ids: torch.Tensor, segment_ids: torch.Tensor, dtype: torch.dtype
+) -> torch.Tensor:
+    """
+    Build the additive 4D attention mask of a batch of packed preference sequences: tokens
+    attend causally within their own preference row, except that rejected tokens skip the
+    chosen response laid out between them and the prompt.
+    """
+    length = sequence_ids.shape[1]
+    causal = torch.ones(
+        (length, length), dtype=torch.bool, device=sequence_ids.device
+    ).tril()
+    allowed = (sequence_ids[:, :, None] == sequence_ids[:, None, :]) & causal
+    allowed &= ~(
+        (segment_ids[:, :, None] == REJECTED_SEGMENT)
+        & (segment_ids[:, None, :] == CHOSEN_SEGMENT)
+    )
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=sequence_ids.device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)[:, None]
+
+
+def packed_preference_logps(
+    logits: torch.Tensor, batch: Dict[str, torch.Tensor]
+) -> Dict[str, torch.Tensor]:
+    """
+    Sum the log-probs of the chosen and rejected tokens of every preference row of a packed
+    batch, in the order the rows were packed.
+
+    Only the logits predicting response tokens are normalized, rather than the whole batch.
+    """
+    logits_positions = batch["logits_positions"]
+    rows, cols = (logits_positions >= 0).nonzero(as_tuple=True)
+    token_logits = logits[rows, logits_positions[rows, cols]]
+    labels = batch["input_ids"][rows, cols]
+    token_logps = (
+        token_logits.float().log_softmax(-1).gather(-1, labels[:, None]).squeeze(-1)
+    )
+
+    is_rejected = batch["segment_ids"][rows, cols] == REJECTED_SEGMENT
+    num_sequences = int(batch["sequence_ids"].max()) + 1
+    # chosen and rejected sums of each row are interleaved
+    index = batch["sequence_ids"][rows, cols] * 2 + is_rejected.long()
+    logps = (
+        token_logps.new_zeros(num_sequences * 2)
+        .index_add_(0, index, token_logps)
+        .view(num_sequences, 2)
+    )
+    num_tokens = torch.bincount(index, minlength=num_sequences * 2).view(
+        num_sequences, 2
+    )
+    return {
+        "chosen_logps": logps[:, 0],
+        "rejected_logps": logps[:, 1],
+        "chosen_num_tokens": num_tokens[:, 0],
+        "rejected_num_tokens": num_tokens[:, 1],
+        "mean_chosen_logits": token_logits[~is_rejected].mean(),
+        "mean_rejected_logits": token_logits[is_rejected].mean(),
+    }
@@ -2,4 +2,8 @@
 axolotl samplers module
 """
 from .multipack import MultipackBatchSampler  # noqa: F401
-from .utils import get_dataset_lengths  # noqa: F401
+from .utils import (  # noqa: F401
+    get_dataset_lengths,
+    get_packing_plan_cache_dir,
+    get_preference_lengths,
+)
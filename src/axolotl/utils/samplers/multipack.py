@@ -2,10 +2,12 @@
 """
 Multipack Batch Sampler
 """
+import hashlib
 import logging
 import math
 import os
-from typing import Any, Iterable, List, Union
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple, Union
 
 import numba
 import numpy as np
@@ -17,91 +19,98 @@ LOG = logging.getLogger("axolotl.utils.samplers.multipack")
 
 
 @numba.njit
-def ffd_check(a: np.ndarray, c: int, n: int):
-    # First-fit-decreasing bin packing
-    # Check if a[] could fit in n bins with capacity c
-    # https://en.wikipedia.org/wiki/First-fit-decreasing_bin_packing
-
-    a = np.sort(a)[::-1]
-    bins = np.full((n,), c, dtype=a.dtype)
-    for size in a:
-        not_found = True
-        for idx in range(n):
-            if bins[idx] >= size:
-                bins[idx] -= size
-                not_found = False
-                break
-
-        if not_found:
-            return False
-
-    return True
-
-
-@numba.njit
-def ffd_with_result(a: np.ndarray, c: int, start_index: int):
-    # First-fit-decreasing bin packing (with result return)
-
-    indices = np.argsort(a)[::-1]
-    a = a[indices]
-
-    bins: List[Any] = []
-    bins_result: List[Any] = []
-    for a_id, size in enumerate(a):
-        add_new = True
-        for idx in range(len(bins)):
-            if bins[idx] >= size:
-                bins[idx] -= size
-                bins_result[idx].append(indices[a_id] + start_index)
-                add_new = False
-                break
-
-        if add_new:
-            bins.append(c - size)
-            bins_result.append([indices[a_id] + start_index])
-
-    return bins_result
-
-
-@numba.njit
-def allocate(
-    lengths: np.ndarray, lengths_cumsum: np.ndarray, rank: int, c: int, n: int
-):
-    # Dynamic batch allocator, similar to Multifit
-    # https://en.wikipedia.org/wiki/Multifit_algorithm
-    # ~99.5% efficiency on OpenChat training set (12 * 2048 ctx len)
-
-    s = 0
-    start_index = 0
-    result = []
-
-    while True:
-        # binary search [l, r)
-        left = 1
-        right = 1 + np.searchsorted(lengths_cumsum[start_index:], s + c * n, "right")
-
-        while right - left > 1:
-            mid = (left + right) // 2
-            if ffd_check(lengths[start_index : start_index + mid], c, n):
-                left = mid
-            else:
-                right = mid
-
-        # use length l
-        batch = ffd_with_result(
-            lengths[start_index : start_index + left], c, start_index
-        )
-        assert len(batch) <= n
-        if len(batch) < n:
-            break
-
-        start_index += left
-        s = lengths_cumsum[start_index - 1]
+def pack_group(lengths: np.ndarray, c: int, bin_size: int):
+    # First-fit-decreasing bin packing of a single group, capped at bin_size samples
+    # per bin. A max segment tree over the remaining capacity of every (possibly not
+    # yet opened) bin finds the first fitting bin in O(log n) instead of a linear scan.
+    # Returns the bin of each sample (-1 if it can't fit in any bin) and the bin count.
+
+    n = len(lengths)
+    order = np.argsort(-lengths, kind="mergesort")
+    bin_of = np.full(n, -1, dtype=np.int64)
+
+    leaves = 1
+    while leaves < max(n, 1):
+        leaves *= 2
+    tree = np.full(2 * leaves, c, dtype=np.int64)
+    counts = np.zeros(leaves, dtype=np.int64)
+    num_bins = 0
+
+    for item in order:
+        size = lengths[item]
+        if tree[1] < size:
+            continue
+        node = 1
+        while node < leaves:
+            node = 2 * node if tree[2 * node] >= size else 2 * node + 1
+        bin_idx = node - leaves
+
+        bin_of[item] = bin_idx
+        counts[bin_idx] += 1
+        num_bins = max(num_bins, bin_idx + 1)
+        tree[node] -= size
+        if counts[bin_idx] >= bin_size:
+            tree[node] = -1
+        node //= 2
+        while node >= 1:
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+
+    return bin_of, num_bins
+
+
+@numba.njit(parallel=True)
+def pack_groups(lengths: np.ndarray, c: int, group_size: int, bin_size: int):
+    # Pack consecutive groups of group_size samples independently and in parallel.
+    # Returns the bin of each sample local to its group, and the bin count per group.
+
+    num_groups = (len(lengths) + group_size - 1) // group_size
+    bin_of = np.empty(len(lengths), dtype=np.int64)
+    group_num_bins = np.zeros(num_groups, dtype=np.int64)
+    for group in numba.prange(num_groups):
+        start = group * group_size
+        end = min(start + group_size, len(lengths))
+        group_bin_of, num_bins = pack_group(lengths[start:end], c, bin_size)
+        bin_of[start:end] = group_bin_of
+        group_num_bins[group] = num_bins
+    return bin_of, group_num_bins
+
+
+def allocate_groups(
+    lengths: np.ndarray,
+    c: int,
+    group_size: int,
+    bin_size: int,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack samples group-wise into bins of at most `c` tokens and `bin_size` samples.
 
-        # add local rank
-        result.append(batch[rank])
+    Returns the bin offsets and the positions (into `lengths`) of the packed samples,
+    bin by bin. Bins come group by group, longest first within each group, unless a
+    `seed` is given to shuffle them. Samples longer than `c` are left out.
+    """
+    group_size = max(int(group_size), 1)
+    bin_of, group_num_bins = pack_groups(
+        lengths.astype(np.int64), c, group_size, bin_size
+    )
+
+    group_bin_offsets = np.zeros(len(group_num_bins) + 1, dtype=np.int64)
+    np.cumsum(group_num_bins, out=group_bin_offsets[1:])
+    packed = np.flatnonzero(bin_of >= 0)
+    global_bin_of = bin_of[packed] + group_bin_offsets[:-1][packed // group_size]
+    if seed is not None:
+        global_bin_of = np.random.default_rng(seed).permutation(group_bin_offsets[-1])[
+            global_bin_of
+        ]
+    # stable, so samples keep their sampler order within each bin
+    packed = packed[np.argsort(global_bin_of, kind="stable")]
 
-    return result, s, len(result) * c * n
+    offsets = np.zeros(group_bin_offsets[-1] + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(global_bin_of, minlength=group_bin_offsets[-1]), out=offsets[1:]
+    )
+    return offsets, packed
 
 
 class MultipackBatchSampler(BatchSampler):
@@ -117,17 +126,28 @@ class MultipackBatchSampler(BatchSampler):
         lengths: np.ndarray,
         packing_efficiency_estimate: float = 1.0,
         drop_last: bool = False,
+        group_size: int = 100_000,
+        bin_size: int = 200,
+        seed: Optional[int] = None,
+        plan_cache_dir: Optional[Union[str, Path]] = None,
         **kwargs,
     ):
         super().__init__(sampler, batch_size, drop_last)
         self.batch_size = batch_size
         self.batch_max_len = batch_max_len
+        self.group_size = group_size
+        self.bin_size = bin_size
         self.lengths: np.ndarray = lengths
         self.packing_efficiency_estimate = packing_efficiency_estimate or 1.0
+        # reseeds the sampler's generator with seed + epoch so each epoch's order,
+        # and so its packing plan, is reproducible across __len__, __iter__ and runs
+        self.seed = seed
+        self.plan_cache_dir = Path(plan_cache_dir) if plan_cache_dir else None
 
         assert isinstance(self.lengths, np.ndarray)
 
         self.epoch = 0
+        self._epoch_started = False
 
         # statistics
         self.eff_total_used = 0
@@ -135,39 +155,110 @@ class MultipackBatchSampler(BatchSampler):
 
         self.len_across_ranks = None
 
+        self._lengths_hash = hashlib.md5(
+            np.ascontiguousarray(self.lengths, dtype=np.int64).tobytes(),
+            usedforsecurity=False,
+        ).hexdigest()
+        self._last_plan: Optional[Tuple[str, np.ndarray, np.ndarray]] = None
+
     def set_epoch(self, epoch: int):
         self.epoch = epoch
+        self._epoch_started = False
+
+    def _sampler_indices(self) -> np.ndarray:
+        generator = getattr(self.sampler, "generator", None)
+        if self.seed is not None and generator is not None:
+            generator.manual_seed(self.seed + self.epoch)
+        return np.fromiter(self.sampler, dtype=np.int64)
+
+    def _plan_key(self, indices: np.ndarray) -> str:
+        digest = hashlib.md5(usedforsecurity=False)
+        digest.update(self._lengths_hash.encode())
+        digest.update(
+            f"shuffled-groups:{self.batch_max_len}:{self.group_size}:{self.bin_size}".encode()
+        )
+        digest.update(indices.tobytes())
+        return digest.hexdigest()
+
+    def _plan_path(self, key: str) -> Optional[Path]:
+        if not self.plan_cache_dir:
+            return None
+        return self.plan_cache_dir / f"{key}.npy"
+
+    def _load_plan(self, key: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if self._last_plan and self._last_plan[0] == key:
+            return self._last_plan[1], self._last_plan[2]
+        path = self._plan_path(key)
+        if not path or not path.exists():
+            return None
+        # layout: [num_bins, bin offsets (num_bins + 1), packed sample indices]
+        plan = np.load(path, mmap_mode="r")
+        num_bins = int(plan[0])
+        os.utime(path)
+        return plan[1 : num_bins + 2], plan[num_bins + 2 :]
+
+    def _save_plan(self, key: str, offsets: np.ndarray, packed: np.ndarray):
+        path = self._plan_path(key)
+        if not path:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")
+        np.save(
+            tmp_path,
+            np.concatenate([[len(offsets) - 1], offsets, packed]).astype(np.int32),
+        )
+        os.replace(tmp_path, path)
+
+    def generate_plan(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pack the sampler's indices group-wise into bins of at most batch_max_len tokens
+        and bin_size samples, returning the bin offsets and the packed sample indices.
+        Plans are reused while the sampler order and lengths are unchanged, and persisted
+        to plan_cache_dir when set.
+        """
+        indices = self._sampler_indices()
+        key = self._plan_key(indices)
+        plan = self._load_plan(key)
+        if plan is None:
+            # bins are shuffled so batches don't go from the longest samples to the
+            # shortest ones within each group, seeded by the sampler order
+            offsets, packed = allocate_groups(
+                self.lengths[indices],
+                c=self.batch_max_len,
+                group_size=self.group_size,
+                bin_size=self.bin_size,
+                seed=int(key[:16], 16),
+            )
+            packed = indices[packed]
+            self._save_plan(key, offsets, packed)
+            plan = offsets, packed
+        self._last_plan = (key, *plan)
+        return plan
 
     def generate_batches(self, set_stats=False):
-        indices = [idx for idx in self.sampler]
-
-        lengths = self.lengths[indices]
-        lengths_cumsum = np.cumsum(lengths)
-
-        batches, total_used, total_slots = allocate(
-            lengths=lengths,
-            lengths_cumsum=lengths_cumsum,
-            rank=0,
-            c=self.batch_max_len,
-            n=1,
-        )
+        offsets, packed = self.generate_plan()
+        packed = np.asarray(packed)
 
+        bins = [
+            packed[start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])
+        ]
         batches = [
-            [
-                [indices[b_idx] for b_idx in batch]
-                for batch in batches[i : i + self.batch_size]
-            ]
-            for i in range(0, len(batches), self.batch_size)
+            bins[i : i + self.batch_size] for i in range(0, len(bins), self.batch_size)
         ]
 
         # statistics
         if set_stats:
-            self.eff_total_used += total_used
-            self.eff_total_slots += total_slots
+            self.eff_total_used += int(np.sum(self.lengths[packed]))
+            self.eff_total_slots += len(bins) * self.batch_max_len
 
         return batches
 
     def __iter__(self):
+        # move on to the next epoch unless set_epoch was called since the last one, as
+        # accelerate's BatchSamplerShard doesn't forward set_epoch under multi-GPU
+        if self._epoch_started:
+            self.epoch += 1
+        self._epoch_started = True
         batches = self.generate_batches(set_stats=True)
         return iter(batches)
 
@@ -1,17 +1,44 @@
 """
 helper util to calculate dataset lengths
 """
+from pathlib import Path
+from typing import Optional
+
 import numpy as np
 
+from axolotl.common.const import PACKING_PLANS_DIR
+from axolotl.utils.dataset_stats import (
+    get_length_column,
+    get_position_id_lengths,
+    get_row_lengths,
+)
+
 
 def get_dataset_lengths(dataset):
     if "length" in dataset.data.column_names:
-        lengths = np.array(dataset.data.column("length"))
-    elif "position_ids" in dataset.data.column_names:
-        position_ids = dataset.data.column("position_ids")
-        lengths = np.array([x[-1] + 1 for x in position_ids])
-    else:
-        input_ids = dataset.data.column("input_ids")
-        lengths = np.vectorize(len)(np.array(input_ids, dtype=object))
-        return lengths
-    return lengths
+        return get_length_column(dataset)
+    if "position_ids" in dataset.data.column_names:
+        return get_position_id_lengths(dataset)
+    return get_row_lengths(dataset)
+
+
+def get_preference_lengths(dataset, max_length: Optional[int] = None) -> np.ndarray:
+    """
+    Tokens of each tokenized preference row once packed as prompt, chosen and rejected, with
+    the responses truncated as by `PackedPreferenceCollator`.
+    """
+    prompt_lengths = get_row_lengths(dataset, "prompt_input_ids")
+    chosen_lengths = get_row_lengths(dataset, "chosen_input_ids")
+    rejected_lengths = get_row_lengths(dataset, "rejected_input_ids")
+    if max_length is not None:
+        max_response_lengths = np.maximum(max_length - prompt_lengths, 0)
+        chosen_lengths = np.minimum(chosen_lengths, max_response_lengths)
+        rejected_lengths = np.minimum(rejected_lengths, max_response_lengths)
+    return prompt_lengths + chosen_lengths + rejected_lengths
+
+
+def get_packing_plan_cache_dir(cfg) -> Optional[Path]:
+    # packing plans are stored next to the prepared datasets they were computed for
+    if not cfg.dataset_prepared_path:
+        return None
+    return Path(cfg.dataset_prepared_path) / PACKING_PLANS_DIR
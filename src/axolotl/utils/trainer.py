@@ -8,6 +8,7 @@ from functools import partial
 from typing import List, Optional
 
 import numpy as np
+import pyarrow as pa
 import torch
 import torch.cuda
 from accelerate.logging import get_logger
@@ -16,9 +17,19 @@ from torch.utils.data import DataLoader, RandomSampler
 from transformers.utils import is_torch_bf16_gpu_available
 
 from axolotl.core.trainer_builder import HFCausalTrainerBuilder, HFRLTrainerBuilder
+from axolotl.utils.dataset_stats import (
+    count_trainable_tokens,
+    get_row_lengths,
+    get_trainable_token_counts,
+    list_lengths,
+)
 from axolotl.utils.distributed import reduce_and_broadcast
 from axolotl.utils.environment import check_cuda_p2p_ib_support
-from axolotl.utils.samplers import MultipackBatchSampler, get_dataset_lengths
+from axolotl.utils.samplers import (
+    MultipackBatchSampler,
+    get_dataset_lengths,
+    get_packing_plan_cache_dir,
+)
 
 LOG = get_logger("axolotl")
 
@@ -178,18 +189,78 @@ def drop_long_seq(sample, sequence_len=2048, min_sequence_len=2):
     )
 
 
-def process_datasets_for_packing(cfg, train_dataset, eval_dataset):
-    drop_long = partial(
-        drop_long_seq,
-        sequence_len=cfg.sequence_len,
-        min_sequence_len=cfg.min_sample_len or 2,
-    )
-
-    min_input_len = np.min(get_dataset_lengths(train_dataset))
+def drop_unpackable_samples(dataset, sequence_len=2048, min_sequence_len=2, split=""):
+    """
+    Drop samples that are too long/short or have no trainable tokens, computing both
+    conditions from the Arrow buffers in one pass instead of per-row filters.
+    """
+    too_long_or_short = 0
+    no_trainable = 0
+    min_input_len, max_input_len = np.iinfo(np.int64).max, 0
+    keep = []
+    for batch in dataset.with_format("arrow").iter(batch_size=10_000):
+        lengths = list_lengths(batch["input_ids"])
+        if len(lengths):
+            min_input_len = min(min_input_len, int(lengths.min()))
+            max_input_len = max(max_input_len, int(lengths.max()))
+        length_ok = (lengths <= sequence_len) & (lengths >= min_sequence_len)
+        trainable = count_trainable_tokens(batch["labels"]) > 0
+        too_long_or_short += int(np.sum(~length_ok))
+        no_trainable += int(np.sum(length_ok & ~trainable))
+        keep.append(length_ok & trainable)
     LOG.debug(f"min_input_len: {min_input_len}", main_process_only=True)
-    max_input_len = np.max(get_dataset_lengths(train_dataset))
     LOG.debug(f"max_input_len: {max_input_len}", main_process_only=True)
 
+    if too_long_or_short:
+        LOG.warning(f"Dropped {too_long_or_short} long samples from {split} dataset")
+    if no_trainable:
+        LOG.warning(
+            f"Dropped {no_trainable} samples with no trainable tokens from {split} dataset"
+        )
+    if not too_long_or_short and not no_trainable:
+        return dataset
+    return dataset.select(np.flatnonzero(np.concatenate(keep)))
+
+
+def add_length_and_position_ids(batch: pa.Table, position_ids=True) -> pa.Table:
+    """
+    Batched, Arrow-native equivalent of `add_position_ids`/`add_length`, meant to be used
+    with `dataset.with_format("arrow").map(..., batched=True)`.
+    """
+    lengths = list_lengths(batch["input_ids"]).astype(np.int64)
+    if position_ids:
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.arange(offsets[-1], dtype=np.int64) - np.repeat(
+            offsets[:-1], lengths
+        )
+        if "position_ids" in batch.column_names:
+            batch = batch.drop_columns("position_ids")
+        batch = batch.append_column(
+            "position_ids",
+            pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), values),
+        )
+    if "length" in batch.column_names:
+        batch = batch.drop_columns("length")
+    return batch.append_column("length", pa.array(lengths))
+
+
+def _map_length_and_position_ids(cfg, dataset, desc, position_ids=True):
+    return (
+        dataset.with_format("arrow")
+        .map(
+            add_length_and_position_ids,
+            batched=True,
+            fn_kwargs={"position_ids": position_ids},
+            num_proc=cfg.dataset_processes,
+            load_from_cache_file=not cfg.is_preprocess,
+            desc=desc,
+        )
+        .with_format(dataset.format["type"])
+    )
+
+
+def process_datasets_for_packing(cfg, train_dataset, eval_dataset):
     if cfg.model_config_type == "mamba":
         LOG.info("dropping attention_mask column")
         train_dataset = train_dataset.remove_columns("attention_mask")
@@ -203,66 +274,19 @@ def process_datasets_for_packing(cfg, train_dataset, eval_dataset):
         if eval_dataset and "token_type_ids" in eval_dataset.column_names:
             eval_dataset = eval_dataset.remove_columns("token_type_ids")
 
-    prior_len = len(train_dataset)
-    train_dataset = train_dataset.filter(
-        drop_long,
-        num_proc=cfg.dataset_processes,
-        load_from_cache_file=not cfg.is_preprocess,
-        desc="Dropping Long Sequences",
-    )
-    dropped = prior_len - len(train_dataset)
-    if dropped:
-        LOG.warning(f"Dropped {dropped} long samples from train dataset")
-
-    if eval_dataset:
-        prior_len = len(eval_dataset)
-        eval_dataset = eval_dataset.filter(
-            drop_long,
-            num_proc=cfg.dataset_processes,
-            load_from_cache_file=not cfg.is_preprocess,
-            desc="Dropping Long Sequences",
-        )
-        dropped = prior_len - len(eval_dataset)
-        if dropped:
-            LOG.warning(f"Dropped {dropped} long samples from eval dataset")
-
-    # drop samples with where the number of elements with labels not equal to -100 is zero
-    def drop_no_trainable_tokens(sample):
-        return np.sum(np.array(sample["labels"]) != -100) > 0
-
-    prior_len = len(train_dataset)
-    train_dataset = train_dataset.filter(
-        drop_no_trainable_tokens,
-        num_proc=cfg.dataset_processes,
-        load_from_cache_file=not cfg.is_preprocess,
-        desc="Drop Samples with Zero Trainable Tokens",
+    drop_unpackable = partial(
+        drop_unpackable_samples,
+        sequence_len=cfg.sequence_len,
+        min_sequence_len=cfg.min_sample_len or 2,
     )
-    dropped = prior_len - len(train_dataset)
-    if dropped:
-        LOG.warning(
-            f"Dropped {dropped} samples with no trainable tokens from train dataset"
-        )
-
+    train_dataset = drop_unpackable(train_dataset, split="train")
     if eval_dataset:
-        prior_len = len(eval_dataset)
-        eval_dataset = eval_dataset.filter(
-            drop_no_trainable_tokens,
-            num_proc=cfg.dataset_processes,
-            load_from_cache_file=not cfg.is_preprocess,
-            desc="Drop Samples with Zero Trainable Tokens",
-        )
-        dropped = prior_len - len(eval_dataset)
-        if dropped:
-            LOG.warning(
-                f"Dropped {dropped} samples with no trainable tokens from eval dataset"
-            )
+        eval_dataset = drop_unpackable(eval_dataset, split="eval")
 
-    if cfg.group_by_length:
-        train_dataset = train_dataset.map(
-            add_length,
-            num_proc=cfg.dataset_processes,
-            load_from_cache_file=not cfg.is_preprocess,
-            desc="Group By Length",
+    # sample packing without PoSE adds the length column along with the position ids
+    if cfg.group_by_length and (cfg.use_pose or not cfg.sample_packing):
+        train_dataset = _map_length_and_position_ids(
+            cfg, train_dataset, "Group By Length", position_ids=False
         )
 
     if cfg.use_pose:
@@ -291,19 +315,13 @@ def process_datasets_for_packing(cfg, train_dataset, eval_dataset):
                     desc="Add position_id column (PoSE)",
                 )
     elif cfg.sample_packing:
-        train_dataset = train_dataset.map(
-            add_position_ids,
-            num_proc=cfg.dataset_processes,
-            load_from_cache_file=not cfg.is_preprocess,
-            desc="Add position_id column (Sample Packing)",
+        train_dataset = _map_length_and_position_ids(
+            cfg, train_dataset, "Add position_id column (Sample Packing)"
         )
         if cfg.eval_sample_packing is not False:
             if eval_dataset:
-                eval_dataset = eval_dataset.map(
-                    add_position_ids,
-                    num_proc=cfg.dataset_processes,
-                    load_from_cache_file=not cfg.is_preprocess,
-                    desc="Add position_id column (Sample Packing)",
+                eval_dataset = _map_length_and_position_ids(
+                    cfg, eval_dataset, "Add position_id column (Sample Packing)"
                 )
 
     return train_dataset, eval_dataset
@@ -333,12 +351,7 @@ def calculate_total_num_steps(cfg, train_dataset, update=True):
         and not cfg.skip_prepare_dataset
         and not cfg.reward_model
     ):
-        total_num_tokens = np.sum(
-            train_dataset.data.column("input_ids")
-            .to_pandas()
-            .apply(lambda x: len(x))  # pylint: disable=unnecessary-lambda
-            .values
-        )
+        total_num_tokens = int(np.sum(get_row_lengths(train_dataset)))
         LOG.debug(f"total_num_tokens: {total_num_tokens:_}", main_process_only=True)
         if update:
             cfg.total_num_tokens = total_num_tokens
@@ -351,12 +364,7 @@ def calculate_total_num_steps(cfg, train_dataset, update=True):
         and not cfg.skip_prepare_dataset
         and not cfg.reward_model
     ):
-        total_supervised_tokens = (
-            train_dataset.data.column("labels")
-            .to_pandas()
-            .apply(lambda x: np.sum(np.array(x) != -100))
-            .sum()
-        )
+        total_supervised_tokens = int(np.sum(get_trainable_token_counts(train_dataset)))
         LOG.debug(
             f"`total_supervised_tokens: {total_supervised_tokens:_}`",
             main_process_only=True,
@@ -394,14 +402,17 @@ def calculate_total_num_steps(cfg, train_dataset, update=True):
             else:
                 sampler_batch_size = cfg.micro_batch_size
                 batch_max_len = cfg.sequence_len
+            # same order and cache dir as the trainer's sampler, so its plan is reused
             sampler = MultipackBatchSampler(
-                sampler=RandomSampler(train_dataset),
+                sampler=RandomSampler(train_dataset, generator=torch.Generator()),
                 lengths=get_dataset_lengths(train_dataset),
                 batch_size=sampler_batch_size,
                 batch_max_len=batch_max_len,
                 group_size=cfg.sample_packing_group_size,
                 bin_size=cfg.sample_packing_bin_size,
                 drop_last=True,
+                seed=cfg.seed or 42,
+                plan_cache_dir=get_packing_plan_cache_dir(cfg),
             )
 
             data_loader = DataLoader(
@@ -0,0 +1,39 @@
+"""pytest tests for axolotl CLI evict-prepared command."""
+from unittest.mock import patch
+
+from axolotl.cli.main import cli
+
+
+def test_evict_prepared_basic(cli_runner, config_path):
+    """Test basic evict-prepared command"""
+    with patch("axolotl.cli.evict_prepared.do_cli") as mock_do_cli:
+        result = cli_runner.invoke(cli, ["evict-prepared", str(config_path)])
+        assert result.exit_code == 0
+
+        mock_do_cli.assert_called_once()
+        assert mock_do_cli.call_args.kwargs["config"] == str(config_path)
+        assert mock_do_cli.call_args.kwargs["max_age_days"] is None
+        assert mock_do_cli.call_args.kwargs["dry_run"] is False
+
+
+def test_evict_prepared_with_limits(cli_runner, config_path):
+    """Test evict-prepared with age and size limits"""
+    with patch("axolotl.cli.evict_prepared.do_cli") as mock_do_cli:
+        result = cli_runner.invoke(
+            cli,
+            [
+                "evict-prepared",
+                str(config_path),
+                "--max-age-days",
+                "7",
+                "--max-size-gb",
+                "50",
+                "--dry-run",
+            ],
+        )
+        assert result.exit_code == 0
+
+        mock_do_cli.assert_called_once()
+        assert mock_do_cli.call_args.kwargs["max_age_days"] == 7.0
+        assert mock_do_cli.call_args.kwargs["max_size_gb"] == 50.0
+        assert mock_do_cli.call_args.kwargs["dry_run"] is True
@@ -28,3 +28,42 @@ def test_inference_gradio(cli_runner, config_path):
 
         assert mock.called
         assert result.exit_code == 0
+
+
+def test_inference_batch(cli_runner, config_path, tmp_path):
+    """Test batched inference over a JSONL file"""
+    input_path = tmp_path / "prompts.jsonl"
+    input_path.write_text('{"prompt": "hello"}\n')
+    output_path = tmp_path / "out.jsonl"
+    with patch("axolotl.cli.inference.do_inference_batch") as mock:
+        result = cli_runner.invoke(
+            cli,
+            [
+                "inference",
+                str(config_path),
+                "--no-accelerate",
+                "--input",
+                str(input_path),
+                "--output",
+                str(output_path),
+            ],
+            catch_exceptions=False,
+        )
+
+        assert mock.called
+        assert mock.call_args.kwargs["input_path"] == str(input_path)
+        assert mock.call_args.kwargs["output_path"] == str(output_path)
+        assert result.exit_code == 0
+
+
+def test_inference_batch_requires_output(cli_runner, config_path, tmp_path):
+    """Test batched inference fails without an output file"""
+    input_path = tmp_path / "prompts.jsonl"
+    input_path.write_text('{"prompt": "hello"}\n')
+    result = cli_runner.invoke(
+        cli,
+        ["inference", str(config_path), "--no-accelerate", "--input", str(input_path)],
+    )
+
+    assert result.exit_code != 0
+    assert "--input and --output must be passed together" in result.output
@@ -0,0 +1,66 @@
+"""
+test batched offline inference with a tiny randomly initialized model on cpu
+"""
+import json
+from unittest.mock import patch
+
+import torch
+
+from axolotl.cli import do_inference_batch
+from axolotl.common.cli import TrainerCliArgs
+from axolotl.utils.dict import DictDefault
+
+
+def test_do_inference_batch(tiny_llama_factory, tiny_tokenizer, tmp_path):
+    tokenizer = tiny_tokenizer
+    model = tiny_llama_factory(
+        vocab_size=len(tokenizer),
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+
+    prompts = ["the quick brown fox", "a lazy dog", "the dog jumps over the fox"]
+    input_path = tmp_path / "prompts.jsonl"
+    input_path.write_text(
+        "".join(
+            json.dumps({"prompt": prompt, "id": idx}) + "\n"
+            for idx, prompt in enumerate(prompts)
+        )
+    )
+    output_path = tmp_path / "out.jsonl"
+    cfg = DictDefault(
+        {
+            "device": "cpu",
+            "torch_dtype": torch.float32,
+            "inference_max_new_tokens": 8,
+            "inference_max_tokens": 24,
+        }
+    )
+
+    with patch("axolotl.cli.load_model_and_tokenizer", return_value=(model, tokenizer)):
+        do_inference_batch(
+            cfg=cfg,
+            cli_args=TrainerCliArgs(inference=True),
+            input_path=input_path,
+            output_path=output_path,
+        )
+
+    results = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert sorted(result["index"] for result in results) == [0, 1, 2]
+    for result in results:
+        prompt = prompts[result["index"]]
+        assert result["id"] == result["index"]
+        assert result["prompt"] == prompt
+
+        input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"]
+        expected = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=8,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id,
+        )[0, input_ids.shape[1] :]
+        assert result["completion"] == tokenizer.decode(
+            expected, skip_special_tokens=True
+        )
@@ -0,0 +1,50 @@
+"""
+test merging a DCP checkpoint into safetensors shards, one output shard at a time
+"""
+import json
+
+import pytest
+import safetensors.torch as st
+import torch
+import torch.distributed.checkpoint as dist_cp
+
+from axolotl.cli.merge_sharded_fsdp_weights import (
+    _distributed_checkpoint_to_merged_weights,
+)
+
+
+@pytest.fixture(name="model")
+def fixture_model(tiny_llama_factory):
+    return tiny_llama_factory()
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_merge_dcp_checkpoint_by_shard(model, tmp_path, num_workers):
+    checkpoint_dir = tmp_path / "pytorch_model_fsdp_0"
+    state_dict = model.state_dict()
+    dist_cp.save(
+        {"model": state_dict},
+        storage_writer=dist_cp.FileSystemWriter(str(checkpoint_dir)),
+    )
+
+    save_path = _distributed_checkpoint_to_merged_weights(
+        checkpoint_dir,
+        str(tmp_path / "merged"),
+        safe_serialization=True,
+        max_shard_size="20KB",
+        num_workers=num_workers,
+    )
+
+    with open(save_path / "model.safetensors.index.json", encoding="utf-8") as file:
+        weight_map = json.load(file)["weight_map"]
+    assert len(set(weight_map.values())) > 1
+    merged = {}
+    for shard in set(weight_map.values()):
+        tensors = st.load_file(str(save_path / shard))
+        assert all(weight_map[name] == shard for name in tensors)
+        merged.update(tensors)
+
+    assert merged.keys() == state_dict.keys()
+    for name, tensor in merged.items():
+        assert tensor.dtype == torch.bfloat16
+        assert torch.equal(tensor, state_dict[name].to(torch.bfloat16))
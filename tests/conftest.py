@@ -10,7 +10,13 @@ import time
 
 import pytest
 import requests
+import torch
+from datasets import Dataset
 from huggingface_hub import snapshot_download
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+TINY_WORDS = "the quick brown fox jumps over a lazy dog while axolotls swim".split()
 
 
 def retry_on_request_exceptions(max_retries=3, delay=1):
@@ -108,6 +114,77 @@ def download_arcee_ai_distilabel_intel_orca_dpo_pairs_dataset():
     )
 
 
+@pytest.fixture(name="tiny_tokenizer_factory")
+def fixture_tiny_tokenizer_factory():
+    """
+    builds whitespace split word level tokenizers over the given words, which follow the
+    <unk>, <s>, </s> and <pad> special tokens at ids 0 to 3
+    """
+
+    def build(words=TINY_WORDS):
+        vocab = {"<unk>": 0, "<s>": 1, "</s>": 2, "<pad>": 3}
+        vocab.update({word: idx + 4 for idx, word in enumerate(words)})
+        backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+        backend.pre_tokenizer = pre_tokenizers.Whitespace()
+        return PreTrainedTokenizerFast(
+            tokenizer_object=backend,
+            unk_token="<unk>",
+            bos_token="<s>",
+            eos_token="</s>",
+            pad_token="<pad>",
+        )
+
+    return build
+
+
+@pytest.fixture(name="tiny_tokenizer")
+def fixture_tiny_tokenizer(tiny_tokenizer_factory):
+    return tiny_tokenizer_factory()
+
+
+@pytest.fixture(name="tiny_words")
+def fixture_tiny_words():
+    return list(TINY_WORDS)
+
+
+@pytest.fixture(name="tiny_llama_factory")
+def fixture_tiny_llama_factory():
+    """
+    builds small randomly initialized llama models, seeded so every build has the same weights
+    """
+
+    def build(**config_kwargs):
+        from transformers import LlamaConfig, LlamaForCausalLM
+
+        torch.manual_seed(0)
+        config = {
+            "vocab_size": 64,
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 4,
+            "num_key_value_heads": 2,
+            **config_kwargs,
+        }
+        return LlamaForCausalLM(LlamaConfig(**config))
+
+    return build
+
+
+@pytest.fixture(name="preference_dataset")
+def fixture_preference_dataset():
+    return Dataset.from_list(
+        [
+            {
+                "prompt": " ".join(TINY_WORDS[: 2 + idx % 5]),
+                "chosen": " ".join(TINY_WORDS[idx % 7 : idx % 7 + 1 + idx % 4]),
+                "rejected": " ".join(TINY_WORDS[::-1][: 1 + idx % 6]),
+            }
+            for idx in range(12)
+        ]
+    )
+
+
 @pytest.fixture
 def temp_dir():
     # Create a temporary directory
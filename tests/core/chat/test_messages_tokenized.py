@@ -0,0 +1,184 @@
+"""
+Tests for tokenizing chat messages in a single pass with offset mappings
+"""
+import pytest
+from datasets import Dataset
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from axolotl.core.chat.format import chatml, llama3x
+from axolotl.core.chat.format.chatml import format_message, format_message_dict
+from axolotl.core.chat.messages import ChatFormattedChats, message_segments
+from axolotl.core.datasets.chat import TokenizedChatDataset
+
+# pylint: disable=duplicate-code
+
+
+@pytest.fixture(name="chat_msgs")
+def chat_msgs_fixture():
+    return {
+        "conversation": [
+            {
+                "role": "system",
+                "content": [{"type": "text", "value": "You are a helpful assistant."}],
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "value": "What is today's stock price of Apple?"}
+                ],
+            },
+            {
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "tool_call",
+                        "value": {"name": "get_date", "arguments": {}},
+                    },
+                    {
+                        "type": "tool_call",
+                        "value": {
+                            "name": "get_stock_price",
+                            "arguments": {"symbol": "AAPL"},
+                        },
+                    },
+                ],
+                "weight": 1,
+            },
+            {
+                "role": "tool",
+                "content": [
+                    {
+                        "type": "tool_response",
+                        "value": {
+                            "name": "get_date",
+                            "content": {"date": "2024-09-09"},
+                        },
+                    },
+                    {
+                        "type": "tool_response",
+                        "value": {
+                            "name": "get_stock_price",
+                            "content": {"symbol": "AAPL", "price": 123.45},
+                        },
+                    },
+                ],
+            },
+            {
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "text",
+                        "value": "The stock price of Apple is $123.45.\n",
+                        "weight": 0,
+                    },
+                    {
+                        "type": "text",
+                        "value": "<reflection>The query asked for today's price.</reflection>",
+                    },
+                    {
+                        "type": "text",
+                        "value": "The stock price of Apple on September 9, 2024 is $123.45.",
+                    },
+                ],
+                "weight": 1,
+            },
+        ]
+    }
+
+
+@pytest.fixture(name="tokenizer")
+def bpe_tokenizer_fixture(chat_msgs):
+    corpus = [str(ChatFormattedChats(**chat_msgs, formatter=format_message))]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        corpus * 8,
+        trainers.BpeTrainer(
+            vocab_size=400,
+            special_tokens=["<|im_start|>", "<|im_end|>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|im_end|>")
+
+
+def test_tokenized_matches_incremental(tokenizer, chat_msgs):
+    chats = ChatFormattedChats(**chat_msgs, formatter=format_message)
+    for msg in chats.conversation:
+        assert msg.tokenized(tokenizer) == msg.tokenized_incremental(tokenizer)
+
+
+def test_tokenized_masks_untrained_contents(tokenizer, chat_msgs):
+    chats = ChatFormattedChats(**chat_msgs, formatter=format_message)
+    tokenized = chats.conversation[4].tokenized(tokenizer)
+    trained = [
+        token
+        for token, label in zip(tokenized["input_ids"], tokenized["labels"])
+        if label != -100
+    ]
+    decoded = tokenizer.decode(trained)
+    assert decoded.startswith("<reflection>")
+    assert "$123.45.\n" not in decoded.split("<reflection>")[0]
+
+
+def test_chat_dataset_matches_incremental(tokenizer, chat_msgs):
+    # arrow can't mix tool call structs with text values in a column
+    chat_msgs = {"conversation": [chat_msgs["conversation"][idx] for idx in (0, 1, 4)]}
+    data = Dataset.from_list([chat_msgs, chat_msgs])
+    dataset = TokenizedChatDataset(
+        data, tokenizer, formatter=format_message, process_count=1
+    )
+
+    chats = ChatFormattedChats(**chat_msgs, formatter=format_message)
+    expected = {"input_ids": [], "attention_mask": [], "labels": []}
+    for msg in chats.conversation:
+        for key, values in msg.tokenized_incremental(tokenizer).items():
+            expected[key].extend(values)
+    assert len(dataset) == 2
+    for row in dataset:
+        assert row == expected
+
+
+@pytest.mark.parametrize("fmt", [chatml, llama3x])
+@pytest.mark.parametrize("train_on_inputs", [False, True])
+def test_message_segments_match_models(chat_msgs, fmt, train_on_inputs):
+    chats = ChatFormattedChats(
+        **chat_msgs, formatter=fmt.format_message, train_on_inputs=train_on_inputs
+    )
+    for idx, msg in enumerate(chat_msgs["conversation"]):
+        formatted = fmt.format_message_dict(msg, message_index=idx)
+        if train_on_inputs:
+            formatted = {**formatted, "weight": 1}
+        assert message_segments(formatted) == chats.conversation[idx].segments()
+    # the rows themselves are left as they were
+    assert "is_chat_formatted" not in chat_msgs["conversation"][0]
+
+
+def test_message_segments_leave_coerced_values_to_models(chat_msgs):
+    msg = chat_msgs["conversation"][2]
+    assert message_segments(format_message_dict(msg)) is not None
+    msg["content"][1]["value"]["arguments"]["limit"] = 1.0
+    assert message_segments(format_message_dict(msg)) is None
+
+
+def test_chat_dataset_from_dicts_matches_models(tokenizer, chat_msgs):
+    msgs = chat_msgs["conversation"]
+    rows = [
+        {"conversation": [msgs[idx] for idx in (0, 1, 4)], "train_on_inputs": False},
+        {"conversation": [msgs[idx] for idx in (1, 4)], "train_on_inputs": True},
+    ]
+    data = Dataset.from_list(rows)
+    dataset = TokenizedChatDataset(
+        data,
+        tokenizer,
+        formatter=format_message,
+        dict_formatter=format_message_dict,
+        process_count=1,
+    )
+
+    assert len(dataset) == 2
+    for row, chat in zip(dataset, data):
+        expected = ChatFormattedChats(**chat, formatter=format_message)
+        assert row == expected.tokenized(tokenizer)
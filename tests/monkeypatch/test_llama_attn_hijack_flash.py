@@ -6,11 +6,14 @@ import unittest
 import torch
 
 from axolotl.monkeypatch.utils import (
+    _compute_unpad_data,
     get_cu_seqlens,
     get_cu_seqlens_from_pos_ids,
     get_max_seqlen_in_batch,
     get_unpad_data,
+    set_precomputed_unpad_data,
 )
+from axolotl.utils.collators.batching import packed_cu_seqlens
 
 
 class TestMonkeyPatchUtils(unittest.TestCase):
@@ -108,6 +111,74 @@ class TestMonkeyPatchUtils(unittest.TestCase):
         self.assertTrue(torch.allclose(target_cu_seqlen, cu_seqlen))
         self.assertEqual(target_max_seqlen_in_batch, max_seqlen_in_batch)
 
+    def test_get_cu_seqlens_from_pos_ids_single_token_and_empty_rows(self):
+        position_ids = torch.tensor(
+            [
+                [0, 1, 2, 0, 0, 1, 0, 0],
+                [0, 0, 0, 0, 0, 0, 0, 0],
+            ]
+        )
+        cu_seqlens, max_seqlens = get_cu_seqlens_from_pos_ids(position_ids)
+        target_res = torch.tensor([[0, 3, 4, 6, 8], [0, 0, 8, 8, 8]], dtype=torch.int32)
+        self.assertTrue(torch.equal(cu_seqlens, target_res))
+        self.assertTrue(torch.equal(max_seqlens, torch.tensor([3, 8])))
+
+    def test_packed_rows_match_per_row_lengths(self):
+        generator = torch.Generator().manual_seed(0)
+        for _ in range(20):
+            attn_mask = torch.zeros((3, 64), dtype=torch.long)
+            position_ids = torch.zeros((3, 64), dtype=torch.long)
+            row_lengths = []
+            for row in range(3):
+                lengths, pos = [], 0
+                while True:
+                    length = int(torch.randint(2, 16, (1,), generator=generator))
+                    if pos + length > 60:
+                        break
+                    attn_mask[row, pos : pos + length] = len(lengths) + 1
+                    position_ids[row, pos : pos + length] = torch.arange(length)
+                    lengths.append(length)
+                    pos += length
+                row_lengths.append(lengths)
+
+            flat_lengths = [length for lengths in row_lengths for length in lengths]
+            indices, cu_seqlens, max_seqlen = get_unpad_data(attn_mask)
+            self.assertEqual(get_max_seqlen_in_batch(attn_mask).tolist(), flat_lengths)
+            self.assertEqual(
+                cu_seqlens.tolist(), [0] + torch.tensor(flat_lengths).cumsum(0).tolist()
+            )
+            self.assertEqual(max_seqlen, max(flat_lengths))
+            self.assertTrue(
+                torch.equal(indices, torch.nonzero(attn_mask.flatten())[:, 0])
+            )
+
+            # both helpers describe every row as its samples followed by the padding
+            from_mask, max_from_mask = get_cu_seqlens(attn_mask)
+            from_pos_ids, max_from_pos_ids = get_cu_seqlens_from_pos_ids(position_ids)
+            self.assertTrue(torch.equal(from_mask, from_pos_ids))
+            self.assertTrue(torch.equal(max_from_mask, max_from_pos_ids))
+            for row, lengths in enumerate(row_lengths):
+                expected = [0] + torch.tensor(lengths).cumsum(0).tolist() + [64]
+                self.assertEqual(from_mask[row, : len(expected)].tolist(), expected)
+
+    def test_get_unpad_data_reuses_result_for_same_mask(self):
+        attn_mask = torch.tensor([[1, 1, 2, 2, 2, 0]])
+        first = get_unpad_data(attn_mask)
+        self.assertIs(get_unpad_data(attn_mask), first)
+        attn_mask[0, 5] = 3
+        self.assertEqual(get_unpad_data(attn_mask)[1].tolist(), [0, 2, 5, 6])
+
+    def test_precomputed_unpad_data(self):
+        attn_mask = torch.tensor([[1, 1, 2, 2, 2, 0], [1, 2, 2, 2, 2, 2]])
+        cu_seqlens, max_seqlen = packed_cu_seqlens(attn_mask.numpy())
+        set_precomputed_unpad_data(attn_mask, torch.from_numpy(cu_seqlens), max_seqlen)
+        indices, cu_seqlen, max_seqlen_in_batch = get_unpad_data(attn_mask)
+
+        expected = _compute_unpad_data(attn_mask.clone())
+        self.assertTrue(torch.equal(indices, expected[0]))
+        self.assertTrue(torch.equal(cu_seqlen, expected[1]))
+        self.assertEqual(max_seqlen_in_batch, expected[2])
+
 
 if __name__ == "__main__":
     unittest.main()
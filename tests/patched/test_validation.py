@@ -184,6 +184,30 @@ class TestValidation(BaseValidation):
 
         validate_config(cfg)
 
+    @pytest.mark.parametrize("temperature", [0, -1.0])
+    def test_pretraining_mixture_temperature_must_be_positive(self, temperature):
+        cfg = DictDefault(
+            {
+                "base_model": "TinyLlama/TinyLlama-1.1B-Chat-v0.6",
+                "learning_rate": 0.000001,
+                "pretraining_dataset": [
+                    {
+                        "path": "mhenrichsen/alpaca_2k_test",
+                        "type": "alpaca",
+                    }
+                ],
+                "pretraining_mixture_temperature": temperature,
+                "micro_batch_size": 1,
+                "gradient_accumulation_steps": 1,
+                "max_steps": 100,
+            }
+        )
+
+        with pytest.raises(
+            ValueError, match=r".*pretraining_mixture_temperature must be positive*"
+        ):
+            validate_config(cfg)
+
     def test_valid_sft_dataset(self):
         cfg = DictDefault(
             {
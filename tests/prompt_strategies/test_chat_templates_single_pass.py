@@ -0,0 +1,303 @@
+"""
+parity tests for single-pass turn detection in the chat_template prompt strategy
+"""
+
+from copy import deepcopy
+
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from axolotl.prompt_strategies.chat_template import (
+    ChatTemplatePrompter,
+    ChatTemplateStrategy,
+)
+from axolotl.utils.chat_templates import get_chat_template
+
+from . import test_chat_templates_advanced as advanced
+
+
+def build_strategy(
+    tokenizer,
+    chat_template,
+    single_pass_turns,
+    roles_to_train=None,
+    train_on_eos="turn",
+) -> ChatTemplateStrategy:
+    prompter = ChatTemplatePrompter(
+        tokenizer,
+        chat_template=chat_template,
+        message_field_role="from",
+        message_field_content="value",
+    )
+    strategy = ChatTemplateStrategy(
+        prompter,
+        tokenizer=tokenizer,
+        train_on_inputs=False,
+        sequence_len=512,
+        roles_to_train=roles_to_train or ["assistant"],
+        train_on_eos=train_on_eos,
+        single_pass_turns=single_pass_turns,
+    )
+    strategy.messages = "conversations"
+    return strategy
+
+
+@pytest.fixture(name="multiturn_dataset")
+def fixture_multiturn_dataset():
+    # pylint: disable=duplicate-code
+    return [
+        {
+            "conversations": [
+                {"from": "system", "value": "You are an AI assistant."},
+                {"from": "human", "value": "Hello"},
+                {"from": "assistant", "value": "Hello"},
+                {"from": "human", "value": "  Tell me a joke.\n"},
+                {"from": "assistant", "value": "Why did the chicken cross the road?\n"},
+                {"from": "human", "value": "Why?"},
+                {"from": "assistant", "value": "To get to the other side."},
+                {"from": "human", "value": "a"},
+                {"from": "assistant", "value": "a"},
+            ]
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    advanced.PARAMETRIZE_KEYS,
+    advanced.PARAMETRIZE_PARAMS,
+)
+class TestChatTemplateSinglePassParity:
+    """
+    Test that single-pass turn detection matches the per-turn algorithm.
+    """
+
+    @staticmethod
+    def setup_strategy(
+        tokenizer_name,
+        chat_template,
+        chat_template_jinja,
+        eos_token,
+        request,
+        single_pass_turns,
+        roles_to_train=None,
+        train_on_eos="turn",
+    ) -> ChatTemplateStrategy:
+        (
+            tokenizer,
+            chat_template_jinja,
+        ) = advanced.TestChatTemplateConfigurations.setup_tokenizer(
+            tokenizer_name, chat_template, chat_template_jinja, eos_token, request
+        )
+        return build_strategy(
+            tokenizer,
+            get_chat_template(chat_template, jinja_template=chat_template_jinja),
+            single_pass_turns,
+            roles_to_train=roles_to_train,
+            train_on_eos=train_on_eos,
+        )
+
+    @pytest.mark.parametrize("dataset", ["basic_dataset", "multiturn_dataset"])
+    def test_find_turns_matches_find_turn(
+        self,
+        tokenizer,
+        chat_template,
+        chat_template_jinja,
+        eos_token,
+        dataset,
+        request,
+    ):
+        strategy = self.setup_strategy(
+            tokenizer, chat_template, chat_template_jinja, eos_token, request, True
+        )
+        sample = request.getfixturevalue(dataset)[0]
+        turns = strategy.get_conversation_thread(sample)
+
+        expected = [
+            strategy.find_turn(turns=turns, turn_idx=i) for i in range(len(turns))
+        ]
+        assert strategy.find_turns(turns) == expected
+
+    @pytest.mark.parametrize("dataset", ["basic_dataset", "multiturn_dataset"])
+    @pytest.mark.parametrize("train_on_eos", ["turn", "all", "last"])
+    @pytest.mark.parametrize(
+        "roles_to_train", [["assistant"], ["system", "human", "assistant"]]
+    )
+    def test_tokenize_prompt_parity(
+        self,
+        tokenizer,
+        chat_template,
+        chat_template_jinja,
+        eos_token,
+        dataset,
+        train_on_eos,
+        roles_to_train,
+        request,
+    ):
+        per_turn, single_pass = (
+            self.setup_strategy(
+                tokenizer,
+                chat_template,
+                chat_template_jinja,
+                eos_token,
+                request,
+                single_pass_turns,
+                roles_to_train=roles_to_train,
+                train_on_eos=train_on_eos,
+            )
+            for single_pass_turns in (False, True)
+        )
+        sample = request.getfixturevalue(dataset)[0]
+
+        assert single_pass.tokenize_prompt(sample) == per_turn.tokenize_prompt(sample)
+
+    @pytest.mark.parametrize("single_pass_turns", [False, True])
+    def test_tokenize_prompt_batched_parity(
+        self,
+        tokenizer,
+        chat_template,
+        chat_template_jinja,
+        eos_token,
+        single_pass_turns,
+        basic_dataset,
+        multiturn_dataset,
+        request,
+    ):
+        strategy = self.setup_strategy(
+            tokenizer,
+            chat_template,
+            chat_template_jinja,
+            eos_token,
+            request,
+            single_pass_turns,
+        )
+        samples = [basic_dataset[0], multiturn_dataset[0]]
+        batched = strategy.tokenize_prompt_batched(
+            {"conversations": [sample["conversations"] for sample in samples]}
+        )
+
+        assert strategy.supports_batched == single_pass_turns
+        for idx, sample in enumerate(samples):
+            expected = strategy.tokenize_prompt(sample)
+            assert {key: val[idx] for key, val in batched.items()} == expected
+
+
+class TestChatTemplateSinglePassToolCalling:
+    """
+    Test single-pass turn detection with turns that have no text content.
+    """
+
+    def test_tool_calling_parity(
+        self, llama3_tokenizer, toolcalling_dataset, llama3_2_vision_chat_template_jinja
+    ):
+        per_turn, single_pass = (
+            ChatTemplateStrategy(
+                ChatTemplatePrompter(
+                    llama3_tokenizer,
+                    chat_template=llama3_2_vision_chat_template_jinja,
+                ),
+                tokenizer=llama3_tokenizer,
+                train_on_inputs=False,
+                sequence_len=512,
+                roles_to_train=["assistant"],
+                train_on_eos="turn",
+                single_pass_turns=single_pass_turns,
+            )
+            for single_pass_turns in (False, True)
+        )
+        sample = toolcalling_dataset[0]
+        turns = single_pass.get_conversation_thread(sample)
+
+        assert single_pass.find_turns(turns) == [
+            per_turn.find_turn(turns=turns, turn_idx=i) for i in range(len(turns))
+        ]
+        assert single_pass.tokenize_prompt(sample) == per_turn.tokenize_prompt(sample)
+
+
+class TestChatTemplateSinglePassMistralV1:
+    """
+    Test single-pass turn detection with the mistral_v1 template, whose leading space
+    before each content is merged with the content's first word by metaspace tokenizers.
+    """
+
+    @staticmethod
+    def assert_parity(tokenizer, sample):
+        per_turn, single_pass = (
+            build_strategy(
+                tokenizer, get_chat_template("mistral_v1"), single_pass_turns
+            )
+            for single_pass_turns in (False, True)
+        )
+        turns = single_pass.get_conversation_thread(sample)
+
+        assert single_pass.find_turns(turns) == [
+            per_turn.find_turn(turns=turns, turn_idx=i) for i in range(len(turns))
+        ]
+        assert single_pass.tokenize_prompt(sample) == per_turn.tokenize_prompt(sample)
+
+    @pytest.mark.parametrize("dataset", ["basic_dataset", "multiturn_dataset"])
+    def test_mistral_v1_parity(self, mistralv03_tokenizer, dataset, request):
+        tokenizer = deepcopy(mistralv03_tokenizer)
+        sample = request.getfixturevalue(dataset)[0]
+        # mistral_v1 has no system role
+        sample = {
+            "conversations": [
+                turn for turn in sample["conversations"] if turn["from"] != "system"
+            ]
+        }
+        self.assert_parity(tokenizer, sample)
+
+    @pytest.fixture(name="unmerged_metaspace_tokenizer")
+    def fixture_unmerged_metaspace_tokenizer(self):
+        # a small vocab leaves the space before some contents as a lone metaspace token
+        tokenizer = Tokenizer(models.BPE(unk_token="<unk>", byte_fallback=True))
+        tokenizer.pre_tokenizer = pre_tokenizers.Metaspace(
+            prepend_scheme="first", split=False
+        )
+        tokenizer.train_from_iterator(
+            [
+                "Hi there! Hello How are you? I'm doing well, thank you! [INST] [/INST]",
+                "abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ .,!?'",
+            ]
+            * 50,
+            trainers.BpeTrainer(
+                vocab_size=200,
+                special_tokens=["<unk>", "<s>", "</s>", "[INST]", "[/INST]"],
+            ),
+        )
+        return PreTrainedTokenizerFast(
+            tokenizer_object=tokenizer,
+            bos_token="<s>",
+            eos_token="</s>",
+            unk_token="<unk>",
+        )
+
+    @pytest.mark.parametrize(
+        "contents",
+        [
+            ["Hello", "Hi there!", "How are you?", "I'm doing well, thank you!"],
+            # digits and punctuation never merge with the space before them
+            ["1 + 1?", "2", "(yes) sure", "!"],
+        ],
+    )
+    def test_unmerged_metaspace_parity(
+        self, unmerged_metaspace_tokenizer, contents, monkeypatch
+    ):
+        sample = {
+            "conversations": [
+                {"from": "human" if idx % 2 == 0 else "assistant", "value": value}
+                for idx, value in enumerate(contents)
+            ]
+        }
+        self.assert_parity(unmerged_metaspace_tokenizer, sample)
+
+        # the lone space tokens are resolved from the offsets, without find_turn
+        single_pass = build_strategy(
+            unmerged_metaspace_tokenizer, get_chat_template("mistral_v1"), True
+        )
+
+        def find_turn(**kwargs):
+            raise AssertionError(f"find_turn called for turn {kwargs['turn_idx']}")
+
+        monkeypatch.setattr(single_pass, "find_turn", find_turn)
+        single_pass.find_turns(single_pass.get_conversation_thread(sample))
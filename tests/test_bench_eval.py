@@ -0,0 +1,109 @@
+"""
+test for the bench eval answer logits gathered from the label positions only
+"""
+import json
+
+import numpy as np
+import pytest
+import torch
+from transformers import DataCollatorForSeq2Seq, Trainer, TrainingArguments
+
+from axolotl.core.trainer_builder import AxolotlTrainer, AxolotlTrainingArguments
+from axolotl.utils.callbacks import (
+    IGNORE_INDEX,
+    bench_answer_logits,
+    bench_eval_callback_factory,
+)
+
+
+def test_bench_answer_logits_matches_full_logits(tiny_llama_factory, tmp_path):
+    model = tiny_llama_factory()
+    trainer = Trainer(
+        model=model,
+        args=TrainingArguments(output_dir=str(tmp_path), report_to=[], use_cpu=True),
+    )
+    abcd_idx = [10, 11, 12, 13]
+    eos = 2
+
+    input_ids = torch.randint(20, 64, (3, 12))
+    labels = torch.full_like(input_ids, IGNORE_INDEX)
+    # right padded rows whose answer and eos tokens end at different positions
+    for row, (end, answer) in enumerate([(12, 11), (9, 13), (6, 10)]):
+        input_ids[row, end - 2 : end] = torch.tensor([answer, eos])
+        labels[row, end - 2 : end] = torch.tensor([answer, eos])
+        input_ids[row, end:] = 0
+    batch = {
+        "input_ids": input_ids,
+        "attention_mask": (input_ids != 0).long(),
+        "labels": labels,
+    }
+
+    loss, answer_logits, answer_labels = bench_answer_logits(trainer, batch, abcd_idx)
+
+    model.eval()
+    with torch.no_grad():
+        outputs = model(**batch)
+    answer_pos = (labels != IGNORE_INDEX).int().argmax(dim=1) - 1
+    expected = outputs.logits[torch.arange(3), answer_pos][:, abcd_idx]
+
+    assert torch.allclose(loss, outputs.loss, atol=1e-5)
+    assert torch.allclose(answer_logits, expected, atol=1e-5)
+    assert answer_labels.tolist() == [1, 3, 0]
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_bench_eval_callback_with_partial_last_batch(
+    tiny_llama_factory, tiny_tokenizer_factory, tmp_path, drop_last
+):
+    tokenizer = tiny_tokenizer_factory(list("ABCDEFG") + ["question", "one", "two"])
+    model = tiny_llama_factory(vocab_size=len(tokenizer))
+    # five rows in batches of two, so the last batch is partial
+    rows = [
+        {"input": "question one", "output": "A", "subject": "maths: algebra"},
+        {"input": "question two", "output": "B", "subject": "history"},
+        {"input": "question one two", "output": "C", "subject": "maths: algebra"},
+        {"input": "question", "output": "D", "subject": "history"},
+        {"input": "one two", "output": "A", "subject": "maths: algebra"},
+    ]
+    bench_path = tmp_path / "bench.jsonl"
+    bench_path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    trainer = AxolotlTrainer(
+        model=model,
+        args=AxolotlTrainingArguments(
+            output_dir=str(tmp_path),
+            report_to=[],
+            use_cpu=True,
+            per_device_eval_batch_size=2,
+            dataloader_drop_last=drop_last,
+            bench_dataset=str(bench_path),
+        ),
+        bench_data_collator=DataCollatorForSeq2Seq(tokenizer, return_tensors="pt"),
+        processing_class=tokenizer,
+    )
+    callback = bench_eval_callback_factory(trainer, tokenizer)()
+    metrics = {}
+    callback.on_evaluate(trainer.args, trainer.state, trainer.control, metrics=metrics)
+
+    abcd_idx = tokenizer.convert_tokens_to_ids(list("ABCDEFG"))
+    correct = {"maths": [], "history": []}
+    for row in rows[: 4 if drop_last else 5]:
+        source_ids = tokenizer(f"<s>{row['input']}")["input_ids"]
+        target_ids = tokenizer(f"{row['output']}</s>")["input_ids"]
+        input_ids = source_ids + target_ids
+        labels = [IGNORE_INDEX] * len(source_ids) + target_ids
+        _, answer_logits, answer_labels = bench_answer_logits(
+            trainer,
+            {
+                "input_ids": torch.tensor([input_ids]),
+                "attention_mask": torch.ones(1, len(input_ids), dtype=torch.long),
+                "labels": torch.tensor([labels]),
+            },
+            abcd_idx,
+        )
+        correct[row["subject"].split(":", maxsplit=1)[0]].append(
+            answer_logits.argmax(dim=-1).item() == answer_labels.item()
+        )
+    for name, subject_correct in correct.items():
+        assert metrics[f"eval_bench_accuracy_{name}"] == pytest.approx(
+            np.mean(subject_correct)
+        )
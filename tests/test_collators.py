@@ -0,0 +1,172 @@
+"""
+parity tests for the preallocated multipack collator
+"""
+from copy import deepcopy
+
+import numpy as np
+import pyarrow as pa
+import pytest
+import torch
+from datasets import Dataset
+from torch.utils.data import DataLoader
+
+from axolotl.monkeypatch.utils import _compute_unpad_data
+from axolotl.utils.collators import (
+    BatchSamplerDataCollatorForSeq2Seq,
+    PreallocatedBatchSamplerDataCollatorForSeq2Seq,
+    V2BatchSamplerDataCollatorForSeq2Seq,
+)
+
+
+@pytest.fixture(name="tokenizer")
+def fixture_tokenizer(tiny_tokenizer_factory):
+    return tiny_tokenizer_factory([])
+
+
+def make_bins(num_bins, rng, as_numpy=False, attention_mask=True):
+    bins = []
+    for _ in range(num_bins):
+        samples = []
+        for _ in range(int(rng.integers(1, 5))):
+            length = int(rng.integers(1, 40))
+            sample = {
+                "input_ids": rng.integers(4, 1000, length).tolist(),
+                "labels": rng.integers(-100, 1000, length).tolist(),
+                "position_ids": list(range(length)),
+                "length": length,
+            }
+            if attention_mask:
+                sample["attention_mask"] = [1] * length
+            if as_numpy:
+                sample = {
+                    key: np.array(val) if isinstance(val, list) else val
+                    for key, val in sample.items()
+                }
+            samples.append(sample)
+        bins.append(samples)
+    return bins
+
+
+class TestPreallocatedCollator:
+    """
+    the preallocated collator matches the concatenate-and-pad collators
+    """
+
+    @pytest.mark.parametrize(
+        "reference_cls, multipack_attn",
+        [
+            (V2BatchSamplerDataCollatorForSeq2Seq, True),
+            (BatchSamplerDataCollatorForSeq2Seq, False),
+        ],
+    )
+    @pytest.mark.parametrize("padding_side", ["right", "left"])
+    @pytest.mark.parametrize("pad_to_multiple_of", [None, 64])
+    @pytest.mark.parametrize("as_numpy", [False, True])
+    def test_parity(
+        self,
+        tokenizer,
+        reference_cls,
+        multipack_attn,
+        padding_side,
+        pad_to_multiple_of,
+        as_numpy,
+    ):
+        tokenizer.padding_side = padding_side
+        bins = make_bins(3, np.random.default_rng(0), as_numpy=as_numpy)
+        kwargs = {
+            "padding": True,
+            "pad_to_multiple_of": pad_to_multiple_of,
+            "return_tensors": "pt",
+        }
+
+        expected = reference_cls(tokenizer, **kwargs)(deepcopy(bins))
+        batch = PreallocatedBatchSamplerDataCollatorForSeq2Seq(
+            tokenizer, multipack_attn=multipack_attn, **kwargs
+        )(deepcopy(bins))
+
+        assert set(batch.keys()) == set(expected.keys())
+        for key, val in expected.items():
+            assert batch[key].dtype == torch.int64
+            assert torch.equal(batch[key], val), key
+
+    def test_missing_attention_mask(self, tokenizer):
+        bins = make_bins(2, np.random.default_rng(1), attention_mask=False)
+        kwargs = {"padding": True, "pad_to_multiple_of": 16, "return_tensors": "pt"}
+
+        expected = V2BatchSamplerDataCollatorForSeq2Seq(tokenizer, **kwargs)(
+            deepcopy(bins)
+        )
+        batch = PreallocatedBatchSamplerDataCollatorForSeq2Seq(tokenizer, **kwargs)(
+            deepcopy(bins)
+        )
+
+        for key, val in expected.items():
+            assert torch.equal(batch[key], val), key
+
+    def test_precompute_cu_seqlens(self, tokenizer):
+        bins = make_bins(3, np.random.default_rng(5))
+        batch = PreallocatedBatchSamplerDataCollatorForSeq2Seq(
+            tokenizer, precompute_cu_seqlens=True, pad_to_multiple_of=64
+        )(bins)
+
+        _, cu_seqlens, max_seqlen = _compute_unpad_data(batch["attention_mask"])
+        assert torch.equal(batch["cu_seqlens"], cu_seqlens)
+        assert batch["max_seqlen"] == max_seqlen
+
+    def test_max_length_padding(self, tokenizer):
+        bins = make_bins(2, np.random.default_rng(2))
+        batch = PreallocatedBatchSamplerDataCollatorForSeq2Seq(
+            tokenizer, padding="max_length", max_length=200, return_tensors="np"
+        )(bins)
+
+        assert isinstance(batch["input_ids"], np.ndarray)
+        assert batch["input_ids"].shape == (2, 200)
+
+
+class TestArrowPackedFetch:
+    """
+    fetching packed batches with one Arrow take matches collating decoded samples
+    """
+
+    @pytest.mark.parametrize("multipack_attn", [True, False])
+    @pytest.mark.parametrize("attention_mask", [True, False])
+    def test_dataloader_parity(self, tokenizer, multipack_attn, attention_mask):
+        # pylint: disable=unused-import
+        import axolotl.monkeypatch.data.batch_dataset_fetcher  # noqa: F401
+
+        bins = make_bins(12, np.random.default_rng(3), attention_mask=attention_mask)
+        dataset = Dataset.from_list([sample for bin_ in bins for sample in bin_])
+        dataset = dataset.shuffle(seed=0).select(range(len(dataset) - 3))
+        rng = np.random.default_rng(4)
+        batches = [
+            [
+                rng.choice(
+                    len(dataset), int(rng.integers(1, 4)), replace=False
+                ).tolist()
+                for _ in range(2)
+            ]
+            for _ in range(5)
+        ]
+        collator = PreallocatedBatchSamplerDataCollatorForSeq2Seq(
+            tokenizer,
+            multipack_attn=multipack_attn,
+            padding=True,
+            pad_to_multiple_of=8,
+            return_tensors="pt",
+        )
+
+        loader = DataLoader(dataset, batch_sampler=batches, collate_fn=collator)
+        for batch, batched_index in zip(loader, batches):
+            expected = collator([dataset.__getitems__(bin_) for bin_ in batched_index])
+            assert set(batch.keys()) == set(expected.keys())
+            for key, val in expected.items():
+                assert torch.equal(batch[key], val), key
+
+    def test_supports_arrow(self, tokenizer):
+        collator = PreallocatedBatchSamplerDataCollatorForSeq2Seq(tokenizer)
+        table = pa.table({"input_ids": [[1, 2], [3]], "labels": [[1, 2], [3]]})
+        assert collator.supports_arrow(table)
+        table = pa.table({"input_ids": [[1, 2], [3]], "labels": [[1], [3]]})
+        assert not collator.supports_arrow(table)
+        table = pa.table({"input_ids": [[1, 2], [3]], "source": ["a", "b"]})
+        assert not collator.supports_arrow(table)
@@ -0,0 +1,50 @@
+"""
+test module for the Arrow-based dataset token statistics
+"""
+import numpy as np
+import pytest
+from datasets import Dataset, concatenate_datasets
+
+from axolotl.utils.dataset_stats import get_row_lengths, get_trainable_token_counts
+from axolotl.utils.samplers import get_dataset_lengths
+from axolotl.utils.trainer import add_position_ids
+
+
+@pytest.fixture(name="dataset")
+def fixture_dataset():
+    rng = np.random.default_rng(0)
+    rows = []
+    for _ in range(100):
+        input_ids = rng.integers(0, 1000, rng.integers(1, 32)).tolist()
+        labels = [token if rng.random() < 0.5 else -100 for token in input_ids]
+        rows.append({"input_ids": input_ids, "labels": labels})
+    # several arrow chunks, then shuffled and filtered into an indices mapping
+    return (
+        concatenate_datasets(
+            [Dataset.from_list(rows[:30]), Dataset.from_list(rows[30:])]
+        )
+        .shuffle(seed=0)
+        .select(range(0, 100, 3))
+    )
+
+
+def test_row_lengths(dataset):
+    expected = [len(input_ids) for input_ids in dataset["input_ids"]]
+    assert get_row_lengths(dataset).tolist() == expected
+    assert get_dataset_lengths(dataset).tolist() == expected
+
+
+def test_trainable_token_counts(dataset):
+    expected = [sum(label != -100 for label in labels) for labels in dataset["labels"]]
+    assert get_trainable_token_counts(dataset).tolist() == expected
+
+
+@pytest.mark.parametrize("column", ["length", "position_ids"])
+def test_dataset_lengths_from_columns(dataset, column):
+    dataset = dataset.map(add_position_ids)
+    if column == "position_ids":
+        dataset = dataset.remove_columns("length")
+    dataset = dataset.shuffle(seed=1)
+    expected = [len(input_ids) for input_ids in dataset["input_ids"]]
+
+    assert get_dataset_lengths(dataset).tolist() == expected
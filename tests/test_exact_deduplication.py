@@ -8,7 +8,7 @@ import unittest
 from unittest.mock import patch
 
 from constants import ALPACA_MESSAGES_CONFIG_REVISION, SPECIAL_TOKENS
-from datasets import Dataset
+from datasets import Dataset, Sequence, Value
 from transformers import AutoTokenizer
 
 from axolotl.utils.data import prepare_dataset
@@ -212,6 +212,83 @@ class TestDeduplicateIndividualFunctions(unittest.TestCase):
         verify_deduplication(eval_dataset, expected_dataset_eval, "eval_dataset")
 
 
+class TestDeduplicateTokenized(unittest.TestCase):
+    """
+    test deduplication of tokenized rows on their token buffers
+    """
+
+    def setUp(self):
+        self.train_dataset = Dataset.from_dict(
+            {
+                "input_ids": [[1, 2, 3], [4, 5], [1, 2, 3], [1, 2, 3], [4, 5, 6]],
+                "labels": [[-100, 2, 3], [4, 5], [-100, 2, 3], [1, 2, 3], [4, 5, 6]],
+            }
+        )
+        self.eval_dataset = Dataset.from_dict(
+            {
+                "input_ids": [[4, 5], [7, 8], [7, 8]],
+                "labels": [[4, 5], [7, 8], [7, 8]],
+            }
+        )
+
+    def test_deduplicates_on_input_ids_and_labels(self):
+        train_dataset, _, _ = deduplicate_and_log_datasets(
+            train_dataset=self.train_dataset
+        )
+
+        # same input_ids with different labels are kept, first occurrences stay in order
+        self.assertEqual(
+            train_dataset["input_ids"], [[1, 2, 3], [4, 5], [1, 2, 3], [4, 5, 6]]
+        )
+        self.assertEqual(
+            train_dataset["labels"], [[-100, 2, 3], [4, 5], [1, 2, 3], [4, 5, 6]]
+        )
+
+    def test_drops_eval_rows_seen_in_train(self):
+        # token buffers of different integer widths hash the same
+        eval_dataset = self.eval_dataset.cast_column(
+            "input_ids", Sequence(Value("int64"))
+        )
+        _, eval_dataset, _ = deduplicate_and_log_datasets(
+            train_dataset=self.train_dataset, eval_dataset=eval_dataset, num_proc=2
+        )
+
+        self.assertEqual(eval_dataset["input_ids"], [[7, 8]])
+
+    def test_keeps_rows_differing_in_other_columns(self):
+        dataset = Dataset.from_dict(
+            {
+                "input_ids": [[1, 2, 3]] * 4,
+                "labels": [[1, 2, 3]] * 4,
+                "attention_mask": [[1, 1, 1], [1, 1, 1], [1, 1, 2], [1, 1, 1]],
+                "position_ids": [[0, 1, 2], [0, 1, 2], [0, 1, 2], [0, 0, 1]],
+                "length": [3, 3, 3, 3],
+            }
+        )
+        train_dataset, _, _ = deduplicate_and_log_datasets(train_dataset=dataset)
+
+        self.assertEqual(
+            train_dataset["attention_mask"], [[1, 1, 1], [1, 1, 2], [1, 1, 1]]
+        )
+        self.assertEqual(
+            train_dataset["position_ids"], [[0, 1, 2], [0, 1, 2], [0, 0, 1]]
+        )
+
+    def test_empty_datasets(self):
+        train_dataset, eval_dataset, _ = deduplicate_and_log_datasets(
+            train_dataset=self.train_dataset.select([]),
+            eval_dataset=self.eval_dataset.select([]),
+        )
+
+        self.assertEqual(len(train_dataset), 0)
+        self.assertEqual(len(eval_dataset), 0)
+
+        _, eval_dataset, _ = deduplicate_and_log_datasets(
+            train_dataset=self.train_dataset.select([]), eval_dataset=self.eval_dataset
+        )
+        self.assertEqual(eval_dataset["input_ids"], [[4, 5], [7, 8]])
+
+
 class TestDeduplicateRLDataset(unittest.TestCase):
     """Test a configured dataloader with deduplication."""
 
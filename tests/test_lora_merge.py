@@ -0,0 +1,90 @@
+"""
+test streaming shard-by-shard LoRA merge against peft's merge_and_unload
+"""
+import json
+
+import pytest
+import safetensors.torch as st
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaForCausalLM
+
+from axolotl.utils.lora_merge import merge_lora_sharded
+
+
+@pytest.fixture(name="base_dir")
+def fixture_base_dir(tiny_llama_factory, tmp_path):
+    model = tiny_llama_factory(tie_word_embeddings=False)
+    base_dir = tmp_path / "base"
+    model.save_pretrained(base_dir, max_shard_size="20KB")
+    return base_dir
+
+
+def load_merged_state_dict(path):
+    state_dict = {}
+    for shard in path.glob("*.safetensors"):
+        state_dict.update(st.load_file(str(shard)))
+    return state_dict
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+@pytest.mark.parametrize("use_rslora", [False, True])
+def test_merge_lora_sharded_matches_merge_and_unload(
+    base_dir, tmp_path, num_workers, use_rslora
+):
+    model = get_peft_model(
+        LlamaForCausalLM.from_pretrained(base_dir),
+        LoraConfig(
+            r=4,
+            lora_alpha=8,
+            target_modules=["q_proj", "v_proj", "down_proj", "embed_tokens"],
+            modules_to_save=["lm_head"],
+            rank_pattern={"down_proj": 2},
+            alpha_pattern={"v_proj": 16},
+            use_rslora=use_rslora,
+        ),
+    )
+    # random B factors and a trained lm_head, so every delta is nonzero
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if (
+                "lora_B" in name
+                or "lora_embedding_B" in name
+                or "modules_to_save" in name
+            ):
+                param.normal_()
+    adapter_dir = tmp_path / "adapter"
+    model.save_pretrained(adapter_dir)
+    expected = model.merge_and_unload().state_dict()
+
+    output_dir = tmp_path / "merged"
+    merge_lora_sharded(base_dir, adapter_dir, output_dir, num_workers=num_workers)
+
+    assert len(list(base_dir.glob("*.safetensors"))) > 1
+    merged = load_merged_state_dict(output_dir)
+    assert merged.keys() == expected.keys()
+    for key, tensor in merged.items():
+        assert torch.allclose(tensor, expected[key], atol=1e-5), key
+
+    with open(output_dir / "model.safetensors.index.json", encoding="utf-8") as file:
+        weight_map = json.load(file)["weight_map"]
+    assert weight_map.keys() == merged.keys()
+    assert (output_dir / "config.json").exists()
+    assert LlamaForCausalLM.from_pretrained(output_dir) is not None
+
+
+def test_merge_lora_sharded_casts_dtype(base_dir, tmp_path):
+    model = get_peft_model(
+        LlamaForCausalLM.from_pretrained(base_dir),
+        LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj"]),
+    )
+    adapter_dir = tmp_path / "adapter"
+    model.save_pretrained(adapter_dir)
+
+    output_dir = tmp_path / "merged"
+    merge_lora_sharded(base_dir, adapter_dir, output_dir, torch_dtype=torch.bfloat16)
+
+    merged = load_merged_state_dict(output_dir)
+    assert all(tensor.dtype == torch.bfloat16 for tensor in merged.values())
+    with open(output_dir / "config.json", encoding="utf-8") as file:
+        assert json.load(file)["torch_dtype"] == "bfloat16"
@@ -0,0 +1,120 @@
+"""
+tests for releasing memory under allocator pressure rather than on every step
+"""
+import gc
+
+import pytest
+import torch
+from transformers import TrainerControl, TrainerState
+
+from axolotl.utils.callbacks.memory import MemoryManagerCallback
+from axolotl.utils.dict import DictDefault
+
+GIB = 1024**3
+
+
+class FakeTrainer:
+    """stores the metrics merged into the next log"""
+
+    def __init__(self):
+        self.stored = []
+
+    def store_metrics(self, metrics, train_eval="train"):
+        self.stored.append((train_eval, metrics))
+
+
+@pytest.fixture(name="memory")
+def memory_fixture(monkeypatch):
+    memory = {"reserved": 0, "allocated": 0, "empty_cache": 0}
+
+    def empty_cache():
+        memory["empty_cache"] += 1
+        memory["reserved"] = memory["allocated"]
+
+    monkeypatch.setattr(torch.cuda, "memory_reserved", lambda: memory["reserved"])
+    monkeypatch.setattr(torch.cuda, "memory_allocated", lambda: memory["allocated"])
+    monkeypatch.setattr(torch.cuda, "empty_cache", empty_cache)
+    return memory
+
+
+@pytest.fixture(name="collections")
+def collections_fixture(monkeypatch):
+    collections = []
+    collect = gc.collect
+
+    def record(generation=2):
+        collections.append(generation)
+        return collect(generation)
+
+    monkeypatch.setattr(gc, "collect", record)
+    return collections
+
+
+def build_callback(**cfg):
+    trainer = FakeTrainer()
+    callback = MemoryManagerCallback(DictDefault(cfg), trainer)
+    callback.total_memory = 10 * GIB
+    return callback, trainer
+
+
+def step(callback, global_step, should_log=False):
+    state = TrainerState(global_step=global_step)
+    control = TrainerControl(should_log=should_log)
+    callback.on_step_end(None, state, control)
+
+
+def test_releases_only_under_pressure(memory, collections):
+    callback, trainer = build_callback()
+
+    # most of the device reserved, but little of it cached
+    memory.update(reserved=9.5 * GIB, allocated=9 * GIB)
+    step(callback, 1)
+    # little of the device reserved
+    memory.update(reserved=4 * GIB, allocated=1 * GIB)
+    step(callback, 2)
+    assert not collections
+    assert memory["empty_cache"] == 0
+
+    # escalates through the generations while the pressure stays
+    for global_step in range(3, 6):
+        memory.update(reserved=9.5 * GIB, allocated=6 * GIB)
+        step(callback, global_step, should_log=global_step == 5)
+    assert collections == [1, 2, 2]
+    assert memory["empty_cache"] == 3
+
+    assert len(trainer.stored) == 1
+    train_eval, metrics = trainer.stored[0]
+    assert train_eval == "train"
+    assert metrics["memory/releases"] == 3
+    assert metrics["memory/gc_seconds"] > 0
+    assert callback.stats["releases"] == 0
+
+    # starts over from the youngest generation once the pressure is gone
+    memory.update(reserved=4 * GIB, allocated=1 * GIB)
+    step(callback, 6)
+    memory.update(reserved=9.5 * GIB, allocated=6 * GIB)
+    step(callback, 7)
+    assert collections == [1, 2, 2, 1]
+
+
+def test_gc_steps(memory, collections):
+    callback, _ = build_callback(gc_steps=2)
+    for global_step in range(1, 5):
+        step(callback, global_step)
+    assert collections == [2, 2]
+    assert memory["empty_cache"] == 2
+
+
+def test_freeze_during_training():
+    callback, trainer = build_callback()
+    callback.on_train_begin(None, TrainerState(), TrainerControl())
+    try:
+        assert gc.get_freeze_count() > 0
+    finally:
+        callback.on_train_end(None, TrainerState(), TrainerControl())
+    assert gc.get_freeze_count() == 0
+    assert not trainer.stored
+
+    callback, _ = build_callback(gc_freeze=False)
+    callback.on_train_begin(None, TrainerState(), TrainerControl())
+    assert gc.get_freeze_count() == 0
@@ -0,0 +1,66 @@
+"""
+test module for group-wise multipack allocation
+"""
+import numpy as np
+import pytest
+
+from axolotl.utils.samplers.multipack import allocate_groups
+
+
+@pytest.fixture(name="lengths")
+def fixture_lengths():
+    return np.random.default_rng(0).integers(16, 2048, 5000)
+
+
+@pytest.mark.parametrize("group_size", [1000, 100_000])
+def test_bins_respect_capacity_and_bin_size(lengths, group_size):
+    offsets, packed = allocate_groups(lengths, 4096, group_size, bin_size=8)
+
+    assert sorted(packed.tolist()) == list(range(len(lengths)))
+    assert np.all(np.add.reduceat(lengths[packed], offsets[:-1]) <= 4096)
+    assert np.all(np.diff(offsets) <= 8)
+    assert np.all(np.diff(offsets) > 0)
+
+
+def test_groups_are_packed_independently(lengths):
+    offsets, packed = allocate_groups(lengths, 4096, group_size=1000, bin_size=200)
+
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        assert len(set(packed[start:end] // 1000)) == 1
+
+
+def test_oversized_samples_are_left_out():
+    offsets, packed = allocate_groups(
+        np.array([10, 5000, 20, 30]), 64, group_size=10, bin_size=200
+    )
+
+    assert offsets.tolist() == [0, 3]
+    assert packed.tolist() == [0, 2, 3]
+
+
+def test_packing_efficiency(lengths):
+    offsets, _ = allocate_groups(lengths, 4096, group_size=100_000, bin_size=200)
+
+    efficiency = lengths.sum() / ((len(offsets) - 1) * 4096)
+    assert efficiency > 0.99
+
+
+def test_shuffled_bins_have_no_length_curriculum(lengths):
+    def quintile_max_lengths(seed):
+        offsets, packed = allocate_groups(
+            lengths, 4096, group_size=100_000, bin_size=200, seed=seed
+        )
+        bin_max_lengths = np.maximum.reduceat(lengths[packed], offsets[:-1])
+        return [chunk.mean() for chunk in np.array_split(bin_max_lengths, 5)]
+
+    # first-fit-decreasing opens bins from the longest samples to the shortest
+    unshuffled = quintile_max_lengths(None)
+    assert unshuffled[0] > 2 * unshuffled[-1]
+
+    shuffled = quintile_max_lengths(42)
+    assert max(shuffled) < 1.2 * min(shuffled)
+    offsets, packed = allocate_groups(
+        lengths, 4096, group_size=100_000, bin_size=200, seed=42
+    )
+    assert sorted(packed.tolist()) == list(range(len(lengths)))
+    assert np.all(np.add.reduceat(lengths[packed], offsets[:-1]) <= 4096)
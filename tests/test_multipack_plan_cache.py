@@ -0,0 +1,95 @@
+"""
+test module for persisted multipack packing plans
+"""
+import numpy as np
+import pytest
+import torch
+from accelerate.data_loader import BatchSamplerShard
+from torch.utils.data import RandomSampler, SequentialSampler
+
+from axolotl.utils.samplers import MultipackBatchSampler
+
+
+@pytest.fixture(name="lengths")
+def fixture_lengths():
+    return np.random.default_rng(0).integers(16, 1024, 2000)
+
+
+def make_sampler(lengths, plan_cache_dir=None, seed=None):
+    return MultipackBatchSampler(
+        RandomSampler(range(len(lengths)), generator=torch.Generator()),
+        lengths=lengths,
+        batch_size=2,
+        batch_max_len=4096,
+        seed=seed,
+        plan_cache_dir=plan_cache_dir,
+    )
+
+
+def test_plan_is_persisted_and_reused(lengths, tmp_path):
+    sampler = make_sampler(lengths, tmp_path, seed=42)
+    batches = list(sampler)
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+
+    reloaded = make_sampler(lengths, tmp_path, seed=42)
+    assert list(reloaded) == batches
+    assert reloaded.efficiency() == sampler.efficiency()
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+
+
+def test_plan_covers_each_sample_once(lengths, tmp_path):
+    sampler = make_sampler(lengths, tmp_path, seed=42)
+    packed = [idx for batch in sampler for bin_ in batch for idx in bin_]
+
+    assert len(packed) == len(set(packed))
+    for batch in sampler:
+        for bin_ in batch:
+            assert lengths[bin_].sum() <= 4096
+
+
+def test_seeded_order_is_stable_per_epoch(lengths):
+    sampler = make_sampler(lengths, seed=42)
+    num_batches = sampler.num_batches()
+    batches = list(sampler)
+    assert num_batches == len(batches)
+    # the next iteration is the next epoch
+    assert list(sampler) != batches
+
+    sampler.set_epoch(0)
+    assert list(sampler) == batches
+
+
+def test_sharded_order_changes_per_epoch(lengths):
+    # set_epoch isn't forwarded through accelerate's BatchSamplerShard
+    shards = [
+        BatchSamplerShard(
+            make_sampler(lengths, seed=42), num_processes=2, process_index=rank
+        )
+        for rank in range(2)
+    ]
+    first_epoch = [list(shard) for shard in shards]
+    second_epoch = [list(shard) for shard in shards]
+
+    for first, second in zip(first_epoch, second_epoch):
+        assert first != second
+    # ranks still split the same order
+    for epoch in (first_epoch, second_epoch):
+        packed = [
+            idx for shard in epoch for batch in shard for bin_ in batch for idx in bin_
+        ]
+        assert len(packed) == len(set(packed))
+
+
+def test_matches_unpersisted_plan(lengths, tmp_path):
+    def sequential_sampler(plan_cache_dir):
+        return MultipackBatchSampler(
+            SequentialSampler(range(len(lengths))),
+            lengths=lengths,
+            batch_size=1,
+            batch_max_len=4096,
+            plan_cache_dir=plan_cache_dir,
+        )
+
+    expected = list(sequential_sampler(None))
+    assert list(sequential_sampler(tmp_path)) == expected
+    assert list(sequential_sampler(tmp_path)) == expected
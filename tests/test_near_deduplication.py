@@ -0,0 +1,108 @@
+"""
+Test cases for MinHash/LSH near-deduplication
+"""
+import unittest
+
+import numpy as np
+from datasets import Dataset
+
+from axolotl.utils.data.near_dedup import (
+    StreamingNearDeduplicator,
+    cluster_signatures,
+    near_deduplicate_dataset,
+    optimal_lsh_params,
+)
+
+
+def perturb(row, num_tokens, rng):
+    row = list(row)
+    for pos in rng.choice(len(row), size=num_tokens, replace=False):
+        row[pos] = int(rng.integers(50_000, 60_000))
+    return row
+
+
+class TestNearDeduplication(unittest.TestCase):
+    """
+    near-deduplication of tokenized datasets and streams
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.unique = [
+            rng.integers(0, 32_000, size=int(rng.integers(100, 400))).tolist()
+            for _ in range(50)
+        ]
+        # a near duplicate of rows 0 and 1, an exact duplicate of row 2 and an empty row
+        self.rows = self.unique + [
+            perturb(self.unique[0], 1, rng),
+            perturb(self.unique[1], 1, rng),
+            self.unique[2],
+            [],
+        ]
+
+    def test_optimal_lsh_params(self):
+        num_bands, rows_per_band = optimal_lsh_params(0.8, 128)
+        assert num_bands * rows_per_band <= 128
+        # a lower threshold needs fewer rows per band to collide
+        assert optimal_lsh_params(0.5, 128)[1] < rows_per_band
+
+    def test_cluster_signatures_chains(self):
+        signatures = np.array([[1, 2], [1, 3], [4, 3], [5, 6], [5, 6]], dtype=np.uint32)
+        empty = np.array([False, False, False, False, True])
+        labels = cluster_signatures(signatures, 2, 1, empty)
+        assert labels.tolist() == [0, 0, 0, 3, 4]
+
+    def test_removes_near_duplicates(self):
+        dataset = Dataset.from_dict({"input_ids": self.rows})
+        deduped, signatures = near_deduplicate_dataset(dataset)
+
+        assert deduped["input_ids"] == self.unique + [[]]
+        assert signatures.shape == (len(deduped), 128)
+
+    def test_follows_selected_indices(self):
+        dataset = Dataset.from_dict({"input_ids": self.rows}).select(
+            range(len(self.rows) - 1, -1, -1)
+        )
+        deduped, _ = near_deduplicate_dataset(dataset)
+
+        assert len(deduped) == len(self.unique) + 1
+        assert deduped[0]["input_ids"] == []
+
+    def test_drops_rows_seen_in_train(self):
+        train, train_signatures = near_deduplicate_dataset(
+            Dataset.from_dict({"input_ids": self.unique[:10]})
+        )
+        rng = np.random.default_rng(1)
+        eval_rows = [perturb(self.unique[3], 2, rng)] + self.unique[10:20]
+        deduped, _ = near_deduplicate_dataset(
+            Dataset.from_dict({"input_ids": eval_rows}),
+            seen_signatures=train_signatures,
+        )
+
+        assert len(train) == 10
+        assert deduped["input_ids"] == self.unique[10:20]
+
+    def test_streaming_matches_dataset(self):
+        near_dedup = StreamingNearDeduplicator()
+        keep = np.concatenate(
+            [
+                near_dedup.keep_mask(self.rows[:30]),
+                near_dedup.keep_mask(self.rows[30:]),
+            ]
+        )
+
+        assert np.flatnonzero(~keep).tolist() == [50, 51, 52]
+        assert near_dedup.num_removed == 3
+        assert near_dedup.num_clusters == 3
+
+    def test_streaming_memory_is_bounded(self):
+        near_dedup = StreamingNearDeduplicator(max_entries=5)
+        keep = near_dedup.keep_mask(self.rows)
+
+        assert all(len(buckets) <= 5 for buckets in near_dedup.buckets)
+        # the originals were forgotten before their duplicates arrived
+        assert keep[50] and keep[51]
+
+
+if __name__ == "__main__":
+    unittest.main()
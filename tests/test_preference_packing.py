@@ -0,0 +1,175 @@
+"""
+Tests for prefix-shared packing of preference rows
+"""
+import pytest
+import torch
+from trl.trainer.dpo_trainer import PreferenceCollator
+
+from axolotl.core.trainer_builder import AxolotlDPOConfig, AxolotlDPOTrainer
+from axolotl.utils.collators import PackedPreferenceCollator
+from axolotl.utils.preference_packing import (
+    CHOSEN_SEGMENT,
+    PAD_SEGMENT,
+    PROMPT_SEGMENT,
+    REJECTED_SEGMENT,
+)
+
+
+def build_trainer(model, tokenizer, dataset, tmp_path, loss_type):
+    args = AxolotlDPOConfig(
+        output_dir=str(tmp_path),
+        per_device_train_batch_size=2,
+        max_length=16,
+        loss_type=loss_type,
+        rpo_alpha=0.5,
+        sample_packing=True,
+        report_to="none",
+        use_cpu=True,
+    )
+    return AxolotlDPOTrainer(
+        model,
+        None,
+        args=args,
+        train_dataset=dataset,
+        processing_class=tokenizer,
+        data_collator=PackedPreferenceCollator(
+            pad_token_id=tokenizer.pad_token_id, max_length=16
+        ),
+    )
+
+
+def test_collator_layout():
+    collator = PackedPreferenceCollator(pad_token_id=0)
+    batch = collator(
+        [
+            [
+                {
+                    "prompt_input_ids": [5, 6, 7],
+                    "chosen_input_ids": [8, 9],
+                    "rejected_input_ids": [10],
+                },
+                {
+                    "prompt_input_ids": [11],
+                    "chosen_input_ids": [12],
+                    "rejected_input_ids": [13, 14],
+                },
+            ],
+            [
+                {
+                    "prompt_input_ids": [15, 16],
+                    "chosen_input_ids": [17],
+                    "rejected_input_ids": [18],
+                }
+            ],
+        ]
+    )
+    assert batch["input_ids"].tolist() == [
+        [5, 6, 7, 8, 9, 10, 11, 12, 13, 14],
+        [15, 16, 17, 18, 0, 0, 0, 0, 0, 0],
+    ]
+    # both responses continue the positions of the prompt
+    assert batch["position_ids"].tolist() == [
+        [0, 1, 2, 3, 4, 3, 0, 1, 1, 2],
+        [0, 1, 2, 2, 0, 0, 0, 0, 0, 0],
+    ]
+    assert batch["sequence_ids"].tolist() == [
+        [0, 0, 0, 0, 0, 0, 1, 1, 1, 1],
+        [2, 2, 2, 2, -1, -1, -1, -1, -1, -1],
+    ]
+    p, c, r, pad = PROMPT_SEGMENT, CHOSEN_SEGMENT, REJECTED_SEGMENT, PAD_SEGMENT
+    assert batch["segment_ids"].tolist() == [
+        [p, p, p, c, c, r, p, c, r, r],
+        [p, p, c, r, pad, pad, pad, pad, pad, pad],
+    ]
+    # the first token of both responses is predicted from the last prompt token
+    assert batch["logits_positions"].tolist() == [
+        [-1, -1, -1, 2, 3, 2, -1, 6, 6, 8],
+        [-1, -1, 1, 1, -1, -1, -1, -1, -1, -1],
+    ]
+
+
+def test_collator_truncates_responses():
+    collator = PackedPreferenceCollator(pad_token_id=0, max_length=4)
+    batch = collator(
+        [
+            {
+                "prompt_input_ids": [5, 6, 7],
+                "chosen_input_ids": [8, 9],
+                "rejected_input_ids": [10, 11, 12],
+                "ref_chosen_logps": -1.0,
+                "ref_rejected_logps": -2.0,
+            }
+        ]
+    )
+    assert batch["input_ids"].tolist() == [[5, 6, 7, 8, 10]]
+    assert batch["ref_chosen_logps"].tolist() == [-1.0]
+    assert batch["ref_rejected_logps"].tolist() == [-2.0]
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+@pytest.mark.parametrize("loss_type", ["sigmoid", "ipo"])
+def test_packed_forward_matches_unpacked(
+    tiny_llama_factory,
+    tiny_tokenizer,
+    preference_dataset,
+    tmp_path,
+    attn_implementation,
+    loss_type,
+):
+    model = tiny_llama_factory(vocab_size=32, attn_implementation=attn_implementation)
+    trainer = build_trainer(
+        model, tiny_tokenizer, preference_dataset, tmp_path, loss_type
+    )
+    rows = trainer.train_dataset.to_list()
+    packed = trainer.data_collator([rows[:3], rows[3:5], rows[5:6]])
+    with torch.no_grad():
+        output = trainer.concatenated_forward(trainer.model, packed)
+
+    unpacked_collator = PreferenceCollator(pad_token_id=tiny_tokenizer.pad_token_id)
+    chosen_tokens = 0
+    nll = 0.0
+    for idx, row in enumerate(rows[:6]):
+        with torch.no_grad():
+            expected = super(AxolotlDPOTrainer, trainer).concatenated_forward(
+                trainer.model, unpacked_collator([row])
+            )
+        assert output["chosen_logps"][idx].item() == pytest.approx(
+            expected["chosen_logps"].item(), abs=1e-4
+        )
+        assert output["rejected_logps"][idx].item() == pytest.approx(
+            expected["rejected_logps"].item(), abs=1e-4
+        )
+        num_tokens = len(row["chosen_input_ids"])
+        chosen_tokens += num_tokens
+        nll += expected["nll_loss"].item() * num_tokens
+    assert output["nll_loss"].item() == pytest.approx(nll / chosen_tokens, abs=1e-4)
+
+
+def test_packed_dataloader_trains(
+    tiny_llama_factory, tiny_tokenizer, preference_dataset, tmp_path
+):
+    import axolotl.monkeypatch.data.batch_dataset_fetcher  # pylint: disable=unused-import  # noqa: F401
+
+    model = tiny_llama_factory(vocab_size=32, attn_implementation="sdpa")
+    trainer = build_trainer(
+        model, tiny_tokenizer, preference_dataset, tmp_path, "sigmoid"
+    )
+    dataloader = trainer.get_train_dataloader()
+    num_sequences = 0
+    for batch in dataloader:
+        assert batch["input_ids"].shape[0] <= trainer.args.per_device_train_batch_size
+        assert batch["input_ids"].shape[1] <= 2 * trainer.args.max_length
+        num_sequences += int(batch["sequence_ids"].max()) + 1
+    assert 0 < num_sequences <= len(preference_dataset)
+
+    batch = trainer._prepare_inputs(  # pylint: disable=protected-access
+        next(iter(dataloader))
+    )
+    loss = trainer.compute_loss(trainer.model, batch)
+    loss.backward()
+    assert torch.isfinite(loss)
+    assert all(
+        torch.isfinite(param.grad).all()
+        for param in trainer.model.parameters()
+        if param.grad is not None
+    )
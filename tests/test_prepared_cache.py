@@ -0,0 +1,160 @@
+"""
+test module for the per-source prepared dataset cache
+"""
+import os
+import time
+
+import numpy as np
+import pytest
+from datasets import Dataset
+
+from axolotl.common.const import PACKING_PLANS_DIR
+from axolotl.utils.data.cache import (
+    PREPARED_SOURCES_DIR,
+    evict_prepared_datasets,
+    get_source_dataset_hash,
+    get_source_prepared_path,
+    get_tokenizer_fingerprint,
+    load_prepared_source,
+    save_prepared_source,
+)
+from axolotl.utils.dict import DictDefault
+
+
+@pytest.fixture(name="cfg")
+def fixture_cfg():
+    return DictDefault({"sequence_len": 1024, "train_on_inputs": False})
+
+
+@pytest.fixture(name="config_dataset")
+def fixture_config_dataset():
+    return DictDefault({"path": "dummy", "type": "alpaca"})
+
+
+@pytest.fixture(name="dataset")
+def fixture_dataset():
+    return Dataset.from_dict({"input_ids": [[1, 2, 3], [4, 5]]})
+
+
+class TestTokenizerFingerprint:
+    """
+    test that the tokenizer fingerprint tracks tokenizer contents, not its name
+    """
+
+    def test_stable_across_instances(self, tiny_tokenizer_factory):
+        assert get_tokenizer_fingerprint(
+            tiny_tokenizer_factory()
+        ) == get_tokenizer_fingerprint(tiny_tokenizer_factory())
+
+    def test_ignores_truncation_state(self, tiny_tokenizer):
+        base = get_tokenizer_fingerprint(tiny_tokenizer)
+        tiny_tokenizer("the quick brown fox", truncation=True, max_length=1)
+        assert get_tokenizer_fingerprint(tiny_tokenizer) == base
+
+    def test_changes_with_chat_template(self, tiny_tokenizer):
+        base = get_tokenizer_fingerprint(tiny_tokenizer)
+        tiny_tokenizer.chat_template = "{{ messages[0]['content'] }}"
+        assert get_tokenizer_fingerprint(tiny_tokenizer) != base
+
+    def test_changes_with_added_tokens(self, tiny_tokenizer):
+        base = get_tokenizer_fingerprint(tiny_tokenizer)
+        tiny_tokenizer.add_special_tokens({"additional_special_tokens": ["<|im_end|>"]})
+        assert get_tokenizer_fingerprint(tiny_tokenizer) != base
+
+    def test_changes_with_vocab(self, tiny_tokenizer, tiny_tokenizer_factory):
+        other = tiny_tokenizer_factory(["hello"])
+        assert get_tokenizer_fingerprint(tiny_tokenizer) != get_tokenizer_fingerprint(
+            other
+        )
+
+
+class TestSourceDatasetHash:
+    """
+    test that the source hash only changes with what affects tokenization
+    """
+
+    def test_stable(self, cfg, config_dataset, dataset):
+        assert get_source_dataset_hash(
+            cfg, config_dataset, dataset, "tok"
+        ) == get_source_dataset_hash(cfg, config_dataset, dataset, "tok")
+
+    def test_changes_with_dataset_config(self, cfg, config_dataset, dataset):
+        other = DictDefault({**config_dataset, "type": "completion"})
+        assert get_source_dataset_hash(
+            cfg, config_dataset, dataset, "tok"
+        ) != get_source_dataset_hash(cfg, other, dataset, "tok")
+
+    def test_changes_with_cfg_and_tokenizer(self, cfg, config_dataset, dataset):
+        base = get_source_dataset_hash(cfg, config_dataset, dataset, "tok")
+        other_cfg = DictDefault({**cfg, "sequence_len": 2048})
+        assert base != get_source_dataset_hash(
+            other_cfg, config_dataset, dataset, "tok"
+        )
+        assert base != get_source_dataset_hash(cfg, config_dataset, dataset, "tok2")
+
+    def test_ignores_unrelated_cfg(self, cfg, config_dataset, dataset):
+        other_cfg = DictDefault({**cfg, "learning_rate": 1e-5})
+        assert get_source_dataset_hash(
+            cfg, config_dataset, dataset, "tok"
+        ) == get_source_dataset_hash(other_cfg, config_dataset, dataset, "tok")
+
+
+def test_save_and_load_prepared_source(tmp_path, dataset):
+    source_path = get_source_prepared_path(tmp_path, "abc")
+    assert load_prepared_source(source_path) is None
+
+    save_prepared_source(dataset, source_path)
+    assert not source_path.with_name("abc.tmp").exists()
+    assert load_prepared_source(source_path)["input_ids"] == dataset["input_ids"]
+
+
+class TestEvictPreparedDatasets:
+    """
+    test LRU eviction of merged and per-source prepared datasets
+    """
+
+    @staticmethod
+    def make_entries(tmp_path, dataset):
+        now = time.time()
+        entries = {
+            "old": tmp_path / "old",
+            "new": tmp_path / "new",
+            "source": tmp_path / PREPARED_SOURCES_DIR / "source",
+        }
+        for age_days, path in zip([10, 0, 5], entries.values()):
+            save_prepared_source(dataset, path)
+            mtime = now - age_days * 24 * 60 * 60
+            os.utime(path, (mtime, mtime))
+        return entries
+
+    def test_max_age(self, tmp_path, dataset):
+        entries = self.make_entries(tmp_path, dataset)
+        evicted = evict_prepared_datasets(tmp_path, max_age_days=3)
+
+        assert evicted == [entries["old"], entries["source"]]
+        assert entries["new"].exists()
+        assert not entries["old"].exists()
+        assert not entries["source"].exists()
+
+    def test_max_size_evicts_least_recently_used(self, tmp_path, dataset):
+        entries = self.make_entries(tmp_path, dataset)
+        evicted = evict_prepared_datasets(tmp_path, max_size_gb=0)
+
+        assert evicted == [entries["old"], entries["source"], entries["new"]]
+
+    def test_packing_plans(self, tmp_path, dataset):
+        entries = self.make_entries(tmp_path, dataset)
+        plan = tmp_path / PACKING_PLANS_DIR / "plan.npy"
+        plan.parent.mkdir()
+        np.save(plan, np.zeros(4, dtype=np.int32))
+        evicted = evict_prepared_datasets(tmp_path, max_size_gb=0)
+
+        assert evicted == [entries["old"], entries["source"], entries["new"], plan]
+        assert not plan.exists()
+
+    def test_dry_run(self, tmp_path, dataset):
+        entries = self.make_entries(tmp_path, dataset)
+        evicted = evict_prepared_datasets(tmp_path, max_age_days=3, dry_run=True)
+
+        assert evicted == [entries["old"], entries["source"]]
+        assert all(path.exists() for path in entries.values())
@@ -0,0 +1,197 @@
+"""
+tests for weighted interleaving of streaming pretraining sources
+"""
+import functools
+
+import numpy as np
+import pytest
+from datasets import Dataset
+
+from axolotl.utils.data import (
+    get_dataset_wrapper,
+    prepare_dataset,
+    wrap_pretraining_dataset,
+)
+from axolotl.utils.data.pretraining import PretrainingMixture
+from axolotl.utils.dict import DictDefault
+
+
+def stream(source: int, num_rows: int):
+    return Dataset.from_dict(
+        {
+            "source": [source] * num_rows,
+            "row": list(range(num_rows)),
+            "attention_mask": [[1] * (source + 1)] * num_rows,
+        }
+    ).to_iterable_dataset()
+
+
+def test_mixture_is_deterministic_and_weighted():
+    def draw(seed):
+        mixture = PretrainingMixture(
+            [stream(0, 10_000), stream(1, 10_000)], ["a", "b"], [3.0, 1.0], seed=seed
+        )
+        return [row["source"] for _, row in zip(range(4000), mixture())]
+
+    sources = draw(42)
+    assert sources == draw(42)
+    assert sources != draw(7)
+    assert np.mean(np.array(sources) == 0) == pytest.approx(0.75, abs=0.03)
+
+
+def test_mixture_reshuffles_every_epoch():
+    mixture = PretrainingMixture(
+        [
+            stream(source, 1000).shuffle(seed=source, buffer_size=100)
+            for source in (0, 1)
+        ],
+        ["a", "b"],
+        [1.0, 1.0],
+        seed=0,
+    )
+
+    def draw():
+        return [(row["source"], row["row"]) for row in mixture()]
+
+    first, second = draw(), draw()
+    assert mixture.epoch == 1
+    assert sorted(first) == sorted(second)
+    assert [source for source, _ in first] != [source for source, _ in second]
+    # the sources' own shuffles move on with the epoch too
+    assert [row for source, row in first if source == 0] != [
+        row for source, row in second if source == 0
+    ]
+
+    # an explicit epoch replays that epoch's order
+    mixture.set_epoch(1)
+    assert draw() == second
+
+
+def test_mixture_counts_tokens_and_drains_exhausted_sources():
+    mixture = PretrainingMixture(
+        [stream(0, 5), stream(1, 50)], ["a", "b"], [100.0, 1.0], seed=0
+    )
+
+    sources = [row["source"] for row in mixture()]
+
+    assert sorted(sources) == [0] * 5 + [1] * 50
+    # the heavily weighted source comes first until it runs out
+    assert sources.index(1) < 10
+    assert mixture.num_rows.tolist() == [5, 50]
+    assert mixture.num_tokens.tolist() == [5, 100]
+
+
+def test_mixture_ends_when_remaining_sources_have_no_weight():
+    mixture = PretrainingMixture(
+        [stream(0, 5), stream(1, 50)], ["a", "b"], [1.0, 0.0], seed=0
+    )
+
+    assert [row["source"] for row in mixture()] == [0] * 5
+    assert mixture.probabilities(0, np.array([False, True])) is None
+
+
+def test_mixture_weight_schedule_and_temperature():
+    mixture = PretrainingMixture(
+        [stream(0, 1), stream(1, 1)],
+        ["a", "b"],
+        [1.0, 0.0],
+        final_weights=[0.0, 1.0],
+        total_rows=100,
+    )
+    active = np.ones(2, dtype=bool)
+    assert mixture.probabilities(0, active).tolist() == [1.0, 0.0]
+    assert mixture.probabilities(50, active).tolist() == [0.5, 0.5]
+    assert mixture.probabilities(200, active).tolist() == [0.0, 1.0]
+
+    mixture = PretrainingMixture(
+        [stream(0, 1), stream(1, 1)], ["a", "b"], [4.0, 1.0], temperature=2.0
+    )
+    assert mixture.probabilities(0, active) == pytest.approx([2 / 3, 1 / 3])
+    assert mixture.probabilities(0, np.array([False, True])).tolist() == [0.0, 1.0]
+
+
+WORDS = ["alpha", "beta", "gamma", "delta"]
+
+
+@pytest.fixture(name="tokenizer")
+def fixture_tokenizer(tiny_tokenizer_factory):
+    return tiny_tokenizer_factory(WORDS)
+
+
+def test_wrap_pretraining_dataset_interleaves_sources(tokenizer):
+    cfg = DictDefault(
+        {
+            "sample_packing": False,
+            "max_steps": 10,
+            "micro_batch_size": 1,
+            "gradient_accumulation_steps": 1,
+        }
+    )
+    sources = [
+        Dataset.from_dict({"text": [f"{word} {word}"] * 20}).to_iterable_dataset()
+        for word in WORDS[:2]
+    ]
+    ds_wrapper_fns = [
+        functools.partial(
+            get_dataset_wrapper,
+            DictDefault({"path": word, "type": "pretrain"}),
+            tokenizer,
+            cfg,
+            "pretrain",
+        )
+        for word in WORDS[:2]
+    ]
+
+    dataset = wrap_pretraining_dataset(
+        sources,
+        tokenizer,
+        cfg,
+        ds_wrapper_fns,
+        max_tokens=4,
+        buffer_size=5,
+        weights=[1.0, 1.0],
+        names=WORDS[:2],
+    )
+    rows = list(dataset)
+
+    # every 4 token row holds one "word word </s>" text plus padding
+    assert len(rows) == 40
+    first_tokens = tokenizer.convert_ids_to_tokens(
+        [row["input_ids"][0] for row in rows]
+    )
+    assert sorted(first_tokens) == ["alpha"] * 20 + ["beta"] * 20
+    assert first_tokens != sorted(first_tokens)
+
+
+def test_prepare_dataset_keeps_zero_weights(tokenizer, tmp_path):
+    pretraining_dataset = []
+    for word, weight, final_weight in (("alpha", 0, 1.0), ("beta", 1.0, 0)):
+        path = tmp_path / word
+        path.mkdir()
+        Dataset.from_dict({"text": [f"{word} {word}"] * 200}).to_json(
+            path / "data.jsonl"
+        )
+        pretraining_dataset.append(
+            {
+                "path": str(path),
+                "type": "pretrain",
+                "weight": weight,
+                "final_weight": final_weight,
+            }
+        )
+    cfg = DictDefault(
+        {
+            "pretraining_dataset": pretraining_dataset,
+            "sequence_len": 4,
+            "sample_packing": False,
+            "max_steps": 1000,
+            "micro_batch_size": 1,
+            "gradient_accumulation_steps": 1,
+        }
+    )
+
+    train_dataset, _, _, _ = prepare_dataset(cfg, tokenizer)
+
+    # alpha ramps in from 0, so the first rows are all beta
+    first_tokens = [row["input_ids"][0] for _, row in zip(range(20), train_dataset)]
+    assert tokenizer.convert_ids_to_tokens(first_tokens) == ["beta"] * 20
@@ -0,0 +1,75 @@
+"""
+test module for the Arrow-native packing preprocessing
+"""
+from functools import partial
+
+import numpy as np
+import pytest
+from accelerate import PartialState
+from datasets import Dataset, concatenate_datasets
+
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.trainer import (
+    add_length,
+    add_position_ids,
+    drop_long_seq,
+    process_datasets_for_packing,
+)
+
+
+@pytest.fixture(name="dataset")
+def fixture_dataset():
+    rng = np.random.default_rng(42)
+    rows = []
+    for _ in range(200):
+        input_ids = rng.integers(0, 1000, rng.integers(0, 48)).tolist()
+        # some rows end up with no trainable tokens
+        labels = [token if rng.random() < 0.2 else -100 for token in input_ids]
+        rows.append(
+            {
+                "input_ids": input_ids,
+                "labels": labels,
+                "attention_mask": [1] * len(input_ids),
+            }
+        )
+    # multiple arrow chunks and an indices mapping, as after merging and shuffling
+    return concatenate_datasets(
+        [Dataset.from_list(rows[:100]), Dataset.from_list(rows[100:])]
+    ).shuffle(seed=42)
+
+
+def per_row_process(cfg, dataset):
+    dataset = dataset.filter(
+        partial(
+            drop_long_seq,
+            sequence_len=cfg.sequence_len,
+            min_sequence_len=cfg.min_sample_len,
+        )
+    )
+    dataset = dataset.filter(lambda sample: np.sum(np.array(sample["labels"]) != -100))
+    if cfg.group_by_length:
+        dataset = dataset.map(add_length)
+    if cfg.sample_packing:
+        dataset = dataset.map(add_position_ids)
+    return dataset
+
+
+@pytest.mark.parametrize("sample_packing", [True, False])
+@pytest.mark.parametrize("group_by_length", [True, False])
+def test_matches_per_row_processing(dataset, sample_packing, group_by_length):
+    PartialState()
+    cfg = DictDefault(
+        {
+            "sequence_len": 32,
+            "min_sample_len": 3,
+            "sample_packing": sample_packing,
+            "group_by_length": group_by_length,
+            "dataset_processes": 1,
+            "is_preprocess": True,
+        }
+    )
+    train_dataset, _ = process_datasets_for_packing(cfg, dataset, None)
+    expected = per_row_process(cfg, dataset)
+
+    assert train_dataset.features == expected.features
+    assert train_dataset[:] == expected[:]
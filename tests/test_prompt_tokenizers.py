@@ -121,6 +121,30 @@ class TestPromptTokenizationStrategies(unittest.TestCase):
         assert example["labels"][world_idx] == 6324
         assert example["labels"][world_idx - 1] == -100
 
+    def test_alpaca_batched(self):
+        """
+        tests that batched tokenization matches tokenizing row by row
+        """
+        # pylint: disable=duplicate-code
+        strat = AlpacaPromptTokenizingStrategy(
+            AlpacaPrompter(),
+            self.tokenizer,
+            False,
+            2048,
+        )
+        assert strat.supports_batched
+        samples = [
+            {"instruction": "hello!", "input": "", "output": "Hi! How can I help?"},
+            {"instruction": "add", "input": "1 + 1", "output": "2"},
+            {"instruction": "say nothing", "input": "", "output": ""},
+        ]
+        batch = {key: [sample[key] for sample in samples] for key in samples[0]}
+        batched = strat.tokenize_prompt_batched(batch)
+        for idx, sample in enumerate(samples):
+            example = strat.tokenize_prompt(sample)
+            for key in ["input_ids", "attention_mask", "labels"]:
+                assert batched[key][idx] == example[key]
+
 
 class InstructionWSystemPromptTokenizingStrategyTest(unittest.TestCase):
     """
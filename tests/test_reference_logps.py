@@ -0,0 +1,113 @@
+"""
+Tests for the offline cache of reference model log-probs
+"""
+import pytest
+import torch
+from datasets import Dataset
+from trl import DPOConfig
+
+from axolotl.core.trainer_builder import AxolotlDPOTrainer
+from axolotl.utils.data.cache import save_prepared_source
+from axolotl.utils.data.reference_logps import (
+    _reference_row_lengths,
+    attach_reference_logps,
+    compute_reference_logps,
+    get_reference_logps_path,
+    has_reference_logps,
+)
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.generation import bucket_by_token_budget
+
+
+@pytest.fixture(name="trainer")
+def trainer_fixture(tiny_llama_factory, tiny_tokenizer, preference_dataset, tmp_path):
+    args = DPOConfig(
+        output_dir=str(tmp_path),
+        per_device_train_batch_size=2,
+        precompute_ref_log_probs=True,
+        report_to="none",
+        use_cpu=True,
+    )
+    return AxolotlDPOTrainer(
+        tiny_llama_factory(vocab_size=32),
+        args=args,
+        train_dataset=preference_dataset,
+        processing_class=tiny_tokenizer,
+    )
+
+
+def test_single_row_batches_match_per_row(trainer):
+    dataset = trainer.train_dataset
+    logps = compute_reference_logps(trainer, dataset, "dpo", max_tokens=1)
+    assert len(logps) == len(dataset)
+    for idx, row in enumerate(dataset):
+        chosen, rejected = trainer.compute_ref_log_probs(trainer.data_collator([row]))
+        assert logps[idx]["ref_chosen_logps"] == pytest.approx(chosen.item(), abs=1e-4)
+        assert logps[idx]["ref_rejected_logps"] == pytest.approx(
+            rejected.item(), abs=1e-4
+        )
+
+
+def test_sorted_batches_keep_dataset_order(trainer):
+    dataset = trainer.train_dataset
+    max_tokens = 64
+    logps = compute_reference_logps(trainer, dataset, "dpo", max_tokens=max_tokens)
+    buckets = bucket_by_token_budget(
+        _reference_row_lengths(dataset, "dpo"), 0, max_tokens
+    )
+    assert 1 < len(buckets) < len(dataset)
+    for bucket in buckets:
+        chosen, rejected = trainer.compute_ref_log_probs(
+            trainer.data_collator([dataset[idx] for idx in bucket])
+        )
+        assert logps[bucket]["ref_chosen_logps"] == pytest.approx(
+            chosen.tolist(), abs=1e-4
+        )
+        assert logps[bucket]["ref_rejected_logps"] == pytest.approx(
+            rejected.tolist(), abs=1e-4
+        )
+
+
+def test_collator_keeps_reference_logps(trainer):
+    dataset = trainer.train_dataset
+    logps = compute_reference_logps(trainer, dataset, "dpo", max_tokens=64)
+    batch = trainer.data_collator([{**dataset[idx], **logps[idx]} for idx in range(3)])
+    assert batch["ref_chosen_logps"].shape == (3,)
+    assert torch.equal(
+        batch["ref_rejected_logps"], torch.tensor(logps[:3]["ref_rejected_logps"])
+    )
+
+
+def test_attach_reference_logps(tiny_tokenizer, preference_dataset, tmp_path):
+    dataset = preference_dataset
+    cfg = DictDefault(
+        {
+            "rl": "dpo",
+            "base_model": "tiny",
+            "sequence_len": 64,
+            "dataset_prepared_path": str(tmp_path),
+            "datasets": [{"path": "dpo.jsonl", "type": "chatml.intel"}],
+        }
+    )
+    train, _ = attach_reference_logps(cfg, dataset, None, tiny_tokenizer)
+    assert not has_reference_logps(train, "dpo")
+
+    path = get_reference_logps_path(cfg, "train", dataset, tiny_tokenizer)
+    path.parent.mkdir(parents=True)
+    save_prepared_source(
+        Dataset.from_dict(
+            {
+                "ref_chosen_logps": [-1.0] * len(dataset),
+                "ref_rejected_logps": [-2.0] * len(dataset),
+            }
+        ),
+        path,
+    )
+    train, _ = attach_reference_logps(cfg, dataset, None, tiny_tokenizer)
+    assert has_reference_logps(train, "dpo")
+    assert train[0]["prompt"] == dataset[0]["prompt"]
+
+    # a different reference model isn't the cached one
+    cfg.base_model = "other"
+    train, _ = attach_reference_logps(cfg, dataset, None, tiny_tokenizer)
+    assert not has_reference_logps(train, "dpo")
@@ -0,0 +1,115 @@
+"""
+Tests for tokenizing preference datasets once while preprocessing
+"""
+import pytest
+from trl import DPOTrainer
+from trl.trainer import kto_trainer
+from trl.trainer.kto_trainer import _tokenize as kto_tokenize
+
+from axolotl.core.trainer_builder import AxolotlDPOTrainer
+from axolotl.monkeypatch.trainer_kto_tokenize import (
+    kto_tokenize_unless_pretokenized,
+    patch_kto_tokenize,
+)
+from axolotl.utils.data.rl import (
+    _get_ds_hash,
+    drop_long_rl_seq,
+    drop_long_rl_seq_tokenized,
+    tokenize_rl_batch,
+)
+from axolotl.utils.dict import DictDefault
+
+
+@pytest.fixture(name="dpo_batch")
+def dpo_batch_fixture():
+    return {
+        "prompt": ["the quick brown fox", "a lazy dog", "axolotls swim"],
+        "chosen": ["jumps over a lazy dog", "swim", "while the fox jumps over"],
+        "rejected": ["swim", "the quick brown fox jumps", "dog"],
+    }
+
+
+@pytest.mark.parametrize("add_special_tokens", [False, True])
+@pytest.mark.parametrize("max_completion_length", [None, 2])
+def test_dpo_pretokenized_row_matches_trl(
+    tiny_tokenizer, dpo_batch, add_special_tokens, max_completion_length
+):
+    tokenized = tokenize_rl_batch(dpo_batch, "dpo", tiny_tokenizer)
+    for idx in range(len(dpo_batch["prompt"])):
+        row = {key: values[idx] for key, values in dpo_batch.items()}
+        pretokenized = {key: values[idx] for key, values in tokenized.items()}
+        args = (tiny_tokenizer, 3, max_completion_length, add_special_tokens)
+        assert AxolotlDPOTrainer.tokenize_row(
+            {**row, **pretokenized}, *args
+        ) == DPOTrainer.tokenize_row(row, *args)
+
+
+@pytest.mark.parametrize("sequence_len", [4, 6, 8])
+def test_drop_long_tokenized_matches_strings(tiny_tokenizer, dpo_batch, sequence_len):
+    tokenized = tokenize_rl_batch(dpo_batch, "dpo", tiny_tokenizer)
+    expected = [
+        drop_long_rl_seq(
+            {key: values[idx] for key, values in dpo_batch.items()},
+            rl="dpo",
+            tokenizer=tiny_tokenizer,
+            sequence_len=sequence_len,
+        )
+        for idx in range(len(dpo_batch["prompt"]))
+    ]
+    assert (
+        drop_long_rl_seq_tokenized(tokenized, rl="dpo", sequence_len=sequence_len)
+        == expected
+    )
+
+
+def test_kto_pretokenized_matches_trl(tiny_tokenizer):
+    batch = {
+        "prompt": ["the quick brown fox", "a lazy dog"],
+        "completion": [" jumps over", " swim"],
+        "label": [True, False],
+    }
+    tokenized = tokenize_rl_batch(batch, "kto", tiny_tokenizer)
+    expected = kto_tokenize(batch, tiny_tokenizer)
+    for key, values in tokenized.items():
+        assert values == [list(value) for value in expected[key]]
+
+    # rows tokenized while preprocessing are kept as is by the trainer
+    assert kto_tokenize_unless_pretokenized({**batch, **tokenized}, None) == tokenized
+    assert drop_long_rl_seq_tokenized(tokenized, rl="kto", sequence_len=5) == [
+        False,
+        True,
+    ]
+
+
+def test_patch_kto_tokenize_is_idempotent(tiny_tokenizer, monkeypatch):
+    # restored after the test
+    monkeypatch.setattr(kto_trainer, "_tokenize", kto_tokenize)
+    patch_kto_tokenize()
+    patch_kto_tokenize()
+
+    # pylint: disable=protected-access
+    assert kto_trainer._tokenize is kto_tokenize_unless_pretokenized
+    batch = {"prompt": ["a lazy dog"], "completion": [" swim"], "label": [True]}
+    patched = kto_trainer._tokenize(batch, tiny_tokenizer)
+    for key, values in kto_tokenize(batch, tiny_tokenizer).items():
+        assert [list(value) for value in patched[key]] == [
+            list(value) for value in values
+        ]
+
+
+def test_ds_hash_depends_on_tokenizer_when_pretokenized(
+    tiny_tokenizer, tiny_tokenizer_factory, tiny_words
+):
+    datasets = [{"path": "dpo.jsonl", "type": "chatml.intel"}]
+    other_tokenizer = tiny_tokenizer_factory(list(reversed(tiny_words)))
+
+    cfg = DictDefault({"rl": "dpo", "sequence_len": 512})
+    assert _get_ds_hash(cfg, datasets) == _get_ds_hash(cfg, datasets, other_tokenizer)
+
+    cfg.rl_pretokenize = True
+    assert _get_ds_hash(cfg, datasets, tiny_tokenizer) != _get_ds_hash(
+        cfg, datasets, other_tokenizer
+    )
+    assert _get_ds_hash(cfg, datasets, tiny_tokenizer) == _get_ds_hash(
+        cfg, datasets, tiny_tokenizer_factory()
+    )
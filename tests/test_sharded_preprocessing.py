@@ -0,0 +1,98 @@
+"""
+test module for preprocessing disjoint dataset shards on every rank
+"""
+import json
+
+import pytest
+
+from axolotl.utils.data.cache import PREPARED_SOURCES_DIR
+from axolotl.utils.data.sft import load_tokenized_prepared_datasets
+from axolotl.utils.dict import DictDefault
+
+
+@pytest.fixture(name="tokenizer")
+def fixture_tokenizer(tiny_tokenizer_factory):
+    return tiny_tokenizer_factory(
+        "below is an instruction that describes a task write response".split()
+    )
+
+
+@pytest.fixture(name="data_files")
+def fixture_data_files(tmp_path):
+    paths = []
+    for name, num_rows in [("a", 11), ("b", 6)]:
+        path = tmp_path / f"{name}.jsonl"
+        with open(path, "w", encoding="utf-8") as fout:
+            for idx in range(num_rows):
+                row = {
+                    "instruction": f"write a response {' task' * idx}",
+                    "input": "",
+                    "output": f"{name} {idx}",
+                }
+                fout.write(json.dumps(row) + "\n")
+        paths.append(path)
+    return paths
+
+
+def make_cfg(data_files, prepared_path, **kwargs):
+    return DictDefault(
+        {
+            "datasets": [
+                DictDefault({"path": str(path), "type": "alpaca", "ds_type": "json"})
+                for path in data_files
+            ],
+            "dataset_prepared_path": str(prepared_path),
+            "sequence_len": 128,
+            "local_rank": 0,
+            "dataset_processes": 1,
+            **kwargs,
+        }
+    )
+
+
+class TestShardedPreprocessing:
+    """
+    test that per-rank shards merge into the same dataset as preprocessing on one rank
+    """
+
+    def test_shards_merge_to_unsharded(
+        self, tokenizer, data_files, tmp_path, monkeypatch
+    ):
+        expected, _ = load_tokenized_prepared_datasets(
+            tokenizer, make_cfg(data_files, tmp_path / "unsharded"), "unused"
+        )
+
+        monkeypatch.setenv("WORLD_SIZE", "3")
+        cfg = make_cfg(
+            data_files, tmp_path / "sharded", dataset_sharded_preprocessing=True
+        )
+        for rank in range(3):
+            dataset, _ = load_tokenized_prepared_datasets(
+                tokenizer, cfg, "unused", shard=(rank, 3)
+            )
+            assert dataset is None
+
+        sources_path = tmp_path / "sharded" / PREPARED_SOURCES_DIR
+        shard_dirs = sorted(path.name for path in sources_path.glob("*.shards/*"))
+        assert shard_dirs == sorted([f"{rank:05d}-of-00003" for rank in range(3)] * 2)
+
+        merged, _ = load_tokenized_prepared_datasets(tokenizer, cfg, "unused")
+        assert merged.to_dict() == expected.to_dict()
+        # the shards are dropped once the merged dataset is saved
+        assert not list(sources_path.glob("*.shards"))
+
+    def test_merge_falls_back_without_all_shards(
+        self, tokenizer, data_files, tmp_path, monkeypatch
+    ):
+        expected, _ = load_tokenized_prepared_datasets(
+            tokenizer, make_cfg(data_files, tmp_path / "unsharded"), "unused"
+        )
+
+        monkeypatch.setenv("WORLD_SIZE", "2")
+        cfg = make_cfg(
+            data_files, tmp_path / "sharded", dataset_sharded_preprocessing=True
+        )
+        load_tokenized_prepared_datasets(tokenizer, cfg, "unused", shard=(0, 2))
+
+        merged, _ = load_tokenized_prepared_datasets(tokenizer, cfg, "unused")
+        assert merged.to_dict() == expected.to_dict()
@@ -0,0 +1,61 @@
+"""
+tests for token-native batched generation
+"""
+import pytest
+import torch
+from transformers import GenerationConfig
+
+from axolotl.utils.generation import bucket_by_token_budget, generate_batched
+
+
+@pytest.fixture(name="model")
+def fixture_model(tiny_llama_factory):
+    return tiny_llama_factory(eos_token_id=5, pad_token_id=0).eval()
+
+
+def test_bucket_by_token_budget():
+    # longest first, each bucket's longest prompt + new tokens times its size within budget
+    assert bucket_by_token_budget([3, 9, 5, 12, 1, 7], 4, 30) == [
+        [3],
+        [1, 5],
+        [2, 0, 4],
+    ]
+    # a prompt longer than the budget still gets a bucket of its own
+    assert bucket_by_token_budget([50, 2], 4, 30) == [[0], [1]]
+
+
+@pytest.mark.parametrize("early_exit", [True, False])
+@pytest.mark.parametrize("max_tokens", [40, 10_000])
+def test_generate_batched_matches_generate(model, max_tokens, early_exit):
+    if not early_exit:
+        # falls back to `generate`, which pads the rows finishing first
+        model._supports_cache_class = False  # pylint: disable=protected-access
+    prompts = [
+        torch.randint(6, 64, (length,)).tolist() for length in [3, 9, 5, 12, 1, 7]
+    ]
+    # an eos token the first prompt emits early, so rows finish at different steps
+    eos_token_id = model.generate(
+        torch.tensor([prompts[0]]),
+        attention_mask=torch.ones((1, len(prompts[0])), dtype=torch.long),
+        generation_config=GenerationConfig(max_new_tokens=3, do_sample=False),
+    )[0, -1].item()
+    generation_config = GenerationConfig(
+        max_new_tokens=20, eos_token_id=[eos_token_id], pad_token_id=0, do_sample=False
+    )
+
+    completions = generate_batched(
+        model,
+        prompts,
+        generation_config,
+        pad_token_id=0,
+        max_tokens=max_tokens,
+        show_progress=False,
+    )
+
+    for prompt, completion in zip(prompts, completions):
+        expected = model.generate(
+            torch.tensor([prompt]),
+            attention_mask=torch.ones((1, len(prompt)), dtype=torch.long),
+            generation_config=generation_config,
+        )[0, len(prompt) :].tolist()
+        assert completion == expected